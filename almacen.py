@@ -0,0 +1,1837 @@
+"""Almacén en memoria de los registros de ordeño y las crías, y su almacén Excel.
+
+``Almacen`` es la interfaz común: copia en memoria con sus índices y cola de
+escritura; ``AlmacenExcel`` guarda los datos en las hojas 'Registros' y 'Crias' del
+libro y ``almacen_sqlite.AlmacenSQLite`` en una base SQLite.
+
+Las escrituras no reescriben el Excel: se anotan en un diario (JSON lines, una
+operación por línea) junto al archivo y se aplican en memoria al momento. Un hilo
+compactador vuelca el diario al Excel cada cierto tiempo o al superar un tamaño.
+
+Todas las escrituras de un proceso pasan por una única cola; el hilo escritor las
+agrupa en lotes y las anota en el diario bajo un bloqueo de archivo compartido entre
+procesos, de modo que varios workers de gunicorn no se pisan filas.
+
+Los registros de los meses cerrados se archivan, al compactar, en un libro por mes
+(``archivo/<nombre>_AAAA-MM.xlsx``) de solo lectura que conserva el número de fila
+y el ID de cada registro; el libro activo solo guarda los meses recientes, así que
+la compactación (que lo reescribe entero) no crece con el historial.
+
+Al arrancar, el libro se crea o se migra al esquema actual una sola vez, y el
+contenido ya leído se guarda en una instantánea binaria (``marshal``) junto al
+Excel; mientras el Excel no cambie, los arranques leen la instantánea en lugar
+de volver a interpretar el xlsx.
+"""
+import atexit
+import bisect
+import gc
+import heapq
+import itertools
+import json
+import marshal
+import operator
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from collections.abc import Mapping
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from openpyxl import Workbook, load_workbook
+
+from analitica import EstadisticasIncrementales, Genealogia, ResumenDiario, SeriesProduccion
+from metricas import tramo
+
+# Orden de columnas de la hoja principal (columna 1 = fecha_hora).
+# La columna 6 guarda el hash de la foto (o el base64 en filas aún no migradas).
+# Las tres últimas las asigna el almacén: ID estable del registro, versión (sube con cada
+# edición) y número de la última operación que lo escribió (cursor de sincronización).
+CAMPOS_REGISTRO = [
+    'fecha_hora', 'nombre_ordenador', 'id_vaca', 'nombre_vaca', 'litros', 'foto',
+    'edad', 'estado_productivo', 'vaca_parida', 'vaca_seca', 'numero_crias', 'numero_parto',
+    'vacunas', 'enfermedades', 'condicion_corporal', 'id_registro', 'version', 'seq'
+]
+# Columnas que escribe la aplicación (sin las que asigna el almacén)
+CAMPOS_EDITABLES = CAMPOS_REGISTRO[:-3]
+
+# Orden de columnas de la hoja 'Crias'; las dos últimas, como en los registros, las asigna el almacén
+CAMPOS_CRIA = [
+    'fecha_registro', 'madre_id', 'madre_nombre', 'cria_id', 'cria_nombre',
+    'fecha_nacimiento', 'sexo', 'observaciones', 'id_registro', 'seq'
+]
+CAMPOS_CRIA_EDITABLES = CAMPOS_CRIA[:-2]
+
+# Textos con pocos valores distintos (se repiten en miles de filas): cada valor se guarda
+# internado, un solo objeto compartido por todas las filas que lo tienen
+CAMPOS_CATEGORICOS = (
+    'nombre_ordenador', 'id_vaca', 'nombre_vaca', 'estado_productivo', 'vaca_parida', 'vaca_seca',
+    'vacunas', 'enfermedades', 'condicion_corporal'
+)
+
+# Encabezados de cada hoja, en el mismo orden que los campos
+ENCABEZADOS_REGISTRO = [
+    'FechaHora', 'Ordeñador', 'ID Vaca', 'Nombre Vaca', 'Litros', 'Foto', 'Edad', 'Estado', 'Parida', 'Seca',
+    'Nº Crías', 'Nº Parto', 'Vacunas', 'Enfermedades', 'Condición Corporal', 'ID Registro', 'Versión', 'Operación'
+]
+ENCABEZADOS_CRIA = [
+    'FechaRegistro', 'MadreID', 'MadreNombre', 'CriaID', 'CriaNombre', 'FechaNacimiento', 'Sexo', 'Observaciones',
+    'ID Registro', 'Operación'
+]
+
+# Hoja oculta donde el Excel recuerda hasta qué operación del diario contiene (fila 1)
+# y la versión del esquema del libro (fila 2)
+HOJA_META = '_meta'
+
+# Versiones del esquema del libro; cada una tiene su migración en MIGRACIONES:
+# 1: encabezados en 'Registros' y hoja 'Crias' con los suyos
+# 2: columnas 'ID Registro' y 'Versión', con el ID derivado en las filas anteriores
+# 3: columna 'Operación' en ambas hojas e 'ID Registro' en 'Crias' (vacías en las filas anteriores)
+VERSION_ESQUEMA = 3
+
+# Formato de la instantánea; cambiarlo invalida las guardadas
+# 2: filas como tuplas de valores en el orden de las columnas (antes, diccionarios)
+# 3: estado del resumen diario junto al de los demás índices
+FORMATO_INSTANTANEA = 3
+# Libros de archivo: un mes por libro, con la fila original en la primera columna
+_PATRON_ARCHIVO = re.compile(r'_(\d{4}-\d{2})\.xlsx$')
+_PATRON_MES = re.compile(r'\d{4}-\d{2}')
+
+# Columnas de cada hoja que pueden llegar del Excel como datetime (marshal no los admite)
+POSICIONES_FECHA_REGISTRO = (CAMPOS_REGISTRO.index('fecha_hora'),)
+POSICIONES_FECHA_CRIA = (CAMPOS_CRIA.index('fecha_registro'), CAMPOS_CRIA.index('fecha_nacimiento'))
+
+
+class RegistroArchivado(ValueError):
+    """El registro pertenece a un mes archivado, que es de solo lectura."""
+
+    def __init__(self, fila):
+        super().__init__(f'El registro de la fila {fila} pertenece a un mes archivado (solo lectura)')
+        self.fila = fila
+
+
+class ConflictoVersion(Exception):
+    """La edición esperaba otra versión del registro: alguien lo modificó antes."""
+
+    def __init__(self, actual):
+        super().__init__('El registro fue modificado por otra persona')
+        self.actual = actual
+
+
+def id_registro_legado(fila, hoja='registro'):
+    """ID estable de una fila anterior a los IDs: se deriva del número de fila (y de la hoja: 'registro' o 'cria')."""
+    return uuid.uuid5(uuid.NAMESPACE_URL, f'veterinaria:{hoja}:{fila}').hex
+
+
+# Litros ya vistos: las filas con la misma cantidad comparten el mismo float. Con pocos
+# decimales hay pocas cantidades distintas; pasado el tope las nuevas ya no se guardan
+_DECIMALES = {}
+_MAX_DECIMALES = 4096
+_POS_LITROS = CAMPOS_REGISTRO.index('litros')
+_POS_CATEGORICOS = tuple(CAMPOS_REGISTRO.index(campo) for campo in CAMPOS_CATEGORICOS)
+_CLAVES_REGISTRO = ('fila', *CAMPOS_REGISTRO)
+
+
+class Registro(Mapping):
+    """Registro de ordeño en memoria: un objeto con ``__slots__`` en lugar de un diccionario.
+
+    Se lee igual que el diccionario al que sustituye (``registro['litros']``, ``get``,
+    ``items``, ``dict(registro)``; en las plantillas también ``registro.litros``) y ocupa
+    menos de la mitad: sin tabla de claves por fila, con los textos de
+    ``CAMPOS_CATEGORICOS`` internados y los litros repetidos compartidos. Como los
+    diccionarios de antes, no se modifica: una edición crea un registro nuevo.
+    """
+
+    __slots__ = _CLAVES_REGISTRO
+
+    def __init__(self, fila, valores):
+        valores = list(valores)
+        if len(valores) != len(CAMPOS_REGISTRO):
+            valores = (valores + [None] * len(CAMPOS_REGISTRO))[:len(CAMPOS_REGISTRO)]
+        for pos in _POS_CATEGORICOS:
+            if type(valores[pos]) is str:
+                valores[pos] = sys.intern(valores[pos])
+        litros = valores[_POS_LITROS]
+        if type(litros) is float:
+            if len(_DECIMALES) < _MAX_DECIMALES:
+                valores[_POS_LITROS] = _DECIMALES.setdefault(litros, litros)
+            else:
+                valores[_POS_LITROS] = _DECIMALES.get(litros, litros)
+        self.fila = fila
+        # En el orden de CAMPOS_REGISTRO (asignar por desempaquetado es lo más rápido al cargar miles de filas)
+        (self.fecha_hora, self.nombre_ordenador, self.id_vaca, self.nombre_vaca, self.litros, self.foto,
+         self.edad, self.estado_productivo, self.vaca_parida, self.vaca_seca, self.numero_crias, self.numero_parto,
+         self.vacunas, self.enfermedades, self.condicion_corporal, self.id_registro, self.version, self.seq) = valores
+        # Columnas añadidas después: pueden no existir en filas antiguas
+        self.vacunas = self.vacunas or ''
+        self.enfermedades = self.enfermedades or ''
+        self.condicion_corporal = self.condicion_corporal or ''
+        self.id_registro = self.id_registro or id_registro_legado(fila)
+        self.version = self.version or 1
+        self.seq = self.seq or 0
+
+    def __getitem__(self, campo):
+        if campo in _CAMPOS_REGISTRO_FILA:
+            return getattr(self, campo)
+        raise KeyError(campo)
+
+    def __iter__(self):
+        return iter(_CLAVES_REGISTRO)
+
+    def __len__(self):
+        return len(_CLAVES_REGISTRO)
+
+    def __eq__(self, otro):
+        if isinstance(otro, Registro):
+            return _valores_registro(self) == _valores_registro(otro) and self.fila == otro.fila
+        return Mapping.__eq__(self, otro)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Registro({dict(self)!r})'
+
+
+_CAMPOS_REGISTRO_FILA = frozenset(_CLAVES_REGISTRO)
+# Valores de un registro en el orden de CAMPOS_REGISTRO, como tupla (en C, sin recorrer los campos en Python)
+_valores_registro = operator.attrgetter(*CAMPOS_REGISTRO)
+_valores_cria = operator.itemgetter(*CAMPOS_CRIA)
+
+
+def fila_a_registro(idx, row):
+    """Convierte una fila de la hoja principal en el ``Registro`` usado por las vistas."""
+    return Registro(idx, row)
+
+
+def registro_a_valores(registro):
+    """Valores de un registro en el orden de columnas de la hoja (inversa de ``fila_a_registro``)."""
+    return [registro[campo] for campo in CAMPOS_REGISTRO]
+
+
+def cria_a_valores(cria):
+    """Valores de una cría en el orden de columnas de la hoja 'Crias'."""
+    return [cria[campo] for campo in CAMPOS_CRIA]
+
+
+def fila_a_cria(idx, row):
+    """Convierte una fila de la hoja 'Crias' en diccionario."""
+    row_len = len(row)
+    cria = {'fila': idx}
+    for pos, campo in enumerate(CAMPOS_CRIA):
+        cria[campo] = row[pos] if pos < row_len else None
+    cria['observaciones'] = cria['observaciones'] or ''
+    cria['id_registro'] = cria['id_registro'] or id_registro_legado(idx, 'cria')
+    cria['seq'] = cria['seq'] or 0
+    return cria
+
+
+def _como_en_excel(valor):
+    """Normaliza un valor como lo devolvería openpyxl al releer el libro (30.0 -> 30)."""
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    return valor
+
+
+def _valor_meta(wb, fila):
+    if HOJA_META not in wb.sheetnames:
+        return 0
+    for row in wb[HOJA_META].iter_rows(min_row=fila, max_row=fila, values_only=True):
+        if row and len(row) > 1 and row[1]:
+            return int(row[1])
+    return 0
+
+
+def _seq_en_excel(wb):
+    """Última operación del diario ya volcada en el libro (0 si nunca se compactó)."""
+    return _valor_meta(wb, 1)
+
+
+def _esquema_en_excel(wb):
+    """Versión del esquema del libro (0 si es anterior a las versiones)."""
+    return _valor_meta(wb, 2)
+
+
+def _hoja_meta(wb):
+    if HOJA_META in wb.sheetnames:
+        return wb[HOJA_META]
+    meta = wb.create_sheet(HOJA_META)
+    meta.sheet_state = 'hidden'
+    meta['A1'] = 'seq_diario'
+    meta['B1'] = 0
+    return meta
+
+
+def _completar_ids(ws):
+    """Añade los encabezados que falten y guarda el ID derivado en las filas anteriores a los IDs."""
+    for col, titulo in enumerate(ENCABEZADOS_REGISTRO, start=1):
+        if ws.cell(row=1, column=col).value is None:
+            ws.cell(row=1, column=col, value=titulo)
+    col_id = CAMPOS_REGISTRO.index('id_registro') + 1
+    for row in ws.iter_rows(min_row=2, max_col=col_id + 1):
+        if row[0].value and not row[col_id - 1].value:
+            row[col_id - 1].value = id_registro_legado(row[0].row)
+            row[col_id].value = 1
+
+
+def _migrar_encabezados(wb):
+    ws = wb.active
+    if ws.max_row == 1 and ws['A1'].value is None:
+        for col, titulo in enumerate(ENCABEZADOS_REGISTRO, start=1):
+            ws.cell(row=1, column=col, value=titulo)
+    if 'Crias' not in wb.sheetnames:
+        wb.create_sheet('Crias').append(ENCABEZADOS_CRIA)
+
+
+def _migrar_ids(wb):
+    _completar_ids(wb.active)
+
+
+def _migrar_operaciones(wb):
+    """Columna 'Operación' en ambas hojas e 'ID Registro' en 'Crias', con el ID derivado en las crías anteriores."""
+    for col, titulo in enumerate(ENCABEZADOS_REGISTRO, start=1):
+        if wb.active.cell(row=1, column=col).value is None:
+            wb.active.cell(row=1, column=col, value=titulo)
+    ws = wb['Crias']
+    for col, titulo in enumerate(ENCABEZADOS_CRIA, start=1):
+        if ws.cell(row=1, column=col).value is None:
+            ws.cell(row=1, column=col, value=titulo)
+    col_id = CAMPOS_CRIA.index('id_registro') + 1
+    for row in ws.iter_rows(min_row=2, max_col=col_id):
+        if len(row) > 1 and row[1].value and not row[col_id - 1].value:
+            row[col_id - 1].value = id_registro_legado(row[0].row, 'cria')
+
+
+# versión -> migración que lleva el libro de la versión anterior a esa
+MIGRACIONES = {1: _migrar_encabezados, 2: _migrar_ids, 3: _migrar_operaciones}
+
+
+def _a_instantanea(por_fila, valores, posiciones_fecha):
+    """``{fila: tupla de valores}`` apta para marshal y filas con fechas datetime.
+
+    ``valores`` extrae la tupla de un registro o cría. marshal no admite datetime: esas
+    fechas (en las columnas ``posiciones_fecha``) se guardan como ``(isoformat,)``.
+    """
+    tuplas, con_fecha = {}, []
+    for fila, datos in por_fila.items():
+        tupla = valores(datos)
+        if any(isinstance(tupla[pos], datetime) for pos in posiciones_fecha):
+            tupla = tuple((v.isoformat(),) if isinstance(v, datetime) else v for v in tupla)
+            con_fecha.append(fila)
+        tuplas[fila] = tupla
+    return tuplas, con_fecha
+
+
+def _de_instantanea(tuplas, con_fecha, a_datos):
+    """Inversa de ``_a_instantanea``: ``{fila: registro o cría}`` construidos con ``a_datos(fila, valores)``."""
+    for fila in con_fecha:
+        tuplas[fila] = tuple(datetime.fromisoformat(v[0]) if type(v) is tuple else v for v in tuplas[fila])
+    return {fila: a_datos(fila, valores) for fila, valores in tuplas.items()}
+
+
+def _fsync(ruta):
+    with open(ruta, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def escribir_libro(destino, registros, crias):
+    """Escribe un libro completo en el formato de la aplicación (ruta o archivo abierto).
+
+    ``registros`` y ``crias`` van por fila ascendente; cada uno queda en su número de
+    fila (los huecos, como filas vacías), así que el libro sirve de almacén Excel con
+    los mismos IDs y enlaces; la última operación del libro es la mayor de sus filas,
+    así que los cursores de sincronización siguen valiendo. Se escribe en modo
+    ``write_only``, fila a fila.
+    """
+    wb = Workbook(write_only=True)
+    seq = 0
+    for titulo, encabezados, filas, a_valores in (('Registros', ENCABEZADOS_REGISTRO, registros, registro_a_valores),
+                                                  ('Crias', ENCABEZADOS_CRIA, crias, cria_a_valores)):
+        ws = wb.create_sheet(titulo)
+        ws.append(encabezados)
+        siguiente = 2
+        for datos in filas:
+            for _ in range(datos['fila'] - siguiente):
+                ws.append([])
+            ws.append(a_valores(datos))
+            siguiente = datos['fila'] + 1
+            seq = max(seq, datos['seq'])
+    meta = wb.create_sheet(HOJA_META)
+    meta.sheet_state = 'hidden'
+    meta.append(['seq_diario', seq])
+    meta.append(['version_esquema', VERSION_ESQUEMA])
+    wb.save(destino)
+
+
+# Columnas por las que se puede ordenar la consulta de registros
+COLUMNAS_ORDENABLES = (
+    'fecha_hora', 'nombre_ordenador', 'id_vaca', 'nombre_vaca', 'edad', 'estado_productivo',
+    'litros', 'numero_crias', 'numero_parto', 'condicion_corporal'
+)
+
+
+def clave_fecha(valor):
+    """Fecha como texto 'AAAA-MM-DD HH:MM:SS' (ordenable), venga como texto o como datetime de Excel."""
+    if isinstance(valor, datetime):
+        return valor.strftime('%Y-%m-%d %H:%M:%S')
+    return str(valor) if valor is not None else ''
+
+
+def clave_texto(valor):
+    """Normaliza IDs y nombres para buscarlos sin importar espacios ni mayúsculas."""
+    return str(valor).strip().lower() if valor is not None else ''
+
+
+def _clave_orden(valor):
+    # Números antes que textos y vacíos al final, sin comparar tipos distintos entre sí
+    if valor is None or valor == '':
+        return (2, 0, '')
+    if isinstance(valor, (int, float)):
+        return (0, valor, '')
+    if isinstance(valor, datetime):
+        return (1, 0, clave_fecha(valor))
+    texto = str(valor).strip()
+    try:
+        return (0, float(texto), '')
+    except ValueError:
+        return (1, 0, texto.lower())
+
+
+def _pagina(secuencia, lo, hi, offset, limite, descendente):
+    """Página de ``secuencia[lo:hi]`` (ya ordenada ascendente) sin copiar el resto."""
+    if descendente:
+        fin = max(lo, hi - offset)
+        return secuencia[max(lo, fin - limite):fin][::-1]
+    inicio = min(hi, lo + offset)
+    return secuencia[inicio:min(hi, inicio + limite)]
+
+
+class IndiceRegistros:
+    """Índices secundarios de los registros en memoria: valor exacto -> filas, y fecha ordenada.
+
+    Una página filtrada se resuelve con búsquedas binarias sobre la fecha e intersecciones
+    de conjuntos, sin recorrer toda la hoja.
+    """
+
+    CAMPOS_EXACTOS = ('id_vaca', 'nombre_ordenador', 'estado_productivo')
+
+    def __init__(self, registros=()):
+        self._por_campo = {campo: {} for campo in self.CAMPOS_EXACTOS}
+        self._por_fecha = []  # [(clave_fecha, fila)] siempre ordenada
+        self._ordenes = {}  # columna -> filas ordenadas; se descarta con cada cambio
+        for registro in registros:
+            self._agregar_a_campos(registro)
+            self._por_fecha.append((clave_fecha(registro['fecha_hora']), registro['fila']))
+        self._por_fecha.sort()
+
+    def estado(self):
+        """Índices en tipos básicos para la instantánea (sin copiar: serializarlos bajo el lock)."""
+        return {'por_campo': self._por_campo, 'por_fecha': self._por_fecha}
+
+    @classmethod
+    def desde_estado(cls, estado):
+        indice = cls()
+        indice._por_campo = estado['por_campo']
+        indice._por_fecha = estado['por_fecha']
+        return indice
+
+    def _agregar_a_campos(self, registro):
+        for campo, indice in self._por_campo.items():
+            indice.setdefault(clave_texto(registro[campo]), set()).add(registro['fila'])
+
+    def agregar(self, registro):
+        self._ordenes.clear()
+        self._agregar_a_campos(registro)
+        bisect.insort(self._por_fecha, (clave_fecha(registro['fecha_hora']), registro['fila']))
+
+    def quitar(self, registro):
+        self._ordenes.clear()
+        fila = registro['fila']
+        for campo, indice in self._por_campo.items():
+            clave = clave_texto(registro[campo])
+            filas = indice.get(clave)
+            if filas is not None:
+                filas.discard(fila)
+                if not filas:
+                    del indice[clave]
+        entrada = (clave_fecha(registro['fecha_hora']), fila)
+        pos = bisect.bisect_left(self._por_fecha, entrada)
+        if pos < len(self._por_fecha) and self._por_fecha[pos] == entrada:
+            del self._por_fecha[pos]
+
+    def filas(self, filtros=None, desde=None, hasta=None):
+        """Números de fila que cumplen los filtros, por fecha ascendente (para exportar)."""
+        candidatos = None
+        for campo, valor in (filtros or {}).items():
+            if valor:
+                filas = self._por_campo[campo].get(clave_texto(valor), set())
+                candidatos = filas if candidatos is None else candidatos & filas
+        lo = bisect.bisect_left(self._por_fecha, (desde,)) if desde else 0
+        hi = bisect.bisect_left(self._por_fecha, (hasta + '\uffff',)) if hasta else len(self._por_fecha)
+        return [fila for _, fila in self._por_fecha[lo:hi] if candidatos is None or fila in candidatos]
+
+    def consultar(self, por_fila, filtros=None, desde=None, hasta=None, orden='fecha_hora',
+                  descendente=True, offset=0, limite=50):
+        """Devuelve ``(total, pagina)`` de los registros que cumplen los filtros.
+
+        ``filtros`` mapea campos de ``CAMPOS_EXACTOS`` a su valor; ``desde``/``hasta``
+        son fechas 'AAAA-MM-DD' inclusivas. Ordenar por fecha sin otros filtros cuesta
+        lo que mide la página; otros órdenes ordenan solo las filas que coinciden.
+        """
+        candidatos = None
+        for campo, valor in (filtros or {}).items():
+            if not valor:
+                continue
+            filas = self._por_campo[campo].get(clave_texto(valor), set())
+            candidatos = filas if candidatos is None else candidatos & filas
+
+        lo = bisect.bisect_left(self._por_fecha, (desde,)) if desde else 0
+        hi = bisect.bisect_left(self._por_fecha, (hasta + '\uffff',)) if hasta else len(self._por_fecha)
+        hi = max(lo, hi)
+
+        if candidatos is None and orden == 'fecha_hora':
+            trozo = _pagina(self._por_fecha, lo, hi, offset, limite, descendente)
+            return hi - lo, [por_fila[fila] for _, fila in trozo]
+
+        if orden == 'fecha_hora':
+            clave = lambda fila: (clave_fecha(por_fila[fila]['fecha_hora']), fila)
+        else:
+            clave = lambda fila: (_clave_orden(por_fila[fila][orden]), fila)
+
+        if candidatos is None and not desde and not hasta:
+            # Toda la hoja: el orden se calcula una vez y se reutiliza hasta el próximo cambio
+            ordenadas = self._ordenes.get(orden)
+            if ordenadas is None:
+                ordenadas = self._ordenes[orden] = sorted((fila for _, fila in self._por_fecha), key=clave)
+            trozo = _pagina(ordenadas, 0, len(ordenadas), offset, limite, descendente)
+            return len(ordenadas), [por_fila[fila] for fila in trozo]
+
+        if candidatos is None:
+            filas = [fila for _, fila in self._por_fecha[lo:hi]]
+        elif len(candidatos) < hi - lo:
+            clave_desde = desde or ''
+            clave_hasta = (hasta + '\uffff') if hasta else None
+            filas = []
+            for fila in candidatos:
+                valor = clave_fecha(por_fila[fila]['fecha_hora'])
+                if valor >= clave_desde and (clave_hasta is None or valor < clave_hasta):
+                    filas.append(fila)
+        else:
+            filas = [fila for _, fila in self._por_fecha[lo:hi] if fila in candidatos]
+
+        # Solo hace falta ordenar hasta el final de la página pedida
+        seleccion = (heapq.nlargest if descendente else heapq.nsmallest)(offset + limite, filas, key=clave)
+        return len(filas), [por_fila[fila] for fila in seleccion[offset:]]
+
+
+class CatalogoVacas:
+    """Catálogo de vacas mantenido con cada alta o edición: ID -> nombre, último ordeño, estado y crías.
+
+    Cada vaca guarda sus filas ordenadas por fecha; el nombre, el estado y el último
+    ordeño salen de la más reciente. La búsqueda por prefijo (de ID o de nombre) usa
+    una lista ordenada de claves y búsqueda binaria.
+
+    ``por_fila`` es el ``{fila: registro}`` del almacén, compartido (no se copia): el
+    almacén lo actualiza antes de llamar a ``agregar`` y el catálogo solo lo lee.
+    """
+
+    def __init__(self, por_fila=None, crias=()):
+        self._filas = {}  # clave de la vaca -> [(clave_fecha, fila)] ordenada
+        self._crias = {}  # clave de la madre -> número de crías
+        self._claves_busqueda = {}  # clave de la vaca -> claves que tiene en _busqueda
+        self._busqueda = []  # [(texto normalizado, clave de la vaca)] ordenada
+        self._por_fila = {} if por_fila is None else por_fila
+        for registro in self._por_fila.values():
+            clave = clave_texto(registro['id_vaca'])
+            if clave:
+                self._filas.setdefault(clave, []).append((clave_fecha(registro['fecha_hora']), registro['fila']))
+        for clave, filas in self._filas.items():
+            filas.sort()
+            self._claves_busqueda[clave] = self._textos(clave)
+            self._busqueda.extend((texto, clave) for texto in self._claves_busqueda[clave])
+        self._busqueda.sort()
+        for cria in crias:
+            self.agregar_cria(cria)
+
+    def estado(self):
+        """Catálogo en tipos básicos para la instantánea; los registros se guardan aparte."""
+        return {'filas': self._filas, 'crias': self._crias, 'claves_busqueda': self._claves_busqueda,
+                'busqueda': self._busqueda}
+
+    @classmethod
+    def desde_estado(cls, estado, por_fila):
+        catalogo = cls()
+        catalogo._por_fila = por_fila
+        catalogo._filas = estado['filas']
+        catalogo._crias = estado['crias']
+        catalogo._claves_busqueda = estado['claves_busqueda']
+        catalogo._busqueda = estado['busqueda']
+        return catalogo
+
+    def _textos(self, clave):
+        ultimo = self._por_fila[self._filas[clave][-1][1]]
+        nombre = clave_texto(ultimo['nombre_vaca'])
+        return (clave, nombre) if nombre and nombre != clave else (clave,)
+
+    def _reindexar(self, clave):
+        """Actualiza las claves de búsqueda de una vaca tras cambiar sus filas."""
+        for texto in self._claves_busqueda.pop(clave, ()):
+            pos = bisect.bisect_left(self._busqueda, (texto, clave))
+            if pos < len(self._busqueda) and self._busqueda[pos] == (texto, clave):
+                del self._busqueda[pos]
+        if self._filas.get(clave):
+            self._claves_busqueda[clave] = self._textos(clave)
+            for texto in self._claves_busqueda[clave]:
+                bisect.insort(self._busqueda, (texto, clave))
+        else:
+            self._filas.pop(clave, None)
+
+    def agregar(self, registro):
+        clave = clave_texto(registro['id_vaca'])
+        if clave:
+            bisect.insort(self._filas.setdefault(clave, []), (clave_fecha(registro['fecha_hora']), registro['fila']))
+            self._reindexar(clave)
+
+    def quitar(self, registro):
+        clave = clave_texto(registro['id_vaca'])
+        filas = self._filas.get(clave)
+        if filas is not None:
+            entrada = (clave_fecha(registro['fecha_hora']), registro['fila'])
+            pos = bisect.bisect_left(filas, entrada)
+            if pos < len(filas) and filas[pos] == entrada:
+                del filas[pos]
+            self._reindexar(clave)
+
+    def agregar_cria(self, cria):
+        clave = clave_texto(cria['madre_id'])
+        self._crias[clave] = self._crias.get(clave, 0) + 1
+
+    def quitar_cria(self, cria):
+        clave = clave_texto(cria['madre_id'])
+        self._crias[clave] = self._crias.get(clave, 0) - 1
+
+    def _ficha(self, clave):
+        filas = self._filas[clave]
+        ultimo = self._por_fila[filas[-1][1]]
+        return {
+            'id': str(ultimo['id_vaca']).strip(),
+            'nombre': ultimo['nombre_vaca'] or '',
+            'ultimo_ordeno': filas[-1][0],
+            'estado': ultimo['estado_productivo'] or '',
+            'ordenos': len(filas),
+            'crias': self._crias.get(clave, 0),
+        }
+
+    def vaca(self, id_vaca):
+        """Ficha de una vaca por su ID (sin distinguir mayúsculas), o None."""
+        clave = clave_texto(id_vaca)
+        return self._ficha(clave) if clave in self._filas else None
+
+    def vacas(self):
+        """Todas las vacas, ordenadas por ID."""
+        return [self._ficha(clave) for clave in sorted(self._filas)]
+
+    def buscar(self, texto, limite=10):
+        """Hasta ``limite`` vacas cuyo ID o nombre empieza por ``texto``, en orden alfabético."""
+        prefijo = clave_texto(texto)
+        encontradas = {}
+        pos = bisect.bisect_left(self._busqueda, (prefijo,))
+        while pos < len(self._busqueda) and len(encontradas) < limite:
+            texto_vaca, clave = self._busqueda[pos]
+            if not texto_vaca.startswith(prefijo):
+                break
+            encontradas.setdefault(clave, None)
+            pos += 1
+        return [self._ficha(clave) for clave in encontradas]
+
+
+class IndiceCambios:
+    """Filas ordenadas por la última operación que las escribió: ``(seq, tipo, fila)``.
+
+    Responde a la sincronización de dispositivos: lo escrito después de un cursor sale
+    con una búsqueda binaria. Cada fila aparece una sola vez, con su operación más reciente.
+    """
+
+    INICIO = (-1,)
+
+    def __init__(self, registros=(), crias=()):
+        self._claves = sorted([(r['seq'], 'registro', r['fila']) for r in registros] +
+                              [(c['seq'], 'cria', c['fila']) for c in crias])
+
+    @staticmethod
+    def clave_cursor(cursor):
+        """Clave a partir de la que seguir: 'seq' (todo lo de esa operación ya entregado) o 'seq.tipo.fila'."""
+        partes = str(cursor or '').split('.')
+        try:
+            if len(partes) == 3 and partes[1] in ('cria', 'registro'):
+                return (int(partes[0]), partes[1], int(partes[2]))
+            if len(partes) == 1 and partes[0]:
+                # '~' va detrás de 'cria' y 'registro': cubre todas las filas de esa operación
+                return (int(partes[0]), '~')
+        except ValueError:
+            pass
+        if cursor:
+            raise ValueError(f'Cursor no válido: {cursor}')
+        return IndiceCambios.INICIO
+
+    def agregar(self, seq, tipo, fila):
+        bisect.insort(self._claves, (seq, tipo, fila))
+
+    def quitar(self, seq, tipo, fila):
+        pos = bisect.bisect_left(self._claves, (seq, tipo, fila))
+        if pos < len(self._claves) and self._claves[pos] == (seq, tipo, fila):
+            del self._claves[pos]
+
+    def desde(self, clave, limite):
+        """Hasta ``limite`` claves posteriores a ``clave``, en orden."""
+        pos = bisect.bisect_right(self._claves, clave)
+        return self._claves[pos:pos + limite]
+
+
+class BloqueoArchivo:
+    """Bloqueo exclusivo entre procesos sobre un archivo auxiliar (flock en POSIX, msvcrt en Windows)."""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._f = None
+
+    def adquirir(self, esperar=True):
+        """Toma el bloqueo; con ``esperar=False`` devuelve False si otro proceso lo tiene."""
+        f = open(self.ruta, 'a+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if esperar else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not esperar:
+                            raise
+                        time.sleep(0.05)
+        except OSError:
+            f.close()
+            return False
+        self._f = f
+        return True
+
+    def liberar(self):
+        f, self._f = self._f, None
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            f.close()
+
+    def __enter__(self):
+        self.adquirir()
+        return self
+
+    def __exit__(self, *exc):
+        self.liberar()
+
+
+class _Pendiente:
+    """Operación encolada a la espera del hilo escritor."""
+
+    __slots__ = ('op', 'valores', 'fila', 'version', 'id_registro', 'duplicado', 'encolada', 'listo', 'error')
+
+    def __init__(self, op, valores, fila, version=None, id_registro=None):
+        self.op = op
+        self.valores = list(valores)
+        self.fila = fila
+        self.version = version  # versión esperada en ediciones con If-Match
+        self.id_registro = id_registro  # ID elegido por el cliente: si ya existe, el alta no se repite
+        self.duplicado = False
+        self.encolada = time.perf_counter()
+        self.listo = threading.Event()
+        self.error = None
+
+
+class Almacen:
+    """Interfaz de almacenamiento de registros y crías, con su copia en memoria.
+
+    Las lecturas y consultas (páginas filtradas, estadísticas, resumen diario, catálogo
+    de vacas, series de producción, exportaciones) se responden desde memoria en cualquier
+    almacén; las altas y ediciones pasan por la cola del hilo escritor, que las
+    numera y las confirma por lotes. Cada subclase decide dónde se guardan:
+
+    - ``cargar()``: prepara el almacenamiento y lo lee una vez al arrancar.
+    - ``_vigente()``: pone la copia en memoria al día con lo que escribieron otros procesos.
+    - ``_escribir_lote(lote)``: persiste un lote (bajo su bloqueo entre procesos) y lo aplica.
+    - ``estado_datos()``, ``invalidar()``, ``compactar()`` y ``restaurar(registros, crias)``.
+
+    Las fotos no pasan por el almacén: se guardan aparte en ``AlmacenFotos`` y los
+    registros solo llevan su hash, así que sirven igual para cualquier almacén.
+    """
+
+    # Nombre que identifica el almacén en mensajes y en los hilos
+    tipo = None
+
+    def __init__(self, max_lote=200):
+        self.max_lote = max_lote
+        self._lock = threading.RLock()
+        self._cola = queue.Queue()
+        self._hilos = None
+        self._seq = 0  # última operación aplicada en memoria
+        self._por_fila = {}
+        self._indice = IndiceRegistros()
+        self._catalogo = CatalogoVacas(self._por_fila)
+        self._estadisticas = EstadisticasIncrementales()
+        self._resumen = ResumenDiario()
+        self._crias_por_fila = {}
+        self._fila_por_id = {}  # id_registro -> fila
+        self._fila_cria_por_id = {}
+        self._cambios = None  # IndiceCambios, construido con la primera sincronización
+        self._modificado = 0.0  # instante (epoch) del último cambio conocido
+        self._version = 0  # cambia con cada registro aplicado o recarga
+        self._series = (None, None)  # (versión, SeriesProduccion) construida a demanda
+        self._version_crias = 0  # cambia con cada cría aplicada o recarga
+        self._genealogia = (None, None)  # ((versión, versión de crías), Genealogia) construida a demanda
+        self._ultima_fila = {'registro': 1, 'cria': 1}
+        self._archivadas = set()  # filas de solo lectura (meses archivados)
+        self._estado_escritor = {'lotes': 0, 'operaciones': 0, 'espera_total': 0.0, 'espera_max': 0.0, 'lote_max': 0}
+
+    # ---- Almacenamiento (cada subclase) ----
+
+    def cargar(self):
+        """Prepara el almacenamiento (crearlo, migrarlo) y lo lee; se llama una vez al arrancar."""
+        raise NotImplementedError
+
+    def _vigente(self):
+        """Aplica en memoria los cambios de otros procesos (o recarga todo si hace falta)."""
+        raise NotImplementedError
+
+    def invalidar(self):
+        """Descarta la copia en memoria; la próxima lectura vuelve a leer el almacenamiento."""
+        raise NotImplementedError
+
+    def estado_datos(self):
+        """``(etiqueta, modificado)`` de los datos: la etiqueta es igual en todos los procesos
+        que ven los mismos datos (sirve de ETag) y ``modificado`` es el epoch del último cambio."""
+        raise NotImplementedError
+
+    def _escribir_lote(self, lote):
+        """Persiste el lote con una sola escritura y lo aplica en memoria (ver ``_numerar``)."""
+        raise NotImplementedError
+
+    def compactar(self):
+        """Lleva lo pendiente a su forma definitiva. Devuelve cuántas operaciones se volcaron."""
+        return 0
+
+    def restaurar(self, registros, crias):
+        """Sustituye todo el contenido por ``registros`` y ``crias`` conservando filas, IDs, versiones
+        y números de operación.
+
+        Sirve para migrar de un almacén a otro; no debe haber otros procesos escribiendo.
+        """
+        raise NotImplementedError
+
+    def reescribir_archivados(self, registros):
+        """Sustituye registros de meses archivados, que no admiten ``actualizar_registro``.
+
+        Solo para migraciones de datos (``flask migrar-fotos``). ``registros`` mapea cada
+        fila a sus valores, como en ``actualizar_registro``; cada registro conserva su ID
+        y sube de versión. Las filas que no están archivadas se ignoran. Devuelve cuántas se reescribieron.
+        """
+        raise NotImplementedError
+
+    def _hilos_de_fondo(self):
+        """Hilos que arrancan con la primera escritura: ``[(nombre, función)]``."""
+        return [(f'escritor-{self.tipo}', self._bucle_escritura)]
+
+    def archivado(self, fila):
+        """Si la fila está en un mes archivado (de solo lectura)."""
+        with self._lock:
+            self._vigente()
+            return fila in self._archivadas
+
+    def _aplicar_en_memoria(self, entrada):
+        fila = entrada['fila']
+        valores = [_como_en_excel(v) for v in entrada['valores']]
+        if entrada['op'] == 'cria':
+            destino = self._crias_por_fila
+            nuevo = fila_a_cria(fila, valores)
+            if fila in destino:
+                self._fila_cria_por_id.pop(destino[fila]['id_registro'], None)
+                self._estadisticas.quitar_cria(destino[fila])
+                self._catalogo.quitar_cria(destino[fila])
+            self._estadisticas.agregar_cria(nuevo)
+            self._catalogo.agregar_cria(nuevo)
+            self._fila_cria_por_id[nuevo['id_registro']] = fila
+            self._version_crias += 1
+        else:
+            destino = self._por_fila
+            nuevo = fila_a_registro(fila, valores)
+            if fila in destino:
+                self._fila_por_id.pop(destino[fila]['id_registro'], None)
+                self._indice.quitar(destino[fila])
+                self._estadisticas.quitar(destino[fila])
+                self._resumen.quitar(destino[fila])
+                self._catalogo.quitar(destino[fila])
+            self._indice.agregar(nuevo)
+            self._estadisticas.agregar(nuevo)
+            self._resumen.agregar(nuevo)
+            self._fila_por_id[nuevo['id_registro']] = fila
+            self._version += 1
+        self._modificado = max(self._modificado, entrada.get('ts', 0))
+        tipo = 'cria' if entrada['op'] == 'cria' else 'registro'
+        if self._cambios is not None:
+            if fila in destino:
+                self._cambios.quitar(destino[fila]['seq'], tipo, fila)
+            self._cambios.agregar(nuevo['seq'], tipo, fila)
+        # Se reemplaza el diccionario (no se modifica) para no alterar listas ya entregadas
+        desordenado = fila not in destino and destino and fila < next(reversed(destino))
+        destino[fila] = nuevo
+        if desordenado:
+            ordenado = dict(sorted(destino.items()))
+            destino.clear()
+            destino.update(ordenado)
+        if tipo == 'registro':
+            # El catálogo lee el registro nuevo de este mismo diccionario
+            self._catalogo.agregar(nuevo)
+        self._ultima_fila[tipo] = max(self._ultima_fila[tipo], fila)
+
+    def _reemplazar(self, registros, crias, ultima_fila, seq, modificado, archivadas=(), estados=None):
+        """Sustituye la copia en memoria por el contenido leído (``{fila: registro}``, ``{fila: cría}``).
+
+        ``estados`` son los índices ya construidos (instantánea); sin ellos se construyen.
+        """
+        self._por_fila = registros
+        self._archivadas = set(archivadas)
+        if estados is not None:
+            self._indice = IndiceRegistros.desde_estado(estados['indice'])
+            self._estadisticas = EstadisticasIncrementales.desde_estado(estados['estadisticas'])
+            self._resumen = ResumenDiario.desde_estado(estados['resumen'])
+            self._catalogo = CatalogoVacas.desde_estado(estados['catalogo'], registros)
+        else:
+            self._indice = IndiceRegistros(registros.values())
+            self._estadisticas = EstadisticasIncrementales(registros.values(), crias.values())
+            self._resumen = ResumenDiario(registros.values())
+            self._catalogo = CatalogoVacas(registros, crias.values())
+        self._fila_por_id = {registro['id_registro']: fila for fila, registro in registros.items()}
+        self._fila_cria_por_id = {cria['id_registro']: fila for fila, cria in crias.items()}
+        self._cambios = None
+        self._modificado = modificado
+        self._crias_por_fila = crias
+        self._version += 1
+        self._version_crias += 1
+        self._ultima_fila = dict(ultima_fila)
+        self._seq = seq
+
+    # ---- Lectura ----
+
+    def registros(self):
+        """Lista de registros de ordeño (diccionarios compartidos: no modificarlos)."""
+        with self._lock:
+            self._vigente()
+            return list(self._por_fila.values())
+
+    def registro(self, fila):
+        """Registro de la fila indicada o ``None`` si no existe."""
+        with self._lock:
+            self._vigente()
+            return self._por_fila.get(fila)
+
+    def registro_por_id(self, id_registro):
+        """Registro con ese ID estable o ``None``."""
+        with self._lock:
+            self._vigente()
+            fila = self._fila_por_id.get(id_registro)
+            return self._por_fila.get(fila) if fila is not None else None
+
+    def cria_por_id(self, id_registro):
+        """Cría con ese ID estable o ``None``."""
+        with self._lock:
+            self._vigente()
+            fila = self._fila_cria_por_id.get(id_registro)
+            return self._crias_por_fila.get(fila) if fila is not None else None
+
+    def cambios_desde(self, cursor='', limite=500):
+        """Registros y crías escritos después de ``cursor``: ``(registros, crias, cursor, mas)``.
+
+        El cursor es opaco para el cliente: el número de operación hasta el que ya tiene
+        todo ('123') o, a mitad de una página, la última fila entregada ('123.registro.45').
+        Vacío empieza desde el principio; uno posterior a la última operación (el
+        almacén se restauró) también, para que el dispositivo vuelva a bajarlo todo.
+        Cada fila sale una vez con sus valores actuales, aunque se editara varias veces.
+        """
+        with self._lock:
+            self._vigente()
+            clave = IndiceCambios.clave_cursor(cursor)
+            if clave[0] > self._seq:
+                clave = IndiceCambios.INICIO
+            if self._cambios is None:
+                self._cambios = IndiceCambios(self._por_fila.values(), self._crias_por_fila.values())
+            claves = self._cambios.desde(clave, limite + 1)
+            mas = len(claves) > limite
+            claves = claves[:limite]
+            registros = [self._por_fila[fila] for _, tipo, fila in claves if tipo == 'registro']
+            crias = [self._crias_por_fila[fila] for _, tipo, fila in claves if tipo == 'cria']
+            if mas:
+                cursor = '.'.join(str(parte) for parte in claves[-1])
+            else:
+                cursor = str(self._seq)
+        return registros, crias, cursor, mas
+
+    def consultar(self, **kwargs):
+        """Página de registros filtrada y ordenada; ver ``IndiceRegistros.consultar``."""
+        with self._lock:
+            self._vigente()
+            return self._indice.consultar(self._por_fila, **kwargs)
+
+    def estadisticas(self):
+        """Resumen del dashboard a partir de los agregados incrementales."""
+        with self._lock:
+            self._vigente()
+            return self._estadisticas.resumen(self._por_fila)
+
+    def resumen_periodo(self, desde=None, hasta=None):
+        """Agregados de un periodo desde el resumen diario (``ResumenDiario.periodo``), o None si no hay registros."""
+        with self._lock:
+            self._vigente()
+            periodo = self._resumen.periodo(desde, hasta)
+            if periodo is None:
+                return None
+            # Cada vaca, con el ID y el nombre de su ordeño más reciente (como en el catálogo)
+            for vaca in periodo['top_productoras']:
+                ficha = self._catalogo.vaca(vaca['vaca']) or {'id': vaca['vaca'], 'nombre': ''}
+                vaca['id_vaca'], vaca['nombre_vaca'] = ficha['id'], ficha['nombre']
+        return periodo
+
+    def interanual(self, desde, hasta, temporadas):
+        """El mismo periodo en las últimas ``temporadas``; ver ``ResumenDiario.interanual``."""
+        with self._lock:
+            self._vigente()
+            return self._resumen.interanual(desde, hasta, temporadas)
+
+    def produccion_mensual(self):
+        """Litros por mes de cada año, desde los totales diarios del resumen."""
+        with self._lock:
+            self._vigente()
+            return self._resumen.mensual()
+
+    def iterar_resumen(self, desde=None, hasta=None, lote=1000):
+        """Genera las filas del resumen diario (``ResumenDiario.filas``) con el ID de cada vaca, para exportar.
+
+        Como ``iterar_registros``, toma el lock de ``lote`` en ``lote`` filas.
+        """
+        with self._lock:
+            self._vigente()
+            filas = self._resumen.filas(desde, hasta)
+            ids = {}
+        while True:
+            with self._lock:
+                trozo = list(itertools.islice(filas, lote))
+                for fila in trozo:
+                    if fila[1] == 'vaca' and fila[2] not in ids:
+                        ficha = self._catalogo.vaca(fila[2])
+                        ids[fila[2]] = ficha['id'] if ficha else fila[2]
+            if not trozo:
+                return
+            yield from ((dia, tipo, ids[clave] if tipo == 'vaca' else clave, *valores)
+                        for dia, tipo, clave, *valores in trozo)
+
+    def vacas(self):
+        """Catálogo completo de vacas ordenado por ID; ver ``CatalogoVacas``."""
+        with self._lock:
+            self._vigente()
+            return self._catalogo.vacas()
+
+    def vaca(self, id_vaca):
+        """Ficha de una vaca del catálogo, o None si no tiene registros."""
+        with self._lock:
+            self._vigente()
+            return self._catalogo.vaca(id_vaca)
+
+    def buscar_vacas(self, texto, limite=10):
+        """Autocompletado: vacas cuyo ID o nombre empieza por ``texto``."""
+        with self._lock:
+            self._vigente()
+            return self._catalogo.buscar(texto, limite)
+
+    def series(self):
+        """Series de producción por vaca (NumPy), reconstruidas solo si hubo cambios desde la última."""
+        with self._lock:
+            self._vigente()
+            version, series = self._series
+            if version == self._version:
+                return series
+            version, registros = self._version, list(self._por_fila.values())
+        # Se construye fuera del lock: las escrituras no esperan a los arrays
+        series = SeriesProduccion(registros)
+        with self._lock:
+            if self._series[0] is None or self._series[0] < version:
+                self._series = (version, series)
+        return series
+
+    def genealogia(self):
+        """Grafo de linaje y fertilidad (``Genealogia``), reconstruido solo si cambiaron las crías o los registros."""
+        with self._lock:
+            self._vigente()
+            version, genealogia = self._genealogia
+            if version == (self._version, self._version_crias):
+                return genealogia
+            version = (self._version, self._version_crias)
+            crias, vacas = list(self._crias_por_fila.values()), self._catalogo.vacas()
+        genealogia = Genealogia(crias, vacas)
+        with self._lock:
+            if self._genealogia[0] is None or self._genealogia[0] < version:
+                self._genealogia = (version, genealogia)
+        return genealogia
+
+    def crias(self):
+        """Lista de crías registradas en la hoja 'Crias'."""
+        with self._lock:
+            self._vigente()
+            return list(self._crias_por_fila.values())
+
+    def iterar_registros(self, filtros=None, desde=None, hasta=None, lote=1000):
+        """Genera los registros filtrados por fecha ascendente, de ``lote`` en ``lote``.
+
+        Solo se retiene la lista de números de fila: cada lote se copia bajo el lock y
+        se suelta antes de entregarlo, así que exportar no bloquea las escrituras ni
+        duplica la hoja en memoria. Una fila editada mientras tanto sale con sus valores nuevos.
+        """
+        with self._lock:
+            self._vigente()
+            filas = self._indice.filas(filtros, desde, hasta)
+        for inicio in range(0, len(filas), lote):
+            with self._lock:
+                trozo = [self._por_fila.get(fila) for fila in filas[inicio:inicio + lote]]
+            yield from (registro for registro in trozo if registro is not None)
+
+    def iterar_crias(self, madre_id=None, desde=None, hasta=None, lote=1000):
+        """Genera las crías (opcionalmente de una madre y por fecha de registro) en orden de fila."""
+        with self._lock:
+            self._vigente()
+            filas = sorted(self._crias_por_fila)
+        clave_hasta = (hasta + '\uffff') if hasta else None
+        for inicio in range(0, len(filas), lote):
+            with self._lock:
+                trozo = [self._crias_por_fila.get(fila) for fila in filas[inicio:inicio + lote]]
+            for cria in trozo:
+                if cria is None:
+                    continue
+                if madre_id and clave_texto(cria['madre_id']) != clave_texto(madre_id):
+                    continue
+                fecha = clave_fecha(cria['fecha_registro'])
+                if (desde and fecha < desde) or (clave_hasta and fecha >= clave_hasta):
+                    continue
+                yield cria
+
+    # ---- Escritura ----
+
+    def _anotar(self, op, valores, fila=None, version=None):
+        """Encola una operación y espera a que el hilo escritor la confirme en el diario. Devuelve la fila."""
+        return self._anotar_grupo([_Pendiente(op, valores, fila, version)])[0]
+
+    def _anotar_grupo(self, grupo):
+        """Encola varias operaciones que el escritor anota juntas, en la misma escritura del diario.
+
+        Un grupo nunca se reparte entre lotes: o se confirman todas sus operaciones o
+        ninguna. Devuelve las filas asignadas, en orden.
+        """
+        self._iniciar_hilos()
+        self._cola.put(grupo)
+        with tramo('espera_escritor'):
+            for pendiente in grupo:
+                pendiente.listo.wait()
+        for pendiente in grupo:
+            if pendiente.error is not None:
+                raise pendiente.error
+        return [pendiente.fila for pendiente in grupo]
+
+    def agregar_registro(self, valores):
+        """Añade un registro de ordeño (valores en el orden de ``CAMPOS_REGISTRO``)."""
+        return self._anotar('registro', valores)
+
+    def agregar_registros(self, lista_valores):
+        """Añade varios registros con una sola escritura del diario (importaciones). Devuelve sus filas."""
+        grupo = [_Pendiente('registro', valores, None) for valores in lista_valores]
+        return self._anotar_grupo(grupo) if grupo else []
+
+    def actualizar_registro(self, fila, valores, version=None):
+        """Reemplaza los valores de la fila indicada; el ID se conserva y la versión sube en uno.
+
+        Con ``version`` la edición solo se aplica si el registro sigue en esa versión;
+        si no, lanza ``ConflictoVersion`` (control optimista para ediciones simultáneas).
+        Los registros de meses archivados no se editan: ``RegistroArchivado``.
+        """
+        if self.archivado(fila):
+            raise RegistroArchivado(fila)
+        return self._anotar('actualizar', valores, fila, version)
+
+    def agregar_cria(self, valores):
+        """Añade una cría (valores en el orden de ``CAMPOS_CRIA``)."""
+        return self._anotar('cria', valores)
+
+    def agregar_con_id(self, registros=(), crias=()):
+        """Altas con el ID elegido por el cliente (``[(id_registro, valores)]``), con una sola escritura.
+
+        Un ID que ya existe no se vuelve a dar de alta: reenviar el mismo lote tras un
+        corte no duplica nada. Devuelve ``(registros, crias)`` como listas de
+        ``(fila, nuevo)`` en el orden recibido.
+        """
+        grupo = [_Pendiente('registro', valores, None, id_registro=id_registro) for id_registro, valores in registros]
+        grupo += [_Pendiente('cria', valores, None, id_registro=id_registro) for id_registro, valores in crias]
+        if grupo:
+            self._anotar_grupo(grupo)
+        resultado = [(pendiente.fila, not pendiente.duplicado) for pendiente in grupo]
+        return resultado[:len(registros)], resultado[len(registros):]
+
+    def _numerar(self, lote):
+        """Asigna fila, identidad y número de operación a cada pendiente del lote; devuelve las entradas.
+
+        Se llama con la copia en memoria al día y bajo el bloqueo de escritura entre
+        procesos. Las ediciones con una versión que ya no es la actual quedan con
+        ``ConflictoVersion`` como error y no generan entrada; las altas con un ID que
+        ya existe quedan como ``duplicado`` con la fila que ya tenían.
+        """
+        entradas = []
+        ahora = time.time()
+        identidades = {}  # fila -> (id_registro, version) tras las ediciones de este lote
+        vistos = {}  # (tipo, id_registro) -> fila de las altas con ID de este lote
+        for pendiente in lote:
+            tipo = 'cria' if pendiente.op == 'cria' else 'registro'
+            if pendiente.id_registro is not None:
+                existentes = self._fila_cria_por_id if tipo == 'cria' else self._fila_por_id
+                fila = vistos.get((tipo, pendiente.id_registro), existentes.get(pendiente.id_registro))
+                if fila is not None:
+                    pendiente.fila, pendiente.duplicado = fila, True
+                    continue
+            if pendiente.fila is None:
+                pendiente.fila = self._ultima_fila[tipo] + 1
+            seq = self._seq + 1
+            if tipo == 'registro':
+                try:
+                    identidad = self._identidad(pendiente, identidades)
+                except ConflictoVersion as e:
+                    pendiente.error = e
+                    continue
+                identidades[pendiente.fila] = identidad
+                pendiente.valores = pendiente.valores[:len(CAMPOS_EDITABLES)] + [*identidad, seq]
+            else:
+                id_cria = pendiente.id_registro or uuid.uuid4().hex
+                pendiente.valores = pendiente.valores[:len(CAMPOS_CRIA_EDITABLES)] + [id_cria, seq]
+            if pendiente.id_registro is not None:
+                vistos[(tipo, pendiente.id_registro)] = pendiente.fila
+            entrada = {'seq': seq, 'op': pendiente.op, 'fila': pendiente.fila,
+                       'valores': pendiente.valores, 'ts': ahora}
+            self._seq = seq
+            self._ultima_fila[tipo] = max(self._ultima_fila[tipo], pendiente.fila)
+            entradas.append(entrada)
+        return entradas
+
+    def _identidad(self, pendiente, identidades):
+        """``(id_registro, version)`` que tendrá el registro tras la operación; comprueba la versión esperada."""
+        if pendiente.op != 'actualizar':
+            return pendiente.id_registro or uuid.uuid4().hex, 1
+        if pendiente.fila in identidades:
+            id_registro, version = identidades[pendiente.fila]
+        elif pendiente.fila in self._por_fila:
+            actual = self._por_fila[pendiente.fila]
+            id_registro, version = actual['id_registro'], actual['version']
+        else:
+            id_registro, version = id_registro_legado(pendiente.fila), 0
+        if pendiente.version is not None and pendiente.version != version:
+            raise ConflictoVersion(self._por_fila.get(pendiente.fila))
+        return id_registro, version + 1
+
+    def _bucle_escritura(self):
+        while True:
+            # Cada elemento de la cola es un grupo; un grupo grande puede superar max_lote
+            lote = list(self._cola.get())
+            while len(lote) < self.max_lote:
+                try:
+                    lote.extend(self._cola.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._escribir_lote(lote)
+            except Exception as e:
+                for pendiente in lote:
+                    pendiente.error = e
+
+            ahora = time.perf_counter()
+            estado = self._estado_escritor
+            estado['lotes'] += 1
+            estado['operaciones'] += len(lote)
+            estado['lote_max'] = max(estado['lote_max'], len(lote))
+            for pendiente in lote:
+                espera = ahora - pendiente.encolada
+                estado['espera_total'] += espera
+                estado['espera_max'] = max(estado['espera_max'], espera)
+                pendiente.listo.set()
+
+    def estado_escritor(self):
+        """Profundidad de la cola y tiempos de espera del hilo escritor (segundos)."""
+        estado = dict(self._estado_escritor)
+        operaciones = estado['operaciones']
+        estado['en_cola'] = self._cola.qsize()
+        estado['espera_media'] = estado['espera_total'] / operaciones if operaciones else 0.0
+        estado['operaciones_por_lote'] = operaciones / estado['lotes'] if estado['lotes'] else 0.0
+        return estado
+
+    def _iniciar_hilos(self):
+        if self._hilos is not None:
+            return
+        with self._lock:
+            if self._hilos is not None:
+                return
+            self._hilos = [threading.Thread(target=funcion, name=nombre, daemon=True)
+                           for nombre, funcion in self._hilos_de_fondo()]
+            for hilo in self._hilos:
+                hilo.start()
+            atexit.register(self.compactar)
+
+
+class AlmacenExcel(Almacen):
+    """Almacén sobre el Excel: lo mantiene en memoria y lo recarga solo si cambia en disco.
+
+    La firma (mtime, tamaño) del archivo y la fecha de la carpeta de archivo se comparan
+    en cada acceso, que cuesta dos ``os.stat`` en lugar de un ``load_workbook``. Con
+    ``meses_activos`` cada compactación archiva los registros de meses anteriores a los
+    ``meses_activos`` más recientes (incluido el actual); los meses archivados se leen
+    una vez y no se editan. Las altas y ediciones van al diario y se ven de inmediato en
+    las lecturas; las que anotan otros procesos se leen del final del diario en el
+    siguiente acceso.
+    """
+
+    tipo = 'excel'
+
+    def __init__(self, ruta, umbral_compactacion=512 * 1024, intervalo_compactacion=60, max_lote=200,
+                 meses_activos=None):
+        super().__init__(max_lote)
+        self.ruta = ruta
+        base = os.path.splitext(ruta)[0]
+        self.ruta_diario = base + '.diario.jsonl'
+        self.ruta_instantanea = base + '.instantanea'
+        self.carpeta_archivo = os.path.join(os.path.dirname(ruta), 'archivo')
+        self.meses_activos = meses_activos
+        self.umbral_compactacion = umbral_compactacion
+        self.intervalo_compactacion = intervalo_compactacion
+        self._bloqueo_diario = BloqueoArchivo(base + '.lock')
+        self._bloqueo_compactacion = BloqueoArchivo(base + '.compactar.lock')
+        self._lock_compactacion = threading.Lock()
+        self._despertar = threading.Event()
+        self._firma = None
+        self._diario_ino = None
+        self._diario_pos = 0
+        self._esquema = VERSION_ESQUEMA  # versión del libro leído
+
+    def _firma_actual(self):
+        st = os.stat(self.ruta)
+        try:
+            archivo = os.stat(self.carpeta_archivo).st_mtime_ns
+        except FileNotFoundError:
+            archivo = 0
+        # Cada libro de archivo se escribe con os.replace, que cambia la fecha de la carpeta
+        return (st.st_mtime_ns, st.st_size, archivo)
+
+    # ---- Archivo por meses ----
+
+    def _ruta_archivo(self, mes):
+        nombre = os.path.splitext(os.path.basename(self.ruta))[0]
+        return os.path.join(self.carpeta_archivo, f'{nombre}_{mes}.xlsx')
+
+    @staticmethod
+    def _leer_archivo(ruta):
+        """Registros de un libro de archivo: ``{fila: registro}``."""
+        registros = {}
+        wb = load_workbook(ruta, read_only=True)
+        try:
+            for row in wb.active.iter_rows(min_row=2, values_only=True):
+                if row and len(row) > 1 and row[0] and row[1]:
+                    registros[int(row[0])] = fila_a_registro(int(row[0]), row[1:])
+        finally:
+            wb.close()
+        return registros
+
+    def _leer_archivos(self):
+        """Registros de todos los meses archivados: ``{fila: registro}``."""
+        registros = {}
+        try:
+            nombres = sorted(os.listdir(self.carpeta_archivo))
+        except FileNotFoundError:
+            return registros
+        prefijo = os.path.splitext(os.path.basename(self.ruta))[0] + '_'
+        for nombre in nombres:
+            if nombre.startswith(prefijo) and _PATRON_ARCHIVO.search(nombre):
+                registros.update(self._leer_archivo(os.path.join(self.carpeta_archivo, nombre)))
+        return registros
+
+    def _por_archivar(self):
+        """Registros del libro activo de meses ya cerrados, agrupados por mes: ``{mes: {fila: registro}}``."""
+        if not self.meses_activos:
+            return {}
+        hoy = datetime.now()
+        indice_mes = hoy.year * 12 + hoy.month - 1 - self.meses_activos
+        ultimo_cerrado = f'{indice_mes // 12:04d}-{indice_mes % 12 + 1:02d}'
+        por_mes = {}
+        with self._lock:
+            self._vigente()
+            for fila in self._indice.filas(hasta=ultimo_cerrado):
+                if fila in self._archivadas:
+                    continue
+                registro = self._por_fila[fila]
+                mes = clave_fecha(registro['fecha_hora'])[:7]
+                if _PATRON_MES.fullmatch(mes):
+                    por_mes.setdefault(mes, {})[fila] = registro
+        return por_mes
+
+    def _escribir_archivo(self, mes, registros):
+        """Añade ``registros`` al libro de archivo del mes (lo crea o lo reescribe con los que ya tenía)."""
+        ruta = self._ruta_archivo(mes)
+        todos = self._leer_archivo(ruta) if os.path.exists(ruta) else {}
+        todos.update(registros)
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Registros')
+        ws.append(['Fila'] + ENCABEZADOS_REGISTRO)
+        for fila in sorted(todos):
+            ws.append([fila] + registro_a_valores(todos[fila]))
+        os.makedirs(self.carpeta_archivo, exist_ok=True)
+        tmp = ruta + '.tmp'
+        wb.save(tmp)
+        _fsync(tmp)
+        os.replace(tmp, ruta)
+
+    def reescribir_archivados(self, registros):
+        """Reescribe los libros de archivo con los registros cambiados (ver ``Almacen.reescribir_archivados``).
+
+        Se hace bajo el bloqueo de compactación, que es el único otro escritor de los libros de archivo.
+        """
+        with self._lock_compactacion, self._bloqueo_compactacion:
+            por_mes = {}
+            with self._lock:
+                self._vigente()
+                for fila, valores in registros.items():
+                    actual = self._por_fila.get(fila)
+                    if actual is None or fila not in self._archivadas:
+                        continue
+                    valores = list(valores[:len(CAMPOS_EDITABLES)]) + [
+                        actual['id_registro'], (actual['version'] or 1) + 1, actual['seq']]
+                    mes = clave_fecha(actual['fecha_hora'])[:7]
+                    por_mes.setdefault(mes, {})[fila] = fila_a_registro(fila, valores)
+            with tramo('archivo_guardado'):
+                for mes, cambiados in sorted(por_mes.items()):
+                    self._escribir_archivo(mes, cambiados)
+            with self._lock:
+                # La carpeta de archivo cambió: la próxima lectura relee el libro y los archivos
+                self._vigente()
+        self._guardar_instantanea()
+        return sum(map(len, por_mes.values()))
+
+    # ---- Diario ----
+
+    def _leer_diario(self, desde=0):
+        """Operaciones del diario a partir del byte ``desde`` y posición final leída.
+
+        Solo se consumen líneas completas: una línea cortada (caída a mitad de escritura
+        u otro proceso escribiendo) se deja para la siguiente lectura.
+        """
+        entradas = []
+        pos = desde
+        try:
+            with open(self.ruta_diario, 'rb') as f:
+                f.seek(desde)
+                for linea in f:
+                    if not linea.endswith(b'\n'):
+                        break
+                    pos += len(linea)
+                    try:
+                        entradas.append(json.loads(linea))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return entradas, pos
+
+    def _reescribir_diario(self, entradas):
+        tmp = self.ruta_diario + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for entrada in entradas:
+                f.write(json.dumps(entrada, ensure_ascii=False, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ruta_diario)
+
+    def _seguir_diario(self):
+        """Aplica en memoria las operaciones del diario que aún no se han visto."""
+        try:
+            st = os.stat(self.ruta_diario)
+        except FileNotFoundError:
+            self._diario_ino, self._diario_pos = None, 0
+            return
+        if st.st_ino != self._diario_ino:
+            self._diario_ino, self._diario_pos = st.st_ino, 0
+        if st.st_size <= self._diario_pos:
+            return
+        entradas, self._diario_pos = self._leer_diario(self._diario_pos)
+        for entrada in entradas:
+            if entrada['seq'] > self._seq:
+                self._aplicar_en_memoria(entrada)
+                self._seq = entrada['seq']
+
+    # ---- Lectura ----
+
+    def _recargar(self, firma):
+        # Tras una compactación de otro proceso suele haber ya una instantánea del libro nuevo
+        if self._leer_instantanea(firma):
+            return
+        with tramo('excel_carga'):
+            self._leer_excel(firma)
+
+    def _leer_excel(self, firma):
+        wb = load_workbook(self.ruta, read_only=True)
+        try:
+            ws = wb.active
+            registros = {}
+            ultima_registro = 1
+            for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
+                ultima_registro = idx
+                if row and row[0]:  # Si hay fecha y hora
+                    registros[idx] = fila_a_registro(idx, row)
+
+            crias = {}
+            ultima_cria = 1
+            if 'Crias' in wb.sheetnames:
+                for idx, row in enumerate(wb['Crias'].iter_rows(min_row=2, values_only=True), start=2):
+                    ultima_cria = idx
+                    if row and len(row) > 1 and row[1]:
+                        crias[idx] = fila_a_cria(idx, row)
+            seq_excel = _seq_en_excel(wb)
+            self._esquema = _esquema_en_excel(wb)
+        finally:
+            wb.close()
+
+        # Meses archivados; si una fila está en ambos sitios (archivado a medias) manda el libro activo
+        archivadas = set()
+        for fila, registro in self._leer_archivos().items():
+            if fila not in registros:
+                registros[fila] = registro
+                archivadas.add(fila)
+        if archivadas:
+            registros = dict(sorted(registros.items()))
+            # Las filas nuevas no deben reutilizar números de filas archivadas
+            ultima_registro = max(ultima_registro, max(archivadas))
+        self._instalar(registros, crias, {'registro': ultima_registro, 'cria': ultima_cria}, seq_excel, firma,
+                       archivadas)
+
+    def _instalar(self, registros, crias, ultima_fila, seq, firma, archivadas=(), estados=None):
+        """Sustituye la copia en memoria por el contenido leído y aplica el diario pendiente."""
+        self._reemplazar(registros, crias, ultima_fila, seq, firma[0] / 1e9, archivadas, estados)
+        # Operaciones del diario aún no volcadas en el Excel (o posteriores a la instantánea)
+        self._diario_ino, self._diario_pos = None, 0
+        self._seguir_diario()
+        self._firma = firma
+
+    def cargar(self):
+        """Prepara el libro y lo lee; se llama una vez al arrancar la aplicación.
+
+        Si el Excel no existe se crea con los encabezados; si su esquema es anterior a
+        ``VERSION_ESQUEMA`` se migra y se guarda una vez. Si la instantánea corresponde
+        al Excel actual se usa en lugar de leerlo; si no, se lee y se guarda una nueva.
+        """
+        with self._lock:
+            if not os.path.exists(self.ruta):
+                self._crear_libro()
+            firma = self._firma_actual()
+            if self._leer_instantanea(firma):
+                return
+            with tramo('excel_carga'):
+                self._leer_excel(firma)
+            if self._esquema < VERSION_ESQUEMA:
+                self._migrar_esquema()
+                with tramo('excel_carga'):
+                    self._leer_excel(self._firma_actual())
+        self._guardar_instantanea()
+
+    def _crear_libro(self):
+        wb = Workbook()
+        wb.active.title = 'Registros'
+        for version in range(1, VERSION_ESQUEMA + 1):
+            MIGRACIONES[version](wb)
+        _hoja_meta(wb)['A2'] = 'version_esquema'
+        wb[HOJA_META]['B2'] = VERSION_ESQUEMA
+        self._guardar_libro(wb)
+
+    def _guardar_libro(self, wb):
+        tmp = self.ruta + '.tmp'
+        with tramo('excel_guardado'):
+            wb.save(tmp)
+            _fsync(tmp)
+        os.replace(tmp, self.ruta)
+
+    def _migrar_esquema(self):
+        """Lleva el libro a ``VERSION_ESQUEMA`` aplicando las migraciones pendientes, con una sola escritura."""
+        with self._bloqueo_compactacion:
+            with tramo('excel_carga_compactacion'):
+                wb = load_workbook(self.ruta)
+            try:
+                actual = _esquema_en_excel(wb)
+                if actual >= VERSION_ESQUEMA:
+                    return  # otro proceso ya lo migró
+                for version in range(actual + 1, VERSION_ESQUEMA + 1):
+                    MIGRACIONES[version](wb)
+                meta = _hoja_meta(wb)
+                meta['A2'] = 'version_esquema'
+                meta['B2'] = VERSION_ESQUEMA
+                self._guardar_libro(wb)
+            finally:
+                wb.close()
+        print(f"Esquema de {self.ruta} migrado de la versión {actual} a la {VERSION_ESQUEMA}")
+
+    def _vigente(self):
+        with self._lock:
+            firma = self._firma_actual()
+            if firma != self._firma:
+                self._recargar(firma)
+            else:
+                self._seguir_diario()
+
+    def invalidar(self):
+        """Descarta la copia en memoria; la próxima lectura vuelve a leer el Excel."""
+        with self._lock:
+            self._firma = None
+
+    def estado_datos(self):
+        """``(etiqueta, modificado)`` de los datos: la etiqueta es igual en todos los procesos
+        que ven los mismos datos (sirve de ETag) y ``modificado`` es el epoch del último cambio."""
+        with self._lock:
+            self._vigente()
+            return f'{self._seq}-{self._firma[0]:x}-{self._firma[1]:x}', self._modificado
+
+    def restaurar(self, registros, crias):
+        """Reescribe el libro con ``registros`` y ``crias`` (filas, IDs y versiones incluidos).
+
+        El diario y la instantánea, que eran del contenido anterior, se descartan.
+        """
+        with self._bloqueo_compactacion, self._bloqueo_diario, self._lock:
+            tmp = self.ruta + '.tmp'
+            with tramo('excel_guardado'):
+                escribir_libro(tmp, registros, crias)
+                _fsync(tmp)
+            os.replace(tmp, self.ruta)
+            for ruta in (self.ruta_diario, self.ruta_instantanea):
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+            self._firma = None
+        self.cargar()
+
+    # ---- Instantánea ----
+
+    def _guardar_instantanea(self):
+        """Guarda la copia en memoria (con la firma del Excel y la última operación aplicada).
+
+        Sirve mientras el Excel no cambie: al cargarla se aplican las operaciones del
+        diario posteriores a ``seq``. Si no se puede guardar, solo se pierde el atajo.
+        """
+        tmp = f'{self.ruta_instantanea}.{os.getpid()}.tmp'
+        try:
+            with tramo('instantanea_guardado'):
+                # Los índices se modifican en su sitio: se serializan sin soltar el lock. Los
+                # registros se sustituyen, nunca se modifican: basta con copiar los diccionarios de filas
+                with self._lock:
+                    if self._firma is None:
+                        return
+                    por_fila, crias_por_fila = dict(self._por_fila), dict(self._crias_por_fila)
+                    cabecera = {
+                        'formato': FORMATO_INSTANTANEA,
+                        'esquema': self._esquema,
+                        'firma': list(self._firma),
+                        'seq': self._seq,
+                        'ultima_fila': dict(self._ultima_fila),
+                        'archivadas': sorted(self._archivadas),
+                    }
+                    estados = marshal.dumps({
+                        'indice': self._indice.estado(),
+                        'estadisticas': self._estadisticas.estado(),
+                        'resumen': self._resumen.estado(),
+                        'catalogo': self._catalogo.estado(),
+                    })
+                registros, cabecera['registros_con_fecha'] = _a_instantanea(por_fila, _valores_registro,
+                                                                            POSICIONES_FECHA_REGISTRO)
+                crias, cabecera['crias_con_fecha'] = _a_instantanea(crias_por_fila, _valores_cria,
+                                                                    POSICIONES_FECHA_CRIA)
+                datos = marshal.dumps((registros, crias))
+                cabecera['bytes_datos'] = len(datos)
+                with open(tmp, 'wb') as f:
+                    # Cabecera aparte: se comprueba sin leer el resto
+                    marshal.dump(cabecera, f)
+                    f.write(datos)
+                    f.write(estados)
+                os.replace(tmp, self.ruta_instantanea)
+        except (OSError, ValueError) as e:
+            print(f"No se pudo guardar la instantánea de {self.ruta}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _leer_instantanea(self, firma):
+        """Carga la instantánea si corresponde al Excel con ``firma``; devuelve si se usó."""
+        try:
+            with tramo('instantanea_carga'), open(self.ruta_instantanea, 'rb') as f:
+                cabecera = marshal.load(f)
+                if (not isinstance(cabecera, dict) or cabecera.get('formato') != FORMATO_INSTANTANEA
+                        or cabecera.get('esquema') != VERSION_ESQUEMA
+                        or tuple(cabecera.get('firma') or ()) != firma):
+                    return False
+                # marshal.loads sobre los bytes es mucho más rápido que marshal.load sobre el archivo,
+                # y sin el recolector de ciclos, que saltaría una y otra vez con millones de objetos nuevos
+                resto = memoryview(f.read())
+                recolector = gc.isenabled()
+                gc.disable()
+                try:
+                    registros, crias = marshal.loads(resto[:cabecera['bytes_datos']])
+                    estados = marshal.loads(resto[cabecera['bytes_datos']:])
+                    registros = _de_instantanea(registros, cabecera['registros_con_fecha'], fila_a_registro)
+                    crias = _de_instantanea(crias, cabecera['crias_con_fecha'], fila_a_cria)
+                finally:
+                    if recolector:
+                        gc.enable()
+                self._esquema = cabecera['esquema']
+                self._instalar(registros, crias, cabecera['ultima_fila'], cabecera['seq'], firma,
+                               cabecera['archivadas'], estados)
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            return False
+        return True
+
+    # ---- Escritura ----
+
+    def _escribir_lote(self, lote):
+        """Anota un lote completo en el diario con una sola escritura y un solo fsync."""
+        with self._bloqueo_diario, self._lock:
+            # Ponerse al día con lo que hayan anotado otros procesos antes de numerar
+            self._vigente()
+            entradas = self._numerar(lote)
+            datos = ''.join(json.dumps(e, ensure_ascii=False, default=str) + '\n' for e in entradas).encode('utf-8')
+            try:
+                with tramo('diario_escritura'), open(self.ruta_diario, 'ab') as f:
+                    # Una línea a medias solo puede venir de un escritor que se cayó: se descarta
+                    if os.fstat(f.fileno()).st_size > self._diario_pos:
+                        f.truncate(self._diario_pos)
+                    f.write(datos)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    tamano = f.tell()
+                    self._diario_ino = os.fstat(f.fileno()).st_ino
+            except Exception:
+                # Nada quedó confirmado: volver a numerar desde el disco en el próximo lote
+                self._firma = None
+                raise
+            for entrada in entradas:
+                self._aplicar_en_memoria(entrada)
+            self._diario_pos = tamano
+        if tamano >= self.umbral_compactacion:
+            self._despertar.set()
+
+    # ---- Compactación ----
+
+    def compactar(self):
+        """Vuelca el diario en el Excel y lo vacía. Devuelve cuántas operaciones se volcaron.
+
+        El libro se guarda en un archivo temporal y se sustituye con ``os.replace``;
+        la hoja ``_meta`` guarda la última operación incluida, de modo que si el proceso
+        cae antes de vaciar el diario, esas operaciones se ignoran al releerlo.
+        Solo compacta un proceso a la vez; los demás siguen anotando en el diario.
+        """
+        with self._lock_compactacion:
+            if not self._bloqueo_compactacion.adquirir(esperar=False):
+                return 0
+            try:
+                return self._compactar()
+            finally:
+                self._bloqueo_compactacion.liberar()
+
+    def _compactar(self):
+        firma_base = self._firma_actual()
+        entradas, _ = self._leer_diario()
+        archivar = self._por_archivar()
+        if not entradas and not archivar:
+            return 0
+        hasta = entradas[-1]['seq'] if entradas else None
+
+        with tramo('excel_carga_compactacion'):
+            wb = load_workbook(self.ruta)
+        tmp = self.ruta + '.tmp'
+        try:
+            aplicadas = _seq_en_excel(wb)
+            ws_registros = wb.active
+            ws_crias = wb['Crias'] if 'Crias' in wb.sheetnames else wb.create_sheet('Crias')
+            _completar_ids(ws_registros)
+            for entrada in entradas:
+                if entrada['seq'] <= aplicadas:
+                    continue
+                ws = ws_crias if entrada['op'] == 'cria' else ws_registros
+                for col, valor in enumerate(entrada['valores'], start=1):
+                    ws.cell(row=entrada['fila'], column=col, value=valor)
+
+            # Meses cerrados: primero a su libro de archivo y después fuera del libro activo. Las
+            # filas quedan vacías (no ocupan celdas) para que los números de fila no cambien
+            if archivar:
+                with tramo('archivo_guardado'):
+                    for mes, registros in sorted(archivar.items()):
+                        self._escribir_archivo(mes, registros)
+                for registros in archivar.values():
+                    for fila in registros:
+                        for col in range(1, len(CAMPOS_REGISTRO) + 1):
+                            ws_registros.cell(row=fila, column=col).value = None
+
+            if hasta is not None:
+                meta = _hoja_meta(wb)
+                meta['A1'] = 'seq_diario'
+                meta['B1'] = hasta
+            with tramo('excel_guardado'):
+                wb.save(tmp)
+                _fsync(tmp)
+        finally:
+            wb.close()
+
+        with self._bloqueo_diario, self._lock:
+            # (los libros de archivo recién escritos cambian la carpeta: solo cuenta el Excel)
+            if self._firma_actual()[:2] != firma_base[:2]:
+                # El Excel cambió mientras se guardaba la copia: descartarla y reintentar luego.
+                # Lo ya archivado sigue también en el libro activo, que manda al leer
+                os.remove(tmp)
+                return 0
+            vigente = self._firma == firma_base
+            os.replace(tmp, self.ruta)
+            # Conservar solo lo que llegó al diario mientras se guardaba el libro
+            if hasta is not None:
+                self._reescribir_diario([e for e in self._leer_diario()[0] if e['seq'] > hasta])
+            for registros in archivar.values():
+                self._archivadas.update(registros)
+            if vigente:
+                self._firma = self._firma_actual()
+                self._seguir_diario()
+            else:
+                self._firma = None
+        if archivar:
+            print(f"Archivados {sum(map(len, archivar.values()))} registros de {', '.join(sorted(archivar))}")
+        # La copia en memoria corresponde al libro recién guardado: el próximo arranque no lo relee
+        self._guardar_instantanea()
+        return len(entradas)
+
+    def _hilos_de_fondo(self):
+        return super()._hilos_de_fondo() + [('compactador-excel', self._bucle_compactacion)]
+
+    def _bucle_compactacion(self):
+        while True:
+            self._despertar.wait(self.intervalo_compactacion)
+            self._despertar.clear()
+            try:
+                self.compactar()
+            except Exception as e:
+                print(f"Error al compactar el diario en {self.ruta}: {e}")
@@ -0,0 +1,288 @@
+"""Almacén de registros y crías en una base SQLite embebida (``sqlite3`` de la biblioteca estándar).
+
+Cada registro y cada cría es una fila de su tabla con su número de fila (el mismo
+que tendría en el Excel), sus valores sin tipo fijo (se guardan tal como llegan,
+como en una celda) y unas columnas de clave normalizadas (sin espacios ni
+mayúsculas, fecha como texto ordenable) con índices por ID de vaca, fecha y
+ordeñador, para consultar la base directamente (informes, otras herramientas)
+sin pasar por la aplicación. La base va en modo WAL: las lecturas no esperan a las
+escrituras y cada lote del hilo escritor es una transacción ``BEGIN IMMEDIATE``,
+que es a la vez el bloqueo entre procesos (varios workers de gunicorn) y el fsync
+del lote. No hay diario ni compactación.
+
+Cada fila lleva la operación (``seq``) que la escribió por última vez; un proceso
+ve que otro escribió con ``PRAGMA data_version`` y aplica en memoria solo las filas
+con ``seq`` posterior a la última que conoce.
+"""
+import sqlite3
+import time
+import uuid
+from datetime import datetime
+
+from almacen import (CAMPOS_CRIA, CAMPOS_REGISTRO, Almacen, _como_en_excel, clave_fecha,
+                     clave_texto, fila_a_cria, fila_a_registro)
+from metricas import tramo
+
+# Versión del esquema de la base (PRAGMA user_version)
+# 2: ID estable en las crías (columna 'id_registro' de CAMPOS_CRIA)
+VERSION_ESQUEMA_SQLITE = 2
+
+# versión -> sentencias que llevan la base de la versión anterior a esa (las tablas nuevas
+# las crea _ESQUEMA, que va después; las columnas se añaden a las tablas que ya existían)
+MIGRACIONES_SQLITE = {2: ['ALTER TABLE crias ADD COLUMN id_registro']}
+
+_ESQUEMA = f'''
+CREATE TABLE IF NOT EXISTS registros (
+    fila INTEGER PRIMARY KEY,
+    {', '.join(CAMPOS_REGISTRO)},
+    clave_fecha TEXT NOT NULL,
+    clave_vaca TEXT NOT NULL,
+    clave_ordenador TEXT NOT NULL,
+    clave_estado TEXT NOT NULL,
+    modificado REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS registros_id ON registros (id_registro);
+CREATE INDEX IF NOT EXISTS registros_fecha ON registros (clave_fecha, fila);
+CREATE INDEX IF NOT EXISTS registros_vaca ON registros (clave_vaca, clave_fecha, fila);
+CREATE INDEX IF NOT EXISTS registros_ordenador ON registros (clave_ordenador, clave_fecha, fila);
+CREATE INDEX IF NOT EXISTS registros_seq ON registros (seq);
+
+CREATE TABLE IF NOT EXISTS crias (
+    fila INTEGER PRIMARY KEY,
+    {', '.join(CAMPOS_CRIA)},
+    clave_madre TEXT NOT NULL,
+    clave_fecha TEXT NOT NULL,
+    modificado REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS crias_id ON crias (id_registro);
+CREATE INDEX IF NOT EXISTS crias_madre ON crias (clave_madre, fila);
+CREATE INDEX IF NOT EXISTS crias_seq ON crias (seq);
+
+CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor);
+'''
+
+_INSERTAR_REGISTRO = (
+    f"INSERT OR REPLACE INTO registros (fila, {', '.join(CAMPOS_REGISTRO)}, clave_fecha, clave_vaca, "
+    f"clave_ordenador, clave_estado, modificado) VALUES ({', '.join('?' * (len(CAMPOS_REGISTRO) + 6))})")
+_INSERTAR_CRIA = (
+    f"INSERT OR REPLACE INTO crias (fila, {', '.join(CAMPOS_CRIA)}, clave_madre, clave_fecha, modificado) "
+    f"VALUES ({', '.join('?' * (len(CAMPOS_CRIA) + 4))})")
+_COLUMNAS_LECTURA_REGISTRO = f"fila, {', '.join(CAMPOS_REGISTRO)}"
+_COLUMNAS_LECTURA_CRIA = f"fila, {', '.join(CAMPOS_CRIA)}"
+
+
+def _valor_sql(valor):
+    """Valor tal como se guarda: las fechas de openpyxl (datetime) pasan a texto ordenable."""
+    return clave_fecha(valor) if isinstance(valor, datetime) else valor
+
+
+def _fila_registro(fila, valores, modificado):
+    registro = fila_a_registro(fila, valores)
+    return (fila, *valores, clave_fecha(registro['fecha_hora']), clave_texto(registro['id_vaca']),
+            clave_texto(registro['nombre_ordenador']), clave_texto(registro['estado_productivo']), modificado)
+
+
+def _fila_cria(fila, valores, modificado):
+    cria = fila_a_cria(fila, valores)
+    return (fila, *valores, clave_texto(cria['madre_id']), clave_fecha(cria['fecha_registro']), modificado)
+
+
+def _registro_leido(row):
+    return fila_a_registro(row[0], [_como_en_excel(v) for v in row[1:]])
+
+
+def _cria_leida(row):
+    return fila_a_cria(row[0], [_como_en_excel(v) for v in row[1:]])
+
+
+class AlmacenSQLite(Almacen):
+    """Almacén sobre una base SQLite en modo WAL, con la misma copia en memoria que el Excel.
+
+    Las lecturas se responden desde memoria como en ``AlmacenExcel`` (recorrer la base
+    por sus índices para exportar resultó el doble de lento que el índice en memoria);
+    la base solo se lee al arrancar y para aplicar los cambios de otros procesos.
+    """
+
+    tipo = 'sqlite'
+
+    def __init__(self, ruta, max_lote=200):
+        super().__init__(max_lote)
+        self.ruta = ruta
+        self._conexion = None  # lecturas, bajo self._lock
+        self._conexion_escritura = None  # solo el hilo escritor (y restaurar)
+        self._data_version = None
+        self._id_base = ''
+
+    def _conectar(self):
+        conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None, check_same_thread=False)
+        conexion.execute('PRAGMA journal_mode=WAL')
+        # Cada transacción confirmada llega a disco, como el fsync por lote del diario
+        conexion.execute('PRAGMA synchronous=FULL')
+        return conexion
+
+    def _escritura(self):
+        if self._conexion_escritura is None:
+            self._conexion_escritura = self._conectar()
+        return self._conexion_escritura
+
+    # ---- Lectura ----
+
+    def cargar(self):
+        """Crea la base y sus índices si no existen y la lee entera; se llama una vez al arrancar."""
+        conexion = self._escritura()
+        conexion.execute('BEGIN IMMEDIATE')
+        try:
+            version = conexion.execute('PRAGMA user_version').fetchone()[0]
+            if version > VERSION_ESQUEMA_SQLITE:
+                raise RuntimeError(f'{self.ruta} es de una versión más nueva de la aplicación ({version})')
+            # Una base nueva (versión 0) ya sale de _ESQUEMA con todas las columnas
+            for pendiente in range(version + 1, VERSION_ESQUEMA_SQLITE + 1) if version else ():
+                for sentencia in MIGRACIONES_SQLITE[pendiente]:
+                    conexion.execute(sentencia)
+            for sentencia in _ESQUEMA.split(';'):
+                if sentencia.strip():
+                    conexion.execute(sentencia)
+            conexion.execute("INSERT OR IGNORE INTO meta VALUES ('seq', 0)")
+            conexion.execute("INSERT OR IGNORE INTO meta VALUES ('id', ?)", (uuid.uuid4().hex[:8],))
+            conexion.execute(f'PRAGMA user_version = {VERSION_ESQUEMA_SQLITE}')
+            conexion.execute('COMMIT')
+        except Exception:
+            conexion.execute('ROLLBACK')
+            raise
+        if 0 < version < VERSION_ESQUEMA_SQLITE:
+            print(f"Esquema de {self.ruta} migrado de la versión {version} a la {VERSION_ESQUEMA_SQLITE}")
+        with self._lock:
+            self._leer_base()
+
+    def _leer_base(self):
+        if self._conexion is None:
+            self._conexion = self._conectar()
+        conexion = self._conexion
+        with tramo('sqlite_carga'):
+            # Una sola transacción de lectura: todo corresponde a la misma operación
+            conexion.execute('BEGIN')
+            try:
+                seq = conexion.execute("SELECT valor FROM meta WHERE clave = 'seq'").fetchone()[0]
+                self._id_base = conexion.execute("SELECT valor FROM meta WHERE clave = 'id'").fetchone()[0]
+                registros = {row[0]: _registro_leido(row) for row in conexion.execute(
+                    f'SELECT {_COLUMNAS_LECTURA_REGISTRO} FROM registros ORDER BY fila')}
+                crias = {row[0]: _cria_leida(row) for row in conexion.execute(
+                    f'SELECT {_COLUMNAS_LECTURA_CRIA} FROM crias ORDER BY fila')}
+                modificado = max(conexion.execute('SELECT max(modificado) FROM registros').fetchone()[0] or 0,
+                                 conexion.execute('SELECT max(modificado) FROM crias').fetchone()[0] or 0)
+                self._data_version = conexion.execute('PRAGMA data_version').fetchone()[0]
+            finally:
+                conexion.execute('COMMIT')
+        ultima_fila = {'registro': max(registros, default=1), 'cria': max(crias, default=1)}
+        self._reemplazar(registros, crias, ultima_fila, seq, modificado)
+
+    def _seguir_cambios(self):
+        """Aplica en memoria las filas que otros procesos escribieron después de ``self._seq``."""
+        conexion = self._conexion
+        conexion.execute('BEGIN')
+        try:
+            seq = conexion.execute("SELECT valor FROM meta WHERE clave = 'seq'").fetchone()[0]
+            if seq <= self._seq:
+                return
+            cambios = [('actualizar', row) for row in conexion.execute(
+                f'SELECT {_COLUMNAS_LECTURA_REGISTRO}, modificado FROM registros WHERE seq > ?', (self._seq,))]
+            cambios += [('cria', row) for row in conexion.execute(
+                f'SELECT {_COLUMNAS_LECTURA_CRIA}, modificado FROM crias WHERE seq > ?', (self._seq,))]
+        finally:
+            conexion.execute('COMMIT')
+        # La última columna de datos es 'seq' y detrás va 'modificado'
+        cambios.sort(key=lambda cambio: cambio[1][-2])
+        for op, row in cambios:
+            self._aplicar_en_memoria({'seq': row[-2], 'op': op, 'fila': row[0], 'valores': list(row[1:-1]),
+                                      'ts': row[-1]})
+        self._seq = seq
+
+    def _vigente(self):
+        with self._lock:
+            if self._conexion is None or self._data_version is None:
+                self._leer_base()
+                return
+            # data_version cambia cuando otra conexión (otro proceso o el hilo escritor) confirma algo
+            version = self._conexion.execute('PRAGMA data_version').fetchone()[0]
+            if version != self._data_version:
+                self._data_version = version
+                self._seguir_cambios()
+
+    def invalidar(self):
+        """Descarta la copia en memoria; la próxima lectura vuelve a leer la base."""
+        with self._lock:
+            self._data_version = None
+
+    def estado_datos(self):
+        with self._lock:
+            self._vigente()
+            return f'{self._seq}-{self._id_base}', self._modificado
+
+    # ---- Escritura ----
+
+    def _escribir_lote(self, lote):
+        """Escribe el lote en una transacción; ``BEGIN IMMEDIATE`` espera a los escritores de otros procesos."""
+        conexion = self._escritura()
+        with tramo('sqlite_espera'):
+            conexion.execute('BEGIN IMMEDIATE')
+        try:
+            with self._lock:
+                # Ponerse al día con lo que hayan escrito otros procesos antes de numerar
+                self._vigente()
+                for pendiente in lote:
+                    pendiente.valores = [_valor_sql(valor) for valor in pendiente.valores]
+                entradas = self._numerar(lote)
+                with tramo('sqlite_escritura'):
+                    conexion.executemany(_INSERTAR_REGISTRO, [
+                        _fila_registro(e['fila'], e['valores'], e['ts']) for e in entradas if e['op'] != 'cria'])
+                    conexion.executemany(_INSERTAR_CRIA, [
+                        _fila_cria(e['fila'], e['valores'], e['ts']) for e in entradas if e['op'] == 'cria'])
+                    conexion.execute("UPDATE meta SET valor = ? WHERE clave = 'seq'", (self._seq,))
+                    conexion.execute('COMMIT')
+                for entrada in entradas:
+                    self._aplicar_en_memoria(entrada)
+        except Exception:
+            if conexion.in_transaction:
+                conexion.execute('ROLLBACK')
+            # Nada quedó confirmado: volver a leer la base antes del próximo lote
+            self.invalidar()
+            raise
+
+    def compactar(self):
+        """Pasa el WAL a la base (``wal_checkpoint``); los datos ya estaban confirmados. Devuelve 0."""
+        with self._lock:
+            if self._conexion is not None:
+                self._conexion.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                self._conexion.execute('PRAGMA optimize')
+        return 0
+
+    def restaurar(self, registros, crias):
+        """Sustituye el contenido de la base por ``registros`` y ``crias`` en una sola transacción.
+
+        Cada fila conserva su número de operación y la base sigue desde el mayor, así que
+        los cursores de sincronización de los dispositivos siguen valiendo.
+        """
+        if self._conexion_escritura is None:
+            self.cargar()
+        conexion = self._escritura()
+        registros, crias = list(registros), list(crias)
+        seq = max((datos['seq'] for datos in registros + crias), default=0)
+        ahora = time.time()
+        conexion.execute('BEGIN IMMEDIATE')
+        try:
+            conexion.execute('DELETE FROM registros')
+            conexion.execute('DELETE FROM crias')
+            conexion.executemany(_INSERTAR_REGISTRO, (
+                _fila_registro(r['fila'], [_valor_sql(r[campo]) for campo in CAMPOS_REGISTRO], ahora)
+                for r in registros))
+            conexion.executemany(_INSERTAR_CRIA, (
+                _fila_cria(c['fila'], [_valor_sql(c[campo]) for campo in CAMPOS_CRIA], ahora)
+                for c in crias))
+            conexion.execute("UPDATE meta SET valor = ? WHERE clave = 'seq'", (seq,))
+            conexion.execute("UPDATE meta SET valor = ? WHERE clave = 'id'", (uuid.uuid4().hex[:8],))
+            conexion.execute('COMMIT')
+        except Exception:
+            conexion.execute('ROLLBACK')
+            raise
+        conexion.execute('PRAGMA optimize')
+        self.invalidar()
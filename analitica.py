@@ -0,0 +1,717 @@
+"""Agregados del ganado calculados a partir de los registros en memoria.
+
+``EstadisticasIncrementales`` mantiene los totales del dashboard con cada alta o
+edición; ``SeriesProduccion`` guarda la producción en arrays de NumPy agrupados por
+vaca para las series diarias, medias móviles y alertas de caída; ``Genealogia`` es el
+grafo de linaje materno de la hoja 'Crias' con las métricas de fertilidad del rebaño;
+``ResumenDiario`` acumula la producción por día, vaca y ordeñador para los periodos del
+dashboard y la comparación entre temporadas.
+"""
+import bisect
+import functools
+import heapq
+import itertools
+import re
+import sys
+from collections import Counter
+
+import numpy as np
+
+# Cantidad de vacas en el ranking de mejores productoras
+TOP_PRODUCTORAS = 5
+
+# Ventanas (días) de las medias móviles y de la comparación que detecta caídas
+VENTANA_CORTA = 7
+VENTANA_LARGA = 30
+# Caída marcada: la media de los últimos VENTANA_CORTA días cae este tanto respecto a los VENTANA_LARGA anteriores
+UMBRAL_CAIDA = 0.3
+
+_PATRON_DIA = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def _numero(valor, tipo):
+    """Convierte una celda numérica como lo hacía /estadisticas (vacío -> 0); valores inválidos cuentan como 0."""
+    if not valor:
+        return tipo(0)
+    try:
+        return tipo(valor)
+    except (TypeError, ValueError):
+        return tipo(0)
+
+
+class EstadisticasIncrementales:
+    """Totales, conteos, mínimo/máximo, ranking y sumas por ordeñador del dashboard.
+
+    Cada alta suma y cada edición resta los valores anteriores antes de sumar los
+    nuevos, así que el resumen se obtiene sin recorrer los registros. Los litros se
+    guardan en una lista ordenada (búsqueda binaria) que sirve a la vez para el mínimo,
+    el máximo y el ranking, y que admite quitar valores al editar.
+    """
+
+    def __init__(self, registros=(), crias=()):
+        self.total = 0
+        self.suma_litros = 0.0
+        self.suma_edad = 0
+        self.suma_crias = 0
+        self.suma_partos = 0
+        self.por_estado = Counter()
+        self.paridas = 0
+        self.secas = 0
+        self.ordenadores = {}
+        self.crias_registradas = 0
+        self._litros = []  # [(litros, -fila)] ordenada: a igual producción, primero la fila más antigua
+        for registro in registros:
+            self._sumar(registro, 1)
+            self._litros.append(self._clave_litros(registro))
+        self._litros.sort()
+        for cria in crias:
+            self.agregar_cria(cria)
+
+    def estado(self):
+        """Acumulados en tipos básicos para la instantánea del almacén."""
+        estado = dict(vars(self))
+        estado['por_estado'] = dict(self.por_estado)
+        return estado
+
+    @classmethod
+    def desde_estado(cls, estado):
+        estadisticas = cls()
+        vars(estadisticas).update(estado)
+        estadisticas.por_estado = Counter(estado['por_estado'])
+        return estadisticas
+
+    @staticmethod
+    def _clave_litros(registro):
+        return (_numero(registro['litros'], float), -registro['fila'])
+
+    def _sumar(self, registro, signo):
+        litros = _numero(registro['litros'], float)
+        self.total += signo
+        self.suma_litros += signo * litros
+        self.suma_edad += signo * _numero(registro['edad'], int)
+        self.suma_crias += signo * _numero(registro['numero_crias'], int)
+        self.suma_partos += signo * _numero(registro['numero_parto'], int)
+        self.por_estado[registro['estado_productivo']] += signo
+        if registro['vaca_parida'] == 'Sí':
+            self.paridas += signo
+        if registro['vaca_seca'] == 'Sí':
+            self.secas += signo
+
+        nombre = registro['nombre_ordenador']
+        datos = self.ordenadores.setdefault(nombre, {'total': 0.0, 'count': 0})
+        datos['total'] += signo * litros
+        datos['count'] += signo
+        if datos['count'] <= 0:
+            del self.ordenadores[nombre]
+
+    def agregar(self, registro):
+        self._sumar(registro, 1)
+        bisect.insort(self._litros, self._clave_litros(registro))
+
+    def quitar(self, registro):
+        self._sumar(registro, -1)
+        clave = self._clave_litros(registro)
+        pos = bisect.bisect_left(self._litros, clave)
+        if pos < len(self._litros) and self._litros[pos] == clave:
+            del self._litros[pos]
+
+    def agregar_cria(self, cria):
+        self.crias_registradas += 1
+
+    def quitar_cria(self, cria):
+        self.crias_registradas -= 1
+
+    def resumen(self, por_fila):
+        """Diccionario ``stats`` que espera estadisticas.html (``None`` si no hay registros)."""
+        if self.total <= 0:
+            return None
+        total = self.total
+        top_productoras = [
+            dict(por_fila[-fila], litros=litros)
+            for litros, fila in reversed(self._litros[-TOP_PRODUCTORAS:])
+        ]
+        return {
+            'total_vacas': total,
+            'total_litros': round(self.suma_litros, 2),
+            'promedio_litros': round(self.suma_litros / total, 2),
+            'max_litros': round(self._litros[-1][0], 2),
+            'min_litros': round(self._litros[0][0], 2),
+            'productivas': self.por_estado['Productiva'],
+            'no_productivas': self.por_estado['No Productiva'],
+            'en_reposo': self.por_estado['En Reposo'],
+            'promedio_edad': round(self.suma_edad / total, 1),
+            'vacas_paridas': self.paridas,
+            'vacas_secas': self.secas,
+            'total_crias': self.suma_crias,
+            'promedio_crias': round(self.suma_crias / total, 1),
+            'promedio_partos': round(self.suma_partos / total, 1),
+            'crias_registradas': self.crias_registradas,
+            'top_productoras': top_productoras,
+            'ordenadores': {nombre: dict(datos) for nombre, datos in self.ordenadores.items()},
+        }
+
+
+def _dia(valor):
+    """'AAAA-MM-DD' de una fecha_hora (texto o datetime de Excel), o None si no es válida."""
+    if hasattr(valor, 'strftime'):
+        return valor.strftime('%Y-%m-%d')
+    texto = str(valor or '')[:10]
+    return texto if _PATRON_DIA.fullmatch(texto) else None
+
+
+def _medias_moviles(valores, ventana):
+    """Media de los días con dato (no NaN) dentro de cada ventana de ``ventana`` días naturales."""
+    hay = ~np.isnan(valores)
+    sumas = np.concatenate(([0.0], np.cumsum(np.where(hay, valores, 0.0))))
+    cuentas = np.concatenate(([0], np.cumsum(hay)))
+    fin = np.arange(1, len(valores) + 1)
+    inicio = np.maximum(fin - ventana, 0)
+    n = cuentas[fin] - cuentas[inicio]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, (sumas[fin] - sumas[inicio]) / n, np.nan)
+
+
+def _redondear(valor, decimales=2):
+    return None if valor is None or np.isnan(valor) else round(float(valor), decimales)
+
+
+class SeriesProduccion:
+    """Producción diaria por vaca en arrays columnares, ordenados por (vaca, día).
+
+    Se construye de una vez a partir de los registros (el almacén la reconstruye solo
+    cuando cambian) y todas las consultas del rebaño son operaciones vectorizadas sobre
+    los totales diarios, sin recorrer diccionarios. Las vacas se agrupan por su ID sin
+    distinguir espacios ni mayúsculas, como en los filtros de /registros.
+    """
+
+    def __init__(self, registros=()):
+        claves, dias, litros, partos, nombres, ids = [], [], [], [], [], []
+        for registro in registros:
+            dia = _dia(registro['fecha_hora'])
+            clave = str(registro['id_vaca'] or '').strip().lower()
+            if dia is None or not clave:
+                continue
+            claves.append(clave)
+            dias.append(dia)
+            litros.append(_numero(registro['litros'], float))
+            partos.append(_numero(registro['numero_parto'], int))
+            nombres.append(registro['nombre_vaca'] or '')
+            ids.append(str(registro['id_vaca']).strip())
+
+        self.claves, vaca = np.unique(np.array(claves, dtype=str), return_inverse=True)
+        dia = np.array(dias, dtype='datetime64[D]').astype(np.int64)
+        litros = np.array(litros, dtype=np.float64)
+        partos = np.array(partos, dtype=np.int64)
+        orden = np.lexsort((dia, vaca))
+        vaca, dia, litros, partos = vaca[orden], dia[orden], litros[orden], partos[orden]
+
+        # Totales diarios: un registro por (vaca, día) sumando los ordeños del día
+        nuevo = np.ones(len(dia), dtype=bool)
+        nuevo[1:] = (vaca[1:] != vaca[:-1]) | (dia[1:] != dia[:-1])
+        cortes = np.flatnonzero(nuevo)
+        self.vaca = vaca[cortes]
+        self.dia = dia[cortes]
+        self.litros = np.add.reduceat(litros, cortes) if len(cortes) else litros
+        self.parto = np.maximum.reduceat(partos, cortes) if len(cortes) else partos
+        self.ordenos = np.diff(np.append(cortes, len(dia)))
+
+        # Rango [inicio, fin) de días de cada vaca, y su ID y nombre más recientes
+        self.inicio = np.searchsorted(self.vaca, np.arange(len(self.claves)), side='left')
+        self.fin = np.searchsorted(self.vaca, np.arange(len(self.claves)), side='right')
+        ultimo = np.asarray(orden)[np.searchsorted(vaca, np.arange(len(self.claves)), side='right') - 1] \
+            if len(self.claves) else np.array([], dtype=np.int64)
+        self.ids = [ids[i] for i in ultimo]
+        self.nombres = [nombres[i] for i in ultimo]
+        self._codigo = {clave: n for n, clave in enumerate(self.claves.tolist())}
+
+    def __len__(self):
+        return len(self.claves)
+
+    def resumen_vacas(self, ventana_corta=VENTANA_CORTA, ventana_larga=VENTANA_LARGA, umbral=UMBRAL_CAIDA):
+        """Una fila por vaca: último día, medias de las ventanas y si su producción cayó.
+
+        Las ventanas se cuentan hacia atrás desde el último día con datos de cada vaca;
+        la larga es la que precede a la corta. Las medias son por día ordeñado.
+        """
+        if not len(self):
+            return []
+        ultimo_dia = self.dia[self.fin - 1]
+        atras = ultimo_dia[self.vaca] - self.dia
+        corta = atras < ventana_corta
+        larga = ~corta & (atras < ventana_corta + ventana_larga)
+        n = len(self)
+        suma_corta = np.bincount(self.vaca, weights=np.where(corta, self.litros, 0.0), minlength=n)
+        dias_corta = np.bincount(self.vaca, weights=corta, minlength=n)
+        suma_larga = np.bincount(self.vaca, weights=np.where(larga, self.litros, 0.0), minlength=n)
+        dias_larga = np.bincount(self.vaca, weights=larga, minlength=n)
+        total = np.bincount(self.vaca, weights=self.litros, minlength=n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            media_corta = suma_corta / dias_corta
+            media_larga = suma_larga / dias_larga
+            variacion = media_corta / media_larga - 1
+        caida = (dias_larga > 0) & (media_larga > 0) & (variacion <= -umbral)
+
+        fechas = ultimo_dia.astype('datetime64[D]').astype(str).tolist()
+        return [{
+            'id_vaca': self.ids[i],
+            'nombre_vaca': self.nombres[i],
+            'ultimo_dia': fechas[i],
+            'dias_ordenados': int(self.fin[i] - self.inicio[i]),
+            'total_litros': _redondear(total[i]),
+            'media_corta': _redondear(media_corta[i]),
+            'media_larga': _redondear(media_larga[i]),
+            'variacion': _redondear(variacion[i], 3),
+            'caida': bool(caida[i]),
+        } for i in range(n)]
+
+    def historial(self, id_vaca):
+        """Serie diaria de una vaca con medias móviles y curva de lactancia por parto, o None si no existe."""
+        n = self._codigo.get(str(id_vaca or '').strip().lower())
+        if n is None:
+            return None
+        dia = self.dia[self.inicio[n]:self.fin[n]]
+        litros = self.litros[self.inicio[n]:self.fin[n]]
+        parto = self.parto[self.inicio[n]:self.fin[n]]
+
+        # Medias móviles sobre días naturales: los días sin ordeño no cuentan como cero
+        continuo = np.full(int(dia[-1] - dia[0]) + 1, np.nan)
+        continuo[dia - dia[0]] = litros
+        media_corta = _medias_moviles(continuo, VENTANA_CORTA)[dia - dia[0]]
+        media_larga = _medias_moviles(continuo, VENTANA_LARGA)[dia - dia[0]]
+        fechas = dia.astype('datetime64[D]').astype(str)
+        diario = [{
+            'fecha': str(fechas[i]),
+            'litros': _redondear(litros[i]),
+            'media_corta': _redondear(media_corta[i]),
+            'media_larga': _redondear(media_larga[i]),
+            'numero_parto': int(parto[i]),
+        } for i in range(len(dia))]
+
+        # Curva de lactancia: litros diarios promedio por semana desde el primer registro de cada parto
+        lactancias = []
+        for numero in np.unique(parto):
+            del_parto = parto == numero
+            semana = (dia[del_parto] - dia[del_parto][0]) // 7
+            suma = np.bincount(semana, weights=litros[del_parto])
+            cuenta = np.bincount(semana)
+            semanas = np.flatnonzero(cuenta)
+            lactancias.append({
+                'numero_parto': int(numero),
+                'inicio': str(fechas[del_parto][0]),
+                'curva': [{'semana': int(s) + 1, 'litros': _redondear(suma[s] / cuenta[s])} for s in semanas],
+                'pico': _redondear((suma[semanas] / cuenta[semanas]).max()),
+            })
+
+        # Medias de las ventanas solo con los días de esta vaca, como en ``resumen_vacas``
+        atras = dia[-1] - dia
+        corta = atras < VENTANA_CORTA
+        larga = ~corta & (atras < VENTANA_CORTA + VENTANA_LARGA)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            media_corta = np.float64(litros[corta].sum()) / corta.sum()
+            media_larga = np.float64(litros[larga].sum()) / larga.sum()
+            variacion = media_corta / media_larga - 1
+        resumen = {
+            'id_vaca': self.ids[n],
+            'nombre_vaca': self.nombres[n],
+            'ultimo_dia': str(fechas[-1]),
+            'dias_ordenados': len(dia),
+            'total_litros': _redondear(litros.sum()),
+            'media_corta': _redondear(media_corta),
+            'media_larga': _redondear(media_larga),
+            'variacion': _redondear(variacion, 3),
+            'caida': bool(larga.any() and media_larga > 0 and variacion <= -UMBRAL_CAIDA),
+        }
+        return dict(resumen, diario=diario, lactancias=lactancias)
+
+
+def _clave_vaca(valor):
+    return str(valor or '').strip().lower()
+
+
+class Genealogia:
+    """Grafo de linaje materno del rebaño (madre -> crías) construido con la hoja 'Crias'.
+
+    Los nodos son las vacas con ordeños y las crías registradas, por ID sin distinguir
+    espacios ni mayúsculas: una cría que después se ordeña con su mismo ID es la misma
+    vaca, y así se enlazan las generaciones. Se construye de una vez (el almacén la
+    reconstruye solo cuando cambian las crías o los registros) y cada consulta se
+    resuelve una sola vez por versión: las siguientes devuelven el resultado guardado
+    (compartido: no modificarlo). Si un ID aparece como cría más de una vez, manda la
+    primera fila; los ciclos (datos erróneos) se cortan al repetirse una vaca.
+    """
+
+    def __init__(self, crias=(), vacas=()):
+        self._madre = {}  # clave -> clave de su madre
+        self._hijas = {}  # clave de la madre -> [clave de cada cría] por fecha de nacimiento
+        self._nodos = {}  # clave -> datos de la vaca o cría
+        self._partos = {}  # clave de la madre -> días de parto distintos, ordenados (mellizos: un parto)
+        self._memo = {}
+        for cria in crias:
+            clave, madre = _clave_vaca(cria['cria_id']), _clave_vaca(cria['madre_id'])
+            if not clave or not madre or clave == madre or clave in self._madre:
+                continue
+            self._madre[clave] = madre
+            self._hijas.setdefault(madre, []).append(clave)
+            self._nodos[clave] = {
+                'id': str(cria['cria_id']).strip(),
+                'nombre': cria['cria_nombre'] or '',
+                'sexo': cria['sexo'] or '',
+                'fecha_nacimiento': _dia(cria['fecha_nacimiento']),
+                'ordenos': 0,
+            }
+            self._nodos.setdefault(madre, {'id': str(cria['madre_id']).strip(), 'nombre': cria['madre_nombre'] or '',
+                                           'sexo': 'Hembra', 'fecha_nacimiento': None, 'ordenos': 0})
+        # Las vacas con ordeños aportan el ID y el nombre más recientes
+        for vaca in vacas:
+            nodo = self._nodos.setdefault(_clave_vaca(vaca['id']), {'sexo': 'Hembra', 'fecha_nacimiento': None})
+            nodo.update(id=vaca['id'], nombre=vaca['nombre'], ordenos=vaca['ordenos'])
+        for madre, hijas in self._hijas.items():
+            hijas.sort(key=lambda clave: (self._nodos[clave]['fecha_nacimiento'] or '', clave))
+            self._partos[madre] = sorted({self._nodos[clave]['fecha_nacimiento'] for clave in hijas} - {None})
+
+    def __contains__(self, id_vaca):
+        return _clave_vaca(id_vaca) in self._nodos
+
+    def _memorizado(self, clave, calcular):
+        if clave not in self._memo:
+            self._memo[clave] = calcular()
+        return self._memo[clave]
+
+    def _nodo(self, clave, **extra):
+        madre = self._madre.get(clave)
+        return dict(self._nodos[clave], madre_id=self._nodos[madre]['id'] if madre else None,
+                    crias=len(self._hijas.get(clave, ())), **extra)
+
+    def ancestros(self, id_vaca):
+        """Madre, abuela... de la vaca, de la más cercana a la más lejana (``generacion`` 1, 2...)."""
+        clave = _clave_vaca(id_vaca)
+
+        def calcular():
+            linaje, vistas, actual = [], {clave}, self._madre.get(clave)
+            while actual is not None and actual not in vistas:
+                vistas.add(actual)
+                linaje.append(self._nodo(actual, generacion=len(linaje) + 1))
+                actual = self._madre.get(actual)
+            return linaje
+        return self._memorizado(('ancestros', clave), calcular)
+
+    def generacion(self, id_vaca):
+        """Profundidad en el linaje: 0 si no se conoce su madre, 1 si solo se conoce la madre..."""
+        return len(self.ancestros(id_vaca))
+
+    def descendientes(self, id_vaca):
+        """Crías, nietas... de la vaca por generaciones (``generacion`` 1, 2...) y fecha de nacimiento."""
+        clave = _clave_vaca(id_vaca)
+
+        def calcular():
+            linaje, vistas, nivel = [], {clave}, [clave]
+            generacion = 0
+            while nivel:
+                generacion += 1
+                siguiente = []
+                for madre in nivel:
+                    for hija in self._hijas.get(madre, ()):
+                        if hija not in vistas:
+                            vistas.add(hija)
+                            siguiente.append(hija)
+                            linaje.append(self._nodo(hija, generacion=generacion))
+                nivel = siguiente
+            return linaje
+        return self._memorizado(('descendientes', clave), calcular)
+
+    def hermanos(self, id_vaca):
+        """Las otras crías de su madre, con ``mismo_parto`` para las nacidas el mismo día (mellizos)."""
+        clave = _clave_vaca(id_vaca)
+
+        def calcular():
+            madre = self._madre.get(clave)
+            if madre is None:
+                return []
+            nacimiento = self._nodos[clave]['fecha_nacimiento']
+            return [self._nodo(hija, mismo_parto=nacimiento is not None
+                               and self._nodos[hija]['fecha_nacimiento'] == nacimiento)
+                    for hija in self._hijas[madre] if hija != clave]
+        return self._memorizado(('hermanos', clave), calcular)
+
+    def arbol(self, id_vaca, generaciones=3):
+        """Árbol familiar de la vaca: ancestros y descendientes hasta ``generaciones``, hermanos y
+        profundidad; None si el ID no está en el grafo."""
+        clave = _clave_vaca(id_vaca)
+        if clave not in self._nodos:
+            return None
+
+        def calcular():
+            return {
+                'vaca': self._nodo(clave, generacion=self.generacion(clave)),
+                'ancestros': self.ancestros(clave)[:generaciones],
+                'descendientes': [d for d in self.descendientes(clave) if d['generacion'] <= generaciones],
+                'hermanos': self.hermanos(clave),
+                'partos': self._partos.get(clave, []),
+            }
+        return self._memorizado(('arbol', clave, generaciones), calcular)
+
+    def fertilidad(self):
+        """Métricas del rebaño: crías por madre e intervalos entre partos (días), y el detalle por madre."""
+        def calcular():
+            madres = []
+            todos = []
+            for madre, hijas in self._hijas.items():
+                partos = self._partos[madre]
+                intervalos = np.diff(np.array(partos, dtype='datetime64[D]')).astype(np.int64)
+                todos.append(intervalos)
+                madres.append({
+                    'id': self._nodos[madre]['id'],
+                    'nombre': self._nodos[madre]['nombre'],
+                    'crias': len(hijas),
+                    'partos': len(partos),
+                    'primer_parto': partos[0] if partos else None,
+                    'ultimo_parto': partos[-1] if partos else None,
+                    'intervalo_medio': _redondear(intervalos.mean(), 1) if len(intervalos) else None,
+                    'ultimo_intervalo': int(intervalos[-1]) if len(intervalos) else None,
+                })
+            madres.sort(key=lambda m: (-m['crias'], _clave_vaca(m['id'])))
+            intervalos = np.concatenate(todos) if todos else np.array([], dtype=np.int64)
+            crias_por_madre = np.array([m['crias'] for m in madres], dtype=np.int64)
+            sexos = Counter(self._nodos[clave]['sexo'] for clave in self._madre)
+            return {
+                'madres': len(madres),
+                'crias': int(crias_por_madre.sum()),
+                'hembras': sexos.get('Hembra', 0),
+                'machos': sexos.get('Macho', 0),
+                'crias_por_madre': _redondear(crias_por_madre.mean()) if len(madres) else None,
+                'max_crias_por_madre': int(crias_por_madre.max()) if len(madres) else 0,
+                'distribucion_crias': {int(n): int(c) for n, c in zip(*np.unique(crias_por_madre, return_counts=True))},
+                'intervalos': len(intervalos),
+                'intervalo_medio': _redondear(intervalos.mean(), 1) if len(intervalos) else None,
+                'intervalo_mediano': _redondear(np.median(intervalos), 1) if len(intervalos) else None,
+                'detalle_madres': madres,
+            }
+        return self._memorizado(('fertilidad',), calcular)
+
+
+@functools.lru_cache(maxsize=4096)
+def _anotaciones(valor):
+    """Vacunas o enfermedades de una celda ('Aftosa, Rabia') como conteos ``('Aftosa', 1, 'Rabia', 1)``.
+
+    'Ninguna' no cuenta. Los nombres se internan y cada texto distinto se convierte una
+    vez: las filas del resumen con las mismas anotaciones comparten la misma tupla.
+    """
+    nombres = sorted({sys.intern(nombre.strip()) for nombre in str(valor or '').split(',')} - {'', 'Ninguna'})
+    return tuple(itertools.chain.from_iterable((nombre, 1) for nombre in nombres))
+
+
+def _pares(conteos):
+    return zip(conteos[::2], conteos[1::2])
+
+
+def _combinar(conteos, otros, signo=1):
+    """Suma (o resta) dos conteos ``(nombre, n, ...)``; los nombres que quedan en cero desaparecen."""
+    if not otros:
+        return conteos
+    if not conteos and signo > 0:
+        return otros
+    suma = dict(_pares(conteos))
+    for nombre, n in _pares(otros):
+        suma[nombre] = suma.get(nombre, 0) + signo * n
+    return tuple(itertools.chain.from_iterable(sorted((nombre, n) for nombre, n in suma.items() if n > 0)))
+
+
+def _ordenados(conteos):
+    """Conteos ``(nombre, n, ...)`` o ``{nombre: n}`` de más a menos casos."""
+    pares = conteos.items() if isinstance(conteos, dict) else _pares(conteos)
+    return [{'nombre': nombre, 'casos': n} for nombre, n in sorted(pares, key=lambda c: (-c[1], c[0]))]
+
+
+def _desplazar_anios(dia, anios):
+    """Mismo día 'AAAA-MM-DD' ``anios`` años antes; el 29 de febrero pasa al 28."""
+    anio, resto = int(dia[:4]) - anios, dia[4:]
+    if resto == '-02-29' and not (anio % 4 == 0 and (anio % 100 != 0 or anio % 400 == 0)):
+        resto = '-02-28'
+    return f'{anio:04d}{resto}'
+
+
+class ResumenDiario:
+    """Resumen materializado por día: una fila por día × vaca y otra por día × ordeñador.
+
+    Cada fila lleva los litros, los ordeños y cuántas veces se anotó cada enfermedad y
+    cada vacuna; el total del rebaño de cada día se guarda aparte. Como
+    ``EstadisticasIncrementales``, cada alta suma y cada edición resta la fila anterior
+    antes de sumar la nueva. Un periodo (semana, mes o fechas libres) se responde con
+    una búsqueda binaria en la lista ordenada de días y recorre solo las filas de esos
+    días; la comparación entre temporadas usa solo los totales diarios.
+    """
+
+    def __init__(self, registros=()):
+        # Cada fila es [litros, ordeños, enfermedades, vacunas], con las anotaciones como
+        # conteos ``(nombre, n, ...)``: tuplas compartidas entre filas mientras no se combinan
+        self._dias = []  # días con registros ('AAAA-MM-DD'), ordenados
+        self._totales = {}  # día -> fila del rebaño
+        self._vacas = {}  # día -> {clave de la vaca: fila}
+        self._ordenadores = {}  # día -> {ordeñador: fila}
+        for registro in registros:
+            self._sumar(registro, 1, ordenar=False)
+        self._dias.sort()
+
+    def estado(self):
+        """Filas en tipos básicos para la instantánea (sin copiar: serializarlas bajo el lock)."""
+        return {'dias': self._dias, 'totales': self._totales, 'vacas': self._vacas, 'ordenadores': self._ordenadores}
+
+    @classmethod
+    def desde_estado(cls, estado):
+        resumen = cls()
+        resumen._dias = estado['dias']
+        resumen._totales = estado['totales']
+        resumen._vacas = estado['vacas']
+        resumen._ordenadores = estado['ordenadores']
+        return resumen
+
+    def _sumar(self, registro, signo, ordenar=True):
+        dia = _dia(registro['fecha_hora'])
+        if dia is None:
+            return
+        litros = _numero(registro['litros'], float)
+        enfermedades = _anotaciones(registro['enfermedades'])
+        vacunas = _anotaciones(registro['vacunas'])
+        if dia not in self._totales:
+            if signo < 0:
+                return
+            self._vacas[dia], self._ordenadores[dia] = {}, {}
+            if ordenar:
+                bisect.insort(self._dias, dia)
+            else:
+                self._dias.append(dia)
+        grupos = [(self._totales, dia), (self._ordenadores[dia], registro['nombre_ordenador'] or '')]
+        clave = sys.intern(_clave_vaca(registro['id_vaca']))
+        if clave:
+            grupos.append((self._vacas[dia], clave))
+        for filas, nombre in grupos:
+            fila = filas.get(nombre)
+            if fila is None:
+                if signo > 0:
+                    filas[nombre] = [litros, 1, enfermedades, vacunas]
+                continue
+            fila[0] += signo * litros
+            fila[1] += signo
+            fila[2] = _combinar(fila[2], enfermedades, signo)
+            fila[3] = _combinar(fila[3], vacunas, signo)
+            if fila[1] <= 0:
+                del filas[nombre]
+        if dia not in self._totales:
+            del self._vacas[dia], self._ordenadores[dia]
+            del self._dias[bisect.bisect_left(self._dias, dia)]
+
+    def agregar(self, registro):
+        self._sumar(registro, 1)
+
+    def quitar(self, registro):
+        self._sumar(registro, -1)
+
+    def _rango(self, desde=None, hasta=None):
+        lo = bisect.bisect_left(self._dias, desde) if desde else 0
+        hi = bisect.bisect_right(self._dias, hasta) if hasta else len(self._dias)
+        return self._dias[lo:hi]
+
+    def _total(self, dias):
+        """Litros, ordeños y casos de cada enfermedad y vacuna (``Counter``) de ``dias``."""
+        litros, ordenos, enfermedades, vacunas = 0.0, 0, Counter(), Counter()
+        for dia in dias:
+            fila = self._totales[dia]
+            litros += fila[0]
+            ordenos += fila[1]
+            enfermedades.update(dict(_pares(fila[2])))
+            vacunas.update(dict(_pares(fila[3])))
+        return litros, ordenos, enfermedades, vacunas
+
+    def periodo(self, desde=None, hasta=None, top=TOP_PRODUCTORAS):
+        """Agregados de los días entre ``desde`` y ``hasta`` ('AAAA-MM-DD', inclusivos), o None si no hay.
+
+        Las mejores productoras van por litros del periodo, con la clave de la vaca (sin
+        mayúsculas ni espacios) en ``vaca``; el almacén les pone su ID y nombre.
+        """
+        dias = self._rango(desde, hasta)
+        if not dias:
+            return None
+        total = self._total(dias)
+        # De cada vaca y ordeñador bastan litros y ordeños: las anotaciones salen del total
+        vacas, ordenadores = {}, {}
+        for dia in dias:
+            for destino, filas in ((vacas, self._vacas[dia]), (ordenadores, self._ordenadores[dia])):
+                for clave, fila in filas.items():
+                    acumulado = destino.get(clave)
+                    if acumulado is None:
+                        destino[clave] = [fila[0], fila[1]]
+                    else:
+                        acumulado[0] += fila[0]
+                        acumulado[1] += fila[1]
+        mejores = heapq.nlargest(top, vacas.items(), key=lambda v: (v[1][0], v[0]))
+        return {
+            'desde': dias[0],
+            'hasta': dias[-1],
+            'dias': len(dias),
+            'total_litros': round(total[0], 2),
+            'ordenos': total[1],
+            'promedio_ordeno': round(total[0] / total[1], 2),
+            'promedio_diario': round(total[0] / len(dias), 2),
+            'vacas_ordenadas': len(vacas),
+            'top_productoras': [{'vaca': clave, 'litros': round(fila[0], 2), 'ordenos': fila[1]}
+                                for clave, fila in mejores],
+            'ordenadores': {nombre: {'total': round(fila[0], 2), 'count': fila[1]}
+                            for nombre, fila in sorted(ordenadores.items())},
+            'enfermedades': _ordenados(total[2]),
+            'vacunas': _ordenados(total[3]),
+            'diario': [{'fecha': dia, 'litros': round(self._totales[dia][0], 2), 'ordenos': self._totales[dia][1]}
+                       for dia in dias],
+        }
+
+    def interanual(self, desde, hasta, temporadas):
+        """El periodo ``desde``-``hasta`` en este año y en las ``temporadas - 1`` anteriores.
+
+        Una fila por año (del más reciente al más antiguo) con litros, ordeños, días con
+        registros y la variación de litros respecto al año anterior; solo recorre los
+        totales diarios de cada periodo.
+        """
+        filas = []
+        for atras in range(temporadas):
+            inicio, fin = _desplazar_anios(desde, atras), _desplazar_anios(hasta, atras)
+            dias = self._rango(inicio, fin)
+            total = self._total(dias)
+            filas.append({
+                'anio': int(inicio[:4]),
+                'desde': inicio,
+                'hasta': fin,
+                'dias': len(dias),
+                'total_litros': round(total[0], 2),
+                'ordenos': total[1],
+                'promedio_diario': round(total[0] / len(dias), 2) if dias else None,
+                'enfermedades': sum(total[2].values()),
+            })
+        for actual, anterior in zip(filas, filas[1:]):
+            actual['variacion'] = (round(actual['total_litros'] / anterior['total_litros'] - 1, 3)
+                                   if anterior['total_litros'] else None)
+        filas[-1]['variacion'] = None
+        return filas
+
+    def filas(self, desde=None, hasta=None):
+        """Filas del periodo por día: ``(día, 'vaca' u 'ordenador', clave, litros, ordeños, enfermedades, vacunas)``.
+
+        Las enfermedades y vacunas van como texto ('Mastitis: 2, Cojeras: 1'). Se puede
+        consumir a trozos mientras llegan escrituras: las filas que desaparecen se saltan.
+        """
+        for dia in self._rango(desde, hasta):
+            for tipo, filas in (('vaca', self._vacas.get(dia, {})), ('ordenador', self._ordenadores.get(dia, {}))):
+                for clave in sorted(filas):
+                    if clave not in filas:
+                        continue
+                    litros, ordenos, enfermedades, vacunas = filas[clave]
+                    yield (dia, tipo, clave, round(litros, 2), ordenos,
+                           ', '.join(f"{c['nombre']}: {c['casos']}" for c in _ordenados(enfermedades)),
+                           ', '.join(f"{c['nombre']}: {c['casos']}" for c in _ordenados(vacunas)))
+
+    def mensual(self):
+        """Litros de cada mes por año: ``{año: [litros de enero, ..., diciembre]}`` (None si no hubo registros)."""
+        anios = {}
+        for dia in self._dias:
+            meses = anios.setdefault(int(dia[:4]), [None] * 12)
+            mes = int(dia[5:7]) - 1
+            meses[mes] = (meses[mes] or 0.0) + self._totales[dia][0]
+        return {anio: [_redondear(litros) for litros in meses] for anio, meses in anios.items()}
@@ -1,75 +1,315 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+from flask import (Flask, render_template, request, redirect, url_for, jsonify, send_file, abort, Response,
+                   stream_with_context, g, before_render_template, template_rendered)
 from openpyxl import Workbook, load_workbook
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import base64
-from io import BytesIO
-from PIL import Image, ImageOps
+import calendar
+import click
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from almacen import (AlmacenExcel, ConflictoVersion, IndiceCambios, RegistroArchivado, registro_a_valores, cria_a_valores,
+                     COLUMNAS_ORDENABLES, CAMPOS_CRIA_EDITABLES, CAMPOS_REGISTRO, ENCABEZADOS_REGISTRO, ENCABEZADOS_CRIA,
+                     clave_texto, escribir_libro)
+from almacen_sqlite import AlmacenSQLite
+from analitica import VENTANA_CORTA, VENTANA_LARGA, UMBRAL_CAIDA
+from fotos import AlmacenFotos, VARIANTES, WEBP_DISPONIBLE, es_hash_foto, procesar_foto
+import metricas
+from metricas import tramo
 
 app = Flask(__name__)
 
 # Configuración
+# Dónde se guardan registros y crías: 'excel' (EXCEL_FILE) o 'sqlite' (SQLITE_FILE).
+# Se pasa de uno a otro con `flask --app app migrar-almacen <destino>`
+ALMACEN = os.environ.get('VETERINARIA_ALMACEN', 'excel')
 EXCEL_FILE = 'registros_vacas.xlsx'
+SQLITE_FILE = 'registros_vacas.sqlite3'
+FOTOS_DIR = 'fotos'
+FOTOS_MAX_AGE = 365 * 24 * 3600  # las fotos se direccionan por hash: nunca cambian
+FOTO_MAX_BYTES = 24000  # ~32000 caracteres en base64, el límite que tenía la celda de Excel
+# Procesos del pool de fotos de cada proceso del servidor (con gunicorn, de cada worker)
+PROCESOS_IMAGENES = min(os.cpu_count() or 1, 4)
+REGISTROS_POR_PAGINA = 50
+MAX_REGISTROS_POR_PAGINA = 500
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+IMPORTAR_MAX_FILAS = 5000
+IMPORTAR_MAX_BYTES_FOTO = 16 * 1024 * 1024  # por foto descomprimida del zip
+SINCRONIZAR_MAX_ELEMENTOS = 500  # altas (registros + crías) por petición de /api/sincronizar
+SINCRONIZAR_MAX_CAMBIOS = 500  # filas por página de cambios de /api/sincronizar
+GENERACIONES_ARBOL = 3  # generaciones de ancestros y descendientes en el árbol familiar
+MAX_GENERACIONES_ARBOL = 10
+TEMPORADAS_COMPARADAS = 5  # años (el del periodo y los anteriores) de la comparación interanual
+MAX_TEMPORADAS_COMPARADAS = 20
+METRICAS_ACTIVAS = True
+PETICION_LENTA_SEGUNDOS = 1.0  # se registran con su desglose por tramos; None para no registrarlas
+
+# Campos que el formulario exige (la foto se comprueba aparte)
+CAMPOS_OBLIGATORIOS = [
+    'nombre_ordenador', 'id_vaca', 'nombre_vaca', 'edad', 'estado_productivo',
+    'vaca_parida', 'vaca_seca', 'numero_crias', 'numero_parto', 'litros', 'condicion_corporal'
+]
 
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB máximo
 
+# Las escrituras van a un diario que se vuelca al Excel cada COMPACTAR_CADA_SEGUNDOS
+# o cuando el diario supera COMPACTAR_UMBRAL_BYTES
+COMPACTAR_CADA_SEGUNDOS = 60
+COMPACTAR_UMBRAL_BYTES = 512 * 1024
+# Meses que se quedan en el libro activo (el actual y el anterior); los más antiguos se
+# archivan al compactar en archivo/registros_vacas_AAAA-MM.xlsx, de solo lectura
+MESES_ACTIVOS = 2
+
+def crear_almacen(tipo):
+    """Almacén de registros y crías del tipo indicado ('excel' o 'sqlite'), sin cargar."""
+    if tipo == 'sqlite':
+        return AlmacenSQLite(SQLITE_FILE)
+    if tipo == 'excel':
+        return AlmacenExcel(EXCEL_FILE, COMPACTAR_UMBRAL_BYTES, COMPACTAR_CADA_SEGUNDOS,
+                            meses_activos=MESES_ACTIVOS)
+    raise ValueError(f"Almacén desconocido: {tipo!r} (usa 'excel' o 'sqlite')")
+
+# Los procesos del pool arrancan con forkserver (o spawn) y vuelven a ejecutar este
+# archivo como '__mp_main__'; ahí solo hace falta ``fotos.procesar_foto``, así que esos
+# procesos no cargan los datos ni registran métricas
+_PROCESO_DEL_POOL = __name__ == '__mp_main__'
+
+# Copia en memoria de los datos compartida por todas las rutas
+almacen = crear_almacen(ALMACEN)
+# Fotos como archivos JPEG nombrados por su hash; el Excel solo guarda el hash
+fotos = AlmacenFotos(FOTOS_DIR)
+# Se crea con la primera foto: los procesos no se arrancan si nadie sube imágenes
+_pool_imagenes = None
+_pool_imagenes_lock = threading.Lock()
+
+# Métricas en /metrics (formato Prometheus)
+if not _PROCESO_DEL_POOL:
+    metricas.activas = METRICAS_ACTIVAS
+    PETICIONES = metricas.Histograma('veterinaria_peticion_segundos', 'Duración de las peticiones HTTP',
+                                     ['metodo', 'ruta', 'estado'])
+    PETICIONES_LENTAS = metricas.Contador('veterinaria_peticiones_lentas_total',
+                                          'Peticiones que superaron PETICION_LENTA_SEGUNDOS', ['metodo', 'ruta'])
+    metricas.Indicador('veterinaria_escritor_en_cola', 'Operaciones esperando al hilo escritor',
+                       lambda: almacen.estado_escritor()['en_cola'])
+    metricas.Indicador('veterinaria_escritor_lotes_total', 'Lotes anotados en el diario',
+                       lambda: almacen.estado_escritor()['lotes'], tipo='counter')
+    metricas.Indicador('veterinaria_escritor_operaciones_total', 'Operaciones anotadas en el diario',
+                       lambda: almacen.estado_escritor()['operaciones'], tipo='counter')
+
 def allowed_file(filename):
     """Verifica si el archivo tiene una extensión permitida"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def procesar_imagen_a_base64(file_storage, max_base64_len: int = 32000) -> str:
-    # Tamaños y calidades a intentar
-    tamanos = [800, 720, 640, 560, 480]
-    calidades = [85, 80, 75, 70, 65, 60, 55, 50]
+def pool_imagenes():
+    """Pool de procesos para comprimir fotos en paralelo sin ocupar el hilo del servidor.
+
+    No usa fork: cuando se crea, el hilo escritor o el compactador pueden tener tomado
+    un bloqueo, y un fork lo copiaría tomado en el proceso hijo.
+    """
+    global _pool_imagenes
+    if _pool_imagenes is None:
+        with _pool_imagenes_lock:
+            if _pool_imagenes is None:
+                metodo = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                _pool_imagenes = ProcessPoolExecutor(max_workers=PROCESOS_IMAGENES,
+                                                     mp_context=multiprocessing.get_context(metodo))
+    return _pool_imagenes
+
+def procesar_imagen(file_storage, max_bytes: int = FOTO_MAX_BYTES):
+    """Redimensiona y comprime la foto subida a un JPEG de tamaño acotado (en el pool de procesos).
 
+    Devuelve ``(jpeg, derivados)``: la miniatura y la versión de detalle se generan en
+    el mismo trabajo, aprovechando la imagen ya decodificada.
+    """
     # Asegurarnos de leer desde el inicio del stream
     try:
         file_storage.stream.seek(0)
     except Exception:
         pass
+    datos = file_storage.stream.read()
+    with tramo('imagen'):
+        return pool_imagenes().submit(procesar_foto, datos, max_bytes).result()
+
+@app.template_global()
+def url_foto(valor, tam='completa'):
+    """URL de la foto de un registro: /foto/<hash>, o data URI si la fila aún guarda base64.
+
+    ``tam`` elige un derivado ('mini', 'detalle') en lugar de la foto completa.
+    """
+    if not valor:
+        return ''
+    if es_hash_foto(valor):
+        return url_for('foto', hash_foto=valor, tam=None if tam == 'completa' else tam)
+    return f'data:image/jpeg;base64,{valor}'
+
+# En las plantillas: si la foto de una fila ya está en el almacén de fotos (y tiene miniatura)
+app.add_template_global(es_hash_foto)
+
+@app.template_global()
+def url_con_parametros(**cambios):
+    """URL de la página actual cambiando algunos parámetros de la query string (filtros, orden, página)."""
+    args = request.args.to_dict()
+    args.update(cambios)
+    args.update(request.view_args or {})
+    return url_for(request.endpoint, **{k: v for k, v in args.items() if v not in ('', None)})
+
+# Campos que se pueden pedir con ?fields= en la API de registros
+CAMPOS_FOTO_API = {'foto_url': 'completa', 'foto_url_detalle': 'detalle', 'foto_url_mini': 'mini'}
+CAMPOS_API = ['fila'] + CAMPOS_REGISTRO + list(CAMPOS_FOTO_API)
+
+def leer_campos(args):
+    """Campos pedidos con ``fields=a,b,c``; ``None`` si no se pidió ninguno. ValueError si alguno no existe."""
+    if not args.get('fields'):
+        return None
+    campos = [c.strip() for c in args['fields'].split(',') if c.strip()]
+    desconocidos = [c for c in campos if c not in CAMPOS_API]
+    if desconocidos:
+        raise ValueError('Campos desconocidos: ' + ', '.join(desconocidos))
+    return campos
+
+def registro_json(registro, campos=None):
+    """Registro listo para JSON, solo con ``campos`` si se indican.
+
+    La foto va como hash y URL. Las filas sin migrar guardan la foto en base64. Para ellas,
+    sin ``campos`` la foto y sus URL salen como ``None``. Si se piden las URL de forma
+    explícita, salen como data URI.
+    """
+    foto = registro['foto']
+    en_archivo = es_hash_foto(foto)
+    data = {}
+    for campo in campos or CAMPOS_API:
+        if campo in CAMPOS_FOTO_API:
+            data[campo] = url_foto(foto, CAMPOS_FOTO_API[campo]) if en_archivo or campos else None
+        elif campo == 'foto':
+            data[campo] = foto if en_archivo else None
+        else:
+            data[campo] = registro[campo]
+    return data
+
+def json_condicional(etag=None, **data):
+    """Respuesta JSON con ETag y Last-Modified; 304 si el cliente ya tiene esta versión.
+
+    Sin ``etag`` se deriva del estado de los datos y de la URL pedida: cambia con
+    cualquier escritura, así que sirve para listados y agregados.
+    """
+    etiqueta, modificado = almacen.estado_datos()
+    if etag is None:
+        etag = hashlib.sha1(f'{etiqueta}|{request.full_path}'.encode()).hexdigest()[:20]
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(modificado, timezone.utc)
+    # Se puede guardar, pero siempre se revalida (barato: 304 sin cuerpo)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def etag_registro(registro, campos=None):
+    """ETag de un registro: ID estable y versión (más los campos pedidos, que cambian el cuerpo)."""
+    etag = f"{registro['id_registro']}-{registro['version']}"
+    if campos:
+        etag += '-' + hashlib.sha1(','.join(campos).encode()).hexdigest()[:8]
+    return etag
+
+def _fecha_param(valor):
+    """Fecha 'AAAA-MM-DD' de la query string, o '' si falta o no es válida."""
+    try:
+        return datetime.strptime(valor, '%Y-%m-%d').strftime('%Y-%m-%d') if valor else ''
+    except ValueError:
+        return ''
+
+def leer_consulta_registros(args):
+    """Filtros, orden y página pedidos a /registros o /api/registros."""
+    orden = args.get('orden', 'fecha_hora')
+    por_pagina = args.get('por_pagina', REGISTROS_POR_PAGINA, type=int) or REGISTROS_POR_PAGINA
+    return {
+        'vaca': args.get('vaca', '').strip(),
+        'ordenador': args.get('ordenador', '').strip(),
+        'estado': args.get('estado', '').strip(),
+        'desde': _fecha_param(args.get('desde')),
+        'hasta': _fecha_param(args.get('hasta')),
+        'orden': orden if orden in COLUMNAS_ORDENABLES else 'fecha_hora',
+        'dir': 'asc' if args.get('dir') == 'asc' else 'desc',
+        'pagina': max(args.get('pagina', 1, type=int) or 1, 1),
+        'por_pagina': min(max(por_pagina, 1), MAX_REGISTROS_POR_PAGINA),
+    }
+
+def leer_periodo(args):
+    """Periodo pedido al dashboard: ``(desde, hasta)`` en 'AAAA-MM-DD', inclusivos.
+
+    ``semana`` ('2024-W09', semana ISO) o ``mes`` ('2024-03') tienen prioridad sobre
+    ``desde``/``hasta``; sin ninguno (o con valores no válidos) es ``(None, None)``, todo
+    el historial. Con ``desde`` y sin ``hasta`` el periodo llega hasta hoy.
+    """
+    try:
+        if args.get('semana'):
+            lunes = datetime.strptime(args['semana'] + '-1', '%G-W%V-%u')
+            return lunes.strftime('%Y-%m-%d'), (lunes + timedelta(days=6)).strftime('%Y-%m-%d')
+        if args.get('mes'):
+            inicio = datetime.strptime(args['mes'], '%Y-%m')
+            ultimo = calendar.monthrange(inicio.year, inicio.month)[1]
+            return inicio.strftime('%Y-%m-%d'), inicio.replace(day=ultimo).strftime('%Y-%m-%d')
+    except ValueError:
+        pass
+    desde = _fecha_param(args.get('desde')) or None
+    hasta = _fecha_param(args.get('hasta')) or None
+    if desde and not hasta:
+        hasta = datetime.now().strftime('%Y-%m-%d')
+    return desde, hasta
+
+def resumen_periodo(args):
+    """Periodo pedido y sus agregados desde el resumen diario: ``(desde, hasta, periodo, interanual)``.
+
+    ``interanual`` compara el periodo con el mismo de años anteriores (``temporadas``
+    años en total); solo se calcula si el periodo tiene principio y fin.
+    """
+    desde, hasta = leer_periodo(args)
+    if not desde and not hasta:
+        return None, None, None, None
+    temporadas = args.get('temporadas', TEMPORADAS_COMPARADAS, type=int) or TEMPORADAS_COMPARADAS
+    temporadas = min(max(temporadas, 1), MAX_TEMPORADAS_COMPARADAS)
+    interanual = almacen.interanual(desde, hasta, temporadas) if desde and hasta else None
+    return desde, hasta, almacen.resumen_periodo(desde, hasta), interanual
 
-    # Abrir imagen con PIL
-    img = Image.open(file_storage.stream)
-
-    # Corregir orientación y convertir a RGB
-    img = ImageOps.exif_transpose(img)
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-
-    for max_px in tamanos:
-        # Redimensionar manteniendo proporción
-        copia = img.copy()
-        copia.thumbnail((max_px, max_px), Image.LANCZOS)
-
-        for q in calidades:
-            buf = BytesIO()
-            copia.save(buf, format='JPEG', quality=q, optimize=True)
-            raw = buf.getvalue()
-            b64 = base64.b64encode(raw).decode('utf-8')
-            if len(b64) <= max_base64_len:
-                return b64
-
-    # Si no se pudo cumplir el límite, devolver la versión más comprimida posible
-    # Último intento: 480px, calidad 50
-    buf = BytesIO()
-    img_small = img.copy()
-    img_small.thumbnail((480, 480), Image.LANCZOS)
-    img_small.save(buf, format='JPEG', quality=50, optimize=True)
-    return base64.b64encode(buf.getvalue()).decode('utf-8')
+def consultar_registros(consulta):
+    """Ejecuta la consulta sobre los índices del almacén. Devuelve (total, paginas, registros)."""
+    total, pagina = almacen.consultar(
+        filtros={
+            'id_vaca': consulta['vaca'],
+            'nombre_ordenador': consulta['ordenador'],
+            'estado_productivo': consulta['estado'],
+        },
+        desde=consulta['desde'] or None,
+        hasta=consulta['hasta'] or None,
+        orden=consulta['orden'],
+        descendente=consulta['dir'] == 'desc',
+        offset=(consulta['pagina'] - 1) * consulta['por_pagina'],
+        limite=consulta['por_pagina'],
+    )
+    paginas = max(1, -(-total // consulta['por_pagina']))
+    return total, paginas, pagina
 
 def guardar_en_excel(datos):
-    """Guarda los datos en el archivo Excel"""
-    # Cargar el archivo existente
-    wb = load_workbook(EXCEL_FILE)
-    ws = wb.active
-    
-    ws.append([
+    """Guarda los datos como una nueva fila (vía el diario del almacén)"""
+    almacen.agregar_registro(datos_a_valores(datos))
+
+def datos_a_valores(datos):
+    """Valores de la fila en el orden de columnas de la hoja principal."""
+    return [
         datos['fecha_hora'],
         datos['nombre_ordenador'],
         datos['id_vaca'],
         datos['nombre_vaca'],
         datos['litros'],
-        datos['imagen_base64'],
+        datos['foto'],
         datos['edad'],
         datos['estado_productivo'],
         datos['vaca_parida'],
@@ -79,79 +319,45 @@ def guardar_en_excel(datos):
         datos.get('vacunas', ''),
         datos.get('enfermedades', ''),
         datos.get('condicion_corporal', '')
-    ])
-    
-    wb.save(EXCEL_FILE)
+    ]
 
-def ensure_workbook_and_headers():
-    """Asegura que el archivo Excel exista y tenga encabezados mínimos en la hoja principal y la hoja 'Crias'."""
-    try:
-        wb = load_workbook(EXCEL_FILE)
-    except FileNotFoundError:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = 'Registros'
-        ws.append([
-            'FechaHora','Ordeñador','ID Vaca','Nombre Vaca','Litros','Imagen Base64','Edad','Estado','Parida','Seca','Nº Crías','Nº Parto','Vacunas','Enfermedades','Condición Corporal'
-        ])
-    # hoja principal
-    ws = wb.active
-    if ws.max_row == 1 and ws.max_column < 5:
-        ws.append([
-            'FechaHora','Ordeñador','ID Vaca','Nombre Vaca','Litros','Imagen Base64','Edad','Estado','Parida','Seca','Nº Crías','Nº Parto','Vacunas','Enfermedades','Condición Corporal'
-        ])
-    # hoja crias
-    if 'Crias' not in wb.sheetnames:
-        ws_c = wb.create_sheet('Crias')
-        ws_c.append(['FechaRegistro','MadreID','MadreNombre','CriaID','CriaNombre','FechaNacimiento','Sexo','Observaciones'])
-    wb.save(EXCEL_FILE)
-    wb.close()
-
-def get_unique_cows():
-    """Devuelve lista de vacas únicas (ID, Nombre) desde la hoja principal."""
-    ensure_workbook_and_headers()
-    wb = load_workbook(EXCEL_FILE)
-    ws = wb.active
-    seen = {}
-    for row in ws.iter_rows(min_row=2, values_only=True):
-        if not row or not row[2]:
-            continue
-        cow_id = str(row[2])
-        name = row[3] or ''
-        # Conserva el último nombre visto
-        seen[cow_id] = name
-    wb.close()
-    # Lista ordenada por ID
-    return sorted([{ 'id': cid, 'nombre': seen[cid] } for cid in seen.keys()], key=lambda x: x['id'])
+def validar_registro(campos, vacunas_list, enfermedades_list, fecha_hora=None):
+    """Aplica las reglas del formulario de registro y devuelve ``datos`` listo para guardar (sin foto).
+
+    Lanza ``ValueError`` con el mensaje para el usuario si falta un campo o un número no es válido.
+    """
+    faltan = [campo for campo in CAMPOS_OBLIGATORIOS if not campos.get(campo)]
+    if faltan:
+        raise ValueError('Faltan campos requeridos: ' + ', '.join(faltan))
+    # Normalizar enfermedades: 'Ninguna' es excluyente
+    if 'Ninguna' in enfermedades_list:
+        enfermedades_list = ['Ninguna']
+    if fecha_hora:
+        # Solo las importaciones traen fecha propia; debe tener el formato de las filas existentes
+        fecha_hora = datetime.strptime(fecha_hora, '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:%S')
+    return {
+        'fecha_hora': fecha_hora or datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'nombre_ordenador': campos['nombre_ordenador'],
+        'id_vaca': campos['id_vaca'],
+        'nombre_vaca': campos['nombre_vaca'],
+        'edad': int(campos['edad']),
+        'estado_productivo': campos['estado_productivo'],
+        'vaca_parida': campos['vaca_parida'],
+        'vaca_seca': campos['vaca_seca'],
+        'numero_crias': int(campos['numero_crias']),
+        'numero_parto': int(campos['numero_parto']),
+        'litros': float(campos['litros']),
+        'vacunas': ', '.join(vacunas_list) if vacunas_list else '',
+        'enfermedades': ', '.join(enfermedades_list) if enfermedades_list else 'Ninguna',
+        'condicion_corporal': campos['condicion_corporal']
+    }
 
 def get_crias():
-    """Lee la hoja 'Crias' y devuelve todas las crías."""
-    ensure_workbook_and_headers()
-    wb = load_workbook(EXCEL_FILE)
-    ws = wb['Crias']
-    crias = []
-    for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-        if not row or not row[1]:
-            continue
-        crias.append({
-            'fila': idx,
-            'fecha_registro': row[0],
-            'madre_id': row[1],
-            'madre_nombre': row[2],
-            'cria_id': row[3],
-            'cria_nombre': row[4],
-            'fecha_nacimiento': row[5],
-            'sexo': row[6],
-            'observaciones': row[7] or ''
-        })
-    wb.close()
-    return crias
+    """Devuelve todas las crías de la hoja 'Crias'."""
+    return almacen.crias()
 
 def add_cria(madre_id: str, madre_nombre: str, cria_id: str, cria_nombre: str, fecha_nac: str, sexo: str, obs: str):
-    ensure_workbook_and_headers()
-    wb = load_workbook(EXCEL_FILE)
-    ws = wb['Crias']
-    ws.append([
+    almacen.agregar_cria([
         datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         madre_id,
         madre_nombre,
@@ -161,8 +367,56 @@ def add_cria(madre_id: str, madre_nombre: str, cria_id: str, cria_nombre: str, f
         sexo,
         obs
     ])
-    wb.save(EXCEL_FILE)
-    wb.close()
+
+# ---- Métricas ----
+
+@app.before_request
+def iniciar_medicion():
+    if METRICAS_ACTIVAS:
+        g.inicio_peticion = time.perf_counter()
+        metricas.iniciar_peticion()
+
+@app.after_request
+def anotar_estado(response):
+    g.estado_peticion = response.status_code
+    return response
+
+@app.teardown_request
+def terminar_medicion(exc):
+    """Anota la duración de la petición y registra las lentas con su desglose por tramos.
+
+    En las respuestas en streaming (exportación CSV) se mide hasta que la vista
+    devuelve la respuesta, no hasta el último byte enviado.
+    """
+    inicio = g.pop('inicio_peticion', None)
+    if inicio is None:
+        return
+    duracion = time.perf_counter() - inicio
+    desglose = metricas.terminar_peticion()
+    ruta = request.url_rule.rule if request.url_rule is not None else 'sin_ruta'
+    PETICIONES.observar(duracion, request.method, ruta, str(g.pop('estado_peticion', 500)))
+    if PETICION_LENTA_SEGUNDOS is not None and duracion >= PETICION_LENTA_SEGUNDOS:
+        PETICIONES_LENTAS.incrementar(request.method, ruta)
+        resto = duracion - sum(desglose.values())
+        partes = [f'{nombre} {segundos:.3f} s' for nombre, segundos in sorted(desglose.items(), key=lambda t: -t[1])]
+        print(f"⏱️ Petición lenta: {request.method} {request.full_path.rstrip('?')} {duracion:.3f} s "
+              f"({', '.join(partes + [f'resto {resto:.3f} s'])})")
+
+@before_render_template.connect_via(app)
+def _inicio_plantilla(sender, template, context, **extra):
+    if METRICAS_ACTIVAS:
+        g.setdefault('inicio_plantillas', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _fin_plantilla(sender, template, context, **extra):
+    inicios = g.get('inicio_plantillas')
+    if inicios:
+        metricas.registrar_tramo('plantilla', time.perf_counter() - inicios.pop())
+
+@app.route('/metrics')
+def metrics():
+    """Métricas de este proceso en formato de texto de Prometheus."""
+    return Response(metricas.exponer(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/')
 def index():
@@ -173,16 +427,16 @@ def index():
 def crias_view():
     """Vista para gestionar crías: lista y formulario de alta."""
     try:
-        vacas = get_unique_cows()
+        # Las madres se buscan con el autocompletado (/api/vacas): la página no lleva la lista de vacas
         crias = get_crias()
-        return render_template('crias.html', vacas=vacas, crias=crias)
+        return render_template('crias.html', crias=crias)
     except Exception as e:
-        return render_template('crias.html', vacas=[], crias=[], error=f"Error: {str(e)}")
+        return render_template('crias.html', crias=[], error=f"Error: {str(e)}")
 
 @app.route('/crias/guardar', methods=['POST'])
 def crias_guardar():
     try:
-        madre = request.form.get('madre')  # formato: id|nombre
+        madre = (request.form.get('madre') or '').strip()  # ID de la vaca (o 'id|nombre')
         cria_id = request.form.get('cria_id')
         cria_nombre = request.form.get('cria_nombre')
         fecha_nac = request.form.get('fecha_nacimiento')
@@ -195,15 +449,46 @@ def crias_guardar():
         if '|' in madre:
             madre_id, madre_nombre = madre.split('|', 1)
         else:
-            # fallback: buscar nombre por ID
-            madre_id = madre
-            madre_nombre = next((v['nombre'] for v in get_unique_cows() if v['id'] == madre_id), '')
+            # Buscar el nombre en el catálogo de vacas
+            vaca = almacen.vaca(madre)
+            if vaca is None:
+                return redirect(url_for('crias_view') + f'?error=No hay registros de la vaca {madre}')
+            madre_id, madre_nombre = vaca['id'], vaca['nombre']
 
         add_cria(madre_id, madre_nombre, cria_id, cria_nombre, fecha_nac, sexo, obs)
         return redirect(url_for('crias_view') + '?success=true')
     except Exception as e:
         return redirect(url_for('crias_view') + f'?error={str(e)}')
 
+@app.route('/api/vacas')
+def api_vacas():
+    """Autocompletado de vacas por prefijo de ID o nombre (``q``), con su último ordeño, estado y crías."""
+    limite = min(max(request.args.get('limite', 10, type=int) or 10, 1), 50)
+    return json_condicional(success=True, vacas=almacen.buscar_vacas(request.args.get('q', ''), limite))
+
+@app.route('/api/vacas/<id_vaca>')
+def api_vaca(id_vaca: str):
+    """Ficha de una vaca del catálogo."""
+    vaca = almacen.vaca(id_vaca)
+    if vaca is None:
+        return jsonify(success=False, error=f'No hay registros de la vaca {id_vaca}'), 404
+    return json_condicional(success=True, vaca=vaca)
+
+@app.route('/api/vacas/<id_vaca>/genealogia')
+def api_genealogia(id_vaca: str):
+    """Árbol familiar de una vaca o cría: ancestros y descendientes (``generaciones``, 3 por defecto),
+    hermanos de madre, profundidad en el linaje y fechas de parto."""
+    generaciones = request.args.get('generaciones', GENERACIONES_ARBOL, type=int) or GENERACIONES_ARBOL
+    arbol = almacen.genealogia().arbol(id_vaca, min(max(generaciones, 1), MAX_GENERACIONES_ARBOL))
+    if arbol is None:
+        return jsonify(success=False, error=f'No hay registros ni crías con el ID {id_vaca}'), 404
+    return json_condicional(success=True, **arbol)
+
+@app.route('/api/fertilidad')
+def api_fertilidad():
+    """Fertilidad del rebaño: crías por madre e intervalos entre partos, con el detalle de cada madre."""
+    return json_condicional(success=True, **almacen.genealogia().fertilidad())
+
 @app.route('/formulario')
 def formulario():
     """Página del formulario de registro"""
@@ -213,38 +498,14 @@ def formulario():
 def editar(fila: int):
     """Carga un registro para editarlo y reutiliza el formulario."""
     try:
-        wb = load_workbook(EXCEL_FILE)
-        ws = wb.active
-        row = ws[fila]
-        # Convertir a values
-        valores = [cell.value for cell in row]
-        wb.close()
-
-        # Campos seguros por índice
-        vacunas_str = valores[12] if len(valores) > 12 else ''
-        enfermedades_str = valores[13] if len(valores) > 13 else ''
-        condicion_corporal = valores[14] if len(valores) > 14 else ''
-        vacunas_sel = [v.strip() for v in (vacunas_str or '').split(',') if v and v.strip()]
-        enfermedades_sel = [e.strip() for e in (enfermedades_str or '').split(',') if e and e.strip()]
-
-        registro = {
-            'fila': fila,
-            'fecha_hora': valores[0],
-            'nombre_ordenador': valores[1],
-            'id_vaca': valores[2],
-            'nombre_vaca': valores[3],
-            'litros': valores[4],
-            'imagen_base64': valores[5],
-            'edad': valores[6],
-            'estado_productivo': valores[7],
-            'vaca_parida': valores[8],
-            'vaca_seca': valores[9],
-            'numero_crias': valores[10],
-            'numero_parto': valores[11],
-            'vacunas': vacunas_str,
-            'enfermedades': enfermedades_str,
-            'condicion_corporal': condicion_corporal
-        }
+        registro = almacen.registro(fila)
+        if registro is None:
+            raise ValueError(f'la fila {fila} no tiene datos')
+        if almacen.archivado(fila):
+            raise RegistroArchivado(fila)
+
+        vacunas_sel = [v.strip() for v in (registro['vacunas'] or '').split(',') if v and v.strip()]
+        enfermedades_sel = [e.strip() for e in (registro['enfermedades'] or '').split(',') if e and e.strip()]
 
         return render_template(
             'formulario.html',
@@ -257,273 +518,214 @@ def editar(fila: int):
     except Exception as e:
         return redirect(url_for('registros') + f'?error=No se pudo cargar el registro: {str(e)}')
 
+def _version_esperada(registro):
+    """Versión que el cliente cree estar editando: cabecera If-Match (ETag) o campo ``version`` del formulario.
+
+    Devuelve ``None`` si no se indicó. Un If-Match de otro registro equivale a una versión imposible.
+    """
+    if request.if_match and not request.if_match.star_tag:
+        for etag in request.if_match:
+            partes = etag.split('-')
+            if registro is not None and partes[0] == registro['id_registro'] and partes[1:2] and partes[1].isdigit():
+                return int(partes[1])
+        return -1
+    version = request.form.get('version', '')
+    return int(version) if version.isdigit() else None
+
 @app.route('/actualizar/<int:fila>', methods=['POST'])
 def actualizar(fila: int):
-    """Actualiza un registro existente en la fila dada."""
+    """Actualiza un registro existente en la fila dada.
+
+    Si el cliente indica la versión que editó (If-Match o campo ``version``) y el
+    registro cambió entretanto, no se guarda: 412 con If-Match, o vuelta al formulario.
+    """
+    existente = almacen.registro(fila)
+    version = _version_esperada(existente)
     try:
-        # Obtener datos del formulario
-        nombre_ordenador = request.form.get('nombre_ordenador')
-        id_vaca = request.form.get('id_vaca')
-        nombre_vaca = request.form.get('nombre_vaca')
-        edad = request.form.get('edad')
-        estado_productivo = request.form.get('estado_productivo')
-        vaca_parida = request.form.get('vaca_parida')
-        vaca_seca = request.form.get('vaca_seca')
-        numero_crias = request.form.get('numero_crias')
-        numero_parto = request.form.get('numero_parto')
-        litros = request.form.get('litros')
-        condicion_corporal = request.form.get('condicion_corporal')
-
-        vacunas_list = request.form.getlist('vacunas')
-        enfermedades_list = request.form.getlist('enfermedades')
-        if 'Ninguna' in enfermedades_list:
-            enfermedades_list = ['Ninguna']
-        vacunas_str = ', '.join(vacunas_list) if vacunas_list else ''
-        enfermedades_str = ', '.join(enfermedades_list) if enfermedades_list else 'Ninguna'
-
-        # Validación básica
-        if not all([nombre_ordenador, id_vaca, nombre_vaca, edad, estado_productivo, 
-                    vaca_parida, vaca_seca, numero_crias, numero_parto, litros, condicion_corporal]):
-            return redirect(url_for('editar', fila=fila) + '?error=Faltan campos requeridos')
-
-        # Cargar Excel y obtener imagen existente por si no se reemplaza
-        wb = load_workbook(EXCEL_FILE)
-        ws = wb.active
-        imagen_existente = ws.cell(row=fila, column=6).value  # Columna 6 = imagen_base64
+        # Obtener y validar datos del formulario (mismas reglas que /guardar)
+        datos = validar_registro(request.form, request.form.getlist('vacunas'),
+                                 request.form.getlist('enfermedades'))
+
+        # Comprobar la versión antes de procesar la foto; el escritor la vuelve a comprobar al anotar
+        if version is not None and (existente is None or existente['version'] != version):
+            raise ConflictoVersion(existente)
+
+        # Foto existente por si no se reemplaza
+        datos['foto'] = existente['foto'] if existente else None
 
         # Procesar foto si se envió una nueva
-        imagen_base64 = imagen_existente
         if 'foto' in request.files:
             foto = request.files['foto']
             if foto and foto.filename and allowed_file(foto.filename):
-                imagen_base64 = procesar_imagen_a_base64(foto)
-
-        # Escribir valores en la fila (respetando el orden de columnas actual)
-        ws.cell(row=fila, column=1, value=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-        ws.cell(row=fila, column=2, value=nombre_ordenador)
-        ws.cell(row=fila, column=3, value=id_vaca)
-        ws.cell(row=fila, column=4, value=nombre_vaca)
-        ws.cell(row=fila, column=5, value=float(litros))
-        ws.cell(row=fila, column=6, value=imagen_base64)
-        ws.cell(row=fila, column=7, value=int(edad))
-        ws.cell(row=fila, column=8, value=estado_productivo)
-        ws.cell(row=fila, column=9, value=vaca_parida)
-        ws.cell(row=fila, column=10, value=vaca_seca)
-        ws.cell(row=fila, column=11, value=int(numero_crias))
-        ws.cell(row=fila, column=12, value=int(numero_parto))
-        ws.cell(row=fila, column=13, value=vacunas_str)
-        ws.cell(row=fila, column=14, value=enfermedades_str)
-        ws.cell(row=fila, column=15, value=condicion_corporal)
-
-        wb.save(EXCEL_FILE)
-        wb.close()
+                datos['foto'] = fotos.guardar(*procesar_imagen(foto))
+
+        # Reemplazar la fila; el almacén conserva el ID y sube la versión
+        almacen.actualizar_registro(fila, datos_a_valores(datos), version)
 
         return redirect(url_for('registros') + '?success=edit')
+    except ConflictoVersion as e:
+        if request.if_match:
+            return jsonify(success=False, error=str(e),
+                           registro=registro_json(e.actual) if e.actual else None), 412
+        return redirect(url_for('editar', fila=fila) +
+                        '?error=El registro fue modificado por otra persona mientras lo editabas; revisa los datos actuales')
+    except RegistroArchivado as e:
+        if request.if_match:
+            return jsonify(success=False, error=str(e)), 409
+        return redirect(url_for('registros') + f'?error={str(e)}')
     except Exception as e:
         return redirect(url_for('editar', fila=fila) + f'?error={str(e)}')
 
 @app.route('/registros')
 def registros():
-    """Página para ver los registros"""
+    """Página para ver los registros (paginada, con filtros y orden)"""
+    consulta = leer_consulta_registros(request.args)
     try:
-        # Leer el archivo Excel
-        wb = load_workbook(EXCEL_FILE)
-        ws = wb.active
-        
-        # Obtener todos los registros (excepto la fila de encabezados)
-        registros_data = []
-        for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-            if row[0]:  # Si hay fecha y hora (primera columna no está vacía)
-                row_len = len(row)
-                vacunas = row[12] if row_len > 12 else ''
-                enfermedades = row[13] if row_len > 13 else ''
-                condicion_corporal = row[14] if row_len > 14 else ''
-                registros_data.append({
-                    'fila': idx,
-                    'fecha_hora': row[0],
-                    'nombre_ordenador': row[1],
-                    'id_vaca': row[2],
-                    'nombre_vaca': row[3],
-                    'litros': row[4],
-                    'imagen_base64': row[5],
-                    'edad': row[6],
-                    'estado_productivo': row[7],
-                    'vaca_parida': row[8],
-                    'vaca_seca': row[9],
-                    'numero_crias': row[10],
-                    'numero_parto': row[11],
-                    'vacunas': vacunas,
-                    'enfermedades': enfermedades,
-                    'condicion_corporal': condicion_corporal
-                })
-        
-        wb.close()
-        return render_template('registros.html', registros=registros_data)
+        total, paginas, registros_data = consultar_registros(consulta)
+        return render_template('registros.html', registros=registros_data, total=total,
+                               paginas=paginas, consulta=consulta)
     except FileNotFoundError:
-        return render_template('registros.html', registros=[], error="No se encontró el archivo de registros")
+        return render_template('registros.html', registros=[], total=0, paginas=1, consulta=consulta,
+                               error="No se encontró el archivo de registros")
     except Exception as e:
-        return render_template('registros.html', registros=[], error=f"Error al leer registros: {str(e)}")
+        return render_template('registros.html', registros=[], total=0, paginas=1, consulta=consulta,
+                               error=f"Error al leer registros: {str(e)}")
 
-@app.route('/api/registro/<int:fila>')
-def api_registro(fila: int):
-    """Devuelve un registro en formato JSON para edición modal."""
+@app.route('/api/registros')
+def api_registros():
+    """Misma consulta que /registros en JSON (filtros, orden y página por query string)."""
+    consulta = leer_consulta_registros(request.args)
     try:
-        wb = load_workbook(EXCEL_FILE)
-        ws = wb.active
-        row = ws[fila]
-        valores = [cell.value for cell in row]
-        wb.close()
-
-        row_len = len(valores)
-        vacunas = valores[12] if row_len > 12 else ''
-        enfermedades = valores[13] if row_len > 13 else ''
-        condicion_corporal = valores[14] if row_len > 14 else ''
-
-        data = {
-            'fila': fila,
-            'fecha_hora': valores[0],
-            'nombre_ordenador': valores[1],
-            'id_vaca': valores[2],
-            'nombre_vaca': valores[3],
-            'litros': valores[4],
-            'imagen_base64': valores[5],
-            'edad': valores[6],
-            'estado_productivo': valores[7],
-            'vaca_parida': valores[8],
-            'vaca_seca': valores[9],
-            'numero_crias': valores[10],
-            'numero_parto': valores[11],
-            'vacunas': vacunas or '',
-            'enfermedades': enfermedades or '',
-            'condicion_corporal': condicion_corporal or ''
-        }
-        return jsonify(success=True, registro=data)
+        campos = leer_campos(request.args)
+        total, paginas, registros_data = consultar_registros(consulta)
+        return json_condicional(success=True, total=total, pagina=consulta['pagina'], paginas=paginas,
+                                por_pagina=consulta['por_pagina'],
+                                registros=[registro_json(r, campos) for r in registros_data])
     except Exception as e:
         return jsonify(success=False, error=str(e)), 400
 
+def _responder_registro(registro, descripcion):
+    try:
+        campos = leer_campos(request.args)
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    if registro is None:
+        return jsonify(success=False, error=f'{descripcion} no tiene datos'), 404
+    return json_condicional(etag_registro(registro, campos), success=True,
+                            registro=registro_json(registro, campos))
+
+@app.route('/api/registro/<int:fila>')
+def api_registro(fila: int):
+    """Devuelve un registro en formato JSON para edición modal (``fields=`` limita los campos)."""
+    # Lectura directa de la copia en memoria: no se abre el Excel
+    return _responder_registro(almacen.registro(fila), f'la fila {fila}')
+
+@app.route('/api/registro/id/<id_registro>')
+def api_registro_por_id(id_registro: str):
+    """Igual que /api/registro/<fila> pero por el ID estable, que no depende de la posición en la hoja."""
+    return _responder_registro(almacen.registro_por_id(id_registro), f'el registro {id_registro}')
+
+@app.route('/foto/<hash_foto>')
+def foto(hash_foto: str):
+    """Sirve una foto por su hash; el contenido nunca cambia, así que se cachea indefinidamente.
+
+    ``?tam=mini|detalle`` sirve el derivado, en WebP si el navegador lo anuncia en Accept.
+    """
+    tam = request.args.get('tam', 'completa')
+    if not fotos.existe(hash_foto) or (tam != 'completa' and tam not in VARIANTES):
+        abort(404)
+    if tam == 'completa':
+        response = send_file(fotos.ruta(hash_foto), mimetype='image/jpeg', etag=hash_foto,
+                             conditional=True, max_age=FOTOS_MAX_AGE)
+    else:
+        # Solo se cuenta una mención explícita: */* no garantiza que el navegador decodifique WebP
+        webp = WEBP_DISPONIBLE and any(tipo == 'image/webp' and calidad > 0
+                                       for tipo, calidad in request.accept_mimetypes)
+        formato = 'webp' if webp else 'jpg'
+        response = send_file(fotos.ruta_derivado(hash_foto, tam, formato),
+                             mimetype='image/webp' if webp else 'image/jpeg',
+                             etag=f'{hash_foto}-{tam}-{formato}', conditional=True,
+                             max_age=FOTOS_MAX_AGE)
+        response.vary.add('Accept')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/escritor')
+def api_escritor():
+    """Estado de la cola de escritura: operaciones en cola, lotes y tiempos de espera."""
+    return jsonify(success=True, escritor=almacen.estado_escritor())
+
 @app.route('/estadisticas')
 def estadisticas():
-    """Página de estadísticas"""
+    """Página de estadísticas: todo el historial o un periodo (``desde``/``hasta``, ``semana`` o ``mes``)."""
     try:
-        # Leer el archivo Excel
-        wb = load_workbook(EXCEL_FILE)
-        ws = wb.active
-        
-        # Obtener todos los registros
-        registros = []
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            if row[0]:  # Si hay fecha
-                registros.append({
-                    'fecha_hora': row[0],
-                    'nombre_ordenador': row[1],
-                    'id_vaca': row[2],
-                    'nombre_vaca': row[3],
-                    'litros': float(row[4]) if row[4] else 0,
-                    'edad': int(row[6]) if row[6] else 0,
-                    'estado_productivo': row[7],
-                    'vaca_parida': row[8],
-                    'vaca_seca': row[9],
-                    'numero_crias': int(row[10]) if row[10] else 0,
-                    'numero_parto': int(row[11]) if row[11] else 0
-                })
-        
-        wb.close()
-        
-        # Calcular estadísticas
-        total_vacas = len(registros)
-        
-        if total_vacas > 0:
-            # Producción de leche
-            total_litros = sum(r['litros'] for r in registros)
-            promedio_litros = total_litros / total_vacas
-            max_litros = max(r['litros'] for r in registros)
-            min_litros = min(r['litros'] for r in registros)
-            
-            # Estado productivo
-            productivas = sum(1 for r in registros if r['estado_productivo'] == 'Productiva')
-            no_productivas = sum(1 for r in registros if r['estado_productivo'] == 'No Productiva')
-            en_reposo = sum(1 for r in registros if r['estado_productivo'] == 'En Reposo')
-            
-            # Edad
-            promedio_edad = sum(r['edad'] for r in registros) / total_vacas
-            
-            # Vacas paridas y secas
-            vacas_paridas = sum(1 for r in registros if r['vaca_parida'] == 'Sí')
-            vacas_secas = sum(1 for r in registros if r['vaca_seca'] == 'Sí')
-            
-            # Reproducción
-            total_crias = sum(r['numero_crias'] for r in registros)
-            promedio_crias = total_crias / total_vacas
-            promedio_partos = sum(r['numero_parto'] for r in registros) / total_vacas
-            
-            # Top 5 mejores productoras
-            top_productoras = sorted(registros, key=lambda x: x['litros'], reverse=True)[:5]
-            
-            # Producción por ordeñador
-            ordenadores = {}
-            for r in registros:
-                ord_nombre = r['nombre_ordenador']
-                if ord_nombre in ordenadores:
-                    ordenadores[ord_nombre]['total'] += r['litros']
-                    ordenadores[ord_nombre]['count'] += 1
-                else:
-                    ordenadores[ord_nombre] = {'total': r['litros'], 'count': 1}
-            
-            stats = {
-                'total_vacas': total_vacas,
-                'total_litros': round(total_litros, 2),
-                'promedio_litros': round(promedio_litros, 2),
-                'max_litros': round(max_litros, 2),
-                'min_litros': round(min_litros, 2),
-                'productivas': productivas,
-                'no_productivas': no_productivas,
-                'en_reposo': en_reposo,
-                'promedio_edad': round(promedio_edad, 1),
-                'vacas_paridas': vacas_paridas,
-                'vacas_secas': vacas_secas,
-                'total_crias': total_crias,
-                'promedio_crias': round(promedio_crias, 1),
-                'promedio_partos': round(promedio_partos, 1),
-                'top_productoras': top_productoras,
-                'ordenadores': ordenadores
-            }
-        else:
-            stats = None
-        
-        return render_template('estadisticas.html', stats=stats)
+        # Agregados mantenidos por el almacén en cada alta o edición; los de un periodo y la
+        # comparación entre temporadas salen del resumen diario, sin recorrer los registros
+        desde, hasta, periodo, interanual = resumen_periodo(request.args)
+        return render_template('estadisticas.html', stats=almacen.estadisticas(), desde=desde, hasta=hasta,
+                               periodo=periodo, interanual=interanual,
+                               mensual=almacen.produccion_mensual())
     except FileNotFoundError:
         return render_template('estadisticas.html', stats=None, error="No se encontró el archivo de registros")
     except Exception as e:
         return render_template('estadisticas.html', stats=None, error=f"Error al calcular estadísticas: {str(e)}")
 
+@app.route('/api/estadisticas')
+def api_estadisticas():
+    """Agregados de un periodo (mismos parámetros que /estadisticas) y su comparación interanual.
+
+    Sin periodo devuelve la producción mensual de cada año (``mensual``).
+    """
+    desde, hasta, periodo, interanual = resumen_periodo(request.args)
+    if not desde and not hasta:
+        mensual = {str(anio): meses for anio, meses in almacen.produccion_mensual().items()}
+        return json_condicional(success=True, mensual=mensual)
+    return json_condicional(success=True, desde=desde, hasta=hasta, periodo=periodo, interanual=interanual)
+
+def _orden_produccion(vacas):
+    """Primero las vacas con caída y luego por media reciente, de mayor a menor."""
+    return sorted(vacas, key=lambda v: (not v['caida'], -(v['media_corta'] or 0)))
+
+@app.route('/produccion')
+def produccion():
+    """Producción por vaca: medias recientes y vacas cuya producción cayó."""
+    return render_template('produccion.html', vacas=_orden_produccion(almacen.series().resumen_vacas()),
+                           ventana_corta=VENTANA_CORTA, ventana_larga=VENTANA_LARGA, umbral=UMBRAL_CAIDA)
+
+@app.route('/produccion/<id_vaca>')
+def produccion_vaca(id_vaca: str):
+    """Serie diaria, medias móviles y curva de lactancia de una vaca."""
+    vaca = almacen.series().historial(id_vaca)
+    if vaca is None:
+        abort(404)
+    return render_template('produccion_vaca.html', vaca=vaca,
+                           ventana_corta=VENTANA_CORTA, ventana_larga=VENTANA_LARGA)
+
+@app.route('/api/produccion')
+def api_produccion():
+    """Resumen de producción de todas las vacas; con ``caidas=1`` solo las que cayeron."""
+    vacas = almacen.series().resumen_vacas()
+    if request.args.get('caidas') == '1':
+        vacas = [v for v in vacas if v['caida']]
+    return json_condicional(success=True, ventana_corta=VENTANA_CORTA, ventana_larga=VENTANA_LARGA,
+                            umbral=UMBRAL_CAIDA, vacas=_orden_produccion(vacas))
+
+@app.route('/api/produccion/<id_vaca>')
+def api_produccion_vaca(id_vaca: str):
+    """Historial de producción de una vaca en JSON."""
+    vaca = almacen.series().historial(id_vaca)
+    if vaca is None:
+        return jsonify(success=False, error=f'No hay registros de la vaca {id_vaca}'), 404
+    return json_condicional(success=True, vaca=vaca)
+
 @app.route('/guardar', methods=['POST'])
 def guardar():
     """Procesa el formulario y guarda los datos"""
     try:
-        # Obtener datos del formulario
-        nombre_ordenador = request.form.get('nombre_ordenador')
-        id_vaca = request.form.get('id_vaca')
-        nombre_vaca = request.form.get('nombre_vaca')
-        edad = request.form.get('edad')
-        estado_productivo = request.form.get('estado_productivo')
-        vaca_parida = request.form.get('vaca_parida')
-        vaca_seca = request.form.get('vaca_seca')
-        numero_crias = request.form.get('numero_crias')
-        numero_parto = request.form.get('numero_parto')
-        litros = request.form.get('litros')
-        condicion_corporal = request.form.get('condicion_corporal')
-        vacunas_list = request.form.getlist('vacunas')
-        enfermedades_list = request.form.getlist('enfermedades')
-        # Normalizar enfermedades: 'Ninguna' es excluyente
-        if 'Ninguna' in enfermedades_list:
-            enfermedades_list = ['Ninguna']
-        vacunas_str = ', '.join(vacunas_list) if vacunas_list else ''
-        enfermedades_str = ', '.join(enfermedades_list) if enfermedades_list else 'Ninguna'
-        
-        # Verificar que todos los campos estén presentes
-        if not all([nombre_ordenador, id_vaca, nombre_vaca, edad, estado_productivo, 
-                    vaca_parida, vaca_seca, numero_crias, numero_parto, litros, condicion_corporal]):
-            return redirect(url_for('formulario') + '?error=Faltan campos requeridos')
+        # Obtener y validar datos del formulario (un error de validación vuelve al formulario)
+        datos = validar_registro(request.form, request.form.getlist('vacunas'),
+                                 request.form.getlist('enfermedades'))
         
         # Procesar la foto
         if 'foto' not in request.files:
@@ -535,29 +737,10 @@ def guardar():
             return redirect(url_for('formulario') + '?error=No se seleccionó ninguna foto')
         
         if foto and allowed_file(foto.filename):
-            # Procesar y comprimir la imagen en base64 segura para Excel
-            imagen_base64 = procesar_imagen_a_base64(foto)
-            # Log simple en consola para depuración de longitud
-            print(f"Longitud base64 generada: {len(imagen_base64)} caracteres")
-            
-            # Preparar datos para guardar
-            datos = {
-                'fecha_hora': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'nombre_ordenador': nombre_ordenador,
-                'id_vaca': id_vaca,
-                'nombre_vaca': nombre_vaca,
-                'edad': int(edad),
-                'estado_productivo': estado_productivo,
-                'vaca_parida': vaca_parida,
-                'vaca_seca': vaca_seca,
-                'numero_crias': int(numero_crias),
-                'numero_parto': int(numero_parto),
-                'litros': float(litros),
-                'imagen_base64': imagen_base64,
-                'vacunas': vacunas_str,
-                'enfermedades': enfermedades_str,
-                'condicion_corporal': condicion_corporal
-            }
+            # Procesar y comprimir la imagen; se guarda aparte y la fila solo lleva su hash
+            imagen, derivados = procesar_imagen(foto)
+            foto_hash = fotos.guardar(imagen, derivados)
+            datos['foto'] = foto_hash
             
             # Guardar en Excel
             guardar_en_excel(datos)
@@ -569,12 +752,426 @@ def guardar():
     except Exception as e:
         return redirect(url_for('formulario') + f'?error={str(e)}')
 
+# ---- Exportación ----
+
+# Hoja 'Resumen diario': una fila por día × vaca y por día × ordeñador
+ENCABEZADOS_RESUMEN = ['Fecha', 'Tipo', 'Vaca / Ordeñador', 'Litros', 'Ordeños', 'Enfermedades', 'Vacunas']
+
+def filas_exportacion(hoja, args):
+    """Encabezados y generador de filas (listas de valores) de la hoja a exportar con sus filtros.
+
+    Parámetros: ``vaca`` (ID de la vaca, o de la madre en crías), ``desde``/``hasta``
+    ('AAAA-MM-DD') y ``foto=0`` para quitar la columna de la foto de los registros.
+    El resumen diario admite solo ``desde``/``hasta``.
+    """
+    vaca = args.get('vaca', '').strip()
+    desde = _fecha_param(args.get('desde')) or None
+    hasta = _fecha_param(args.get('hasta')) or None
+    if hoja == 'resumen':
+        return ENCABEZADOS_RESUMEN, almacen.iterar_resumen(desde, hasta)
+    if hoja == 'crias':
+        return ENCABEZADOS_CRIA, (cria_a_valores(c) for c in almacen.iterar_crias(vaca, desde, hasta))
+
+    registros = almacen.iterar_registros({'id_vaca': vaca}, desde, hasta)
+    if args.get('foto') == '0':
+        columna = CAMPOS_REGISTRO.index('foto')
+        encabezados = ENCABEZADOS_REGISTRO[:columna] + ENCABEZADOS_REGISTRO[columna + 1:]
+        return encabezados, (v[:columna] + v[columna + 1:] for v in map(registro_a_valores, registros))
+    return ENCABEZADOS_REGISTRO, (registro_a_valores(r) for r in registros)
+
+def _csv_por_trozos(encabezados, filas, lote=500):
+    """Genera el CSV en trozos de ``lote`` filas; el BOM hace que Excel lea bien los acentos."""
+    buf = io.StringIO()
+    escritor = csv.writer(buf)
+    buf.write('\ufeff')
+    escritor.writerow(encabezados)
+    for n, valores in enumerate(filas, 1):
+        escritor.writerow(valores)
+        if n % lote == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+@app.route('/exportar/<hoja>.<formato>')
+def exportar(hoja: str, formato: str):
+    """Descarga 'Registros', 'Crias' o el resumen diario en CSV (en streaming) o XLSX, con filtros opcionales.
+
+    ``/exportar/libro.xlsx`` es el libro completo (ambas hojas) en el formato de
+    ``registros_vacas.xlsx``, sea cual sea el almacén: la copia para la oficina.
+    """
+    if hoja not in ('registros', 'crias', 'resumen', 'libro') or formato not in ('csv', 'xlsx'):
+        abort(404)
+    nombre = f'{hoja}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{formato}'
+    if hoja == 'libro':
+        if formato != 'xlsx':
+            abort(404)
+        archivo = tempfile.TemporaryFile()
+        escribir_libro(archivo, almacen.registros(), almacen.crias())
+        archivo.seek(0)
+        return send_file(archivo, as_attachment=True, download_name=nombre,
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    encabezados, filas = filas_exportacion(hoja, request.args)
+    if formato == 'csv':
+        return Response(stream_with_context(_csv_por_trozos(encabezados, filas)),
+                        mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={nombre}'})
+
+    # El zip del XLSX no se puede enviar hasta cerrarlo: el modo write_only vuelca cada fila
+    # a disco, y el archivo temporal (anónimo) se envía y desaparece al cerrar la respuesta
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet({'crias': 'Crias', 'resumen': 'Resumen diario'}.get(hoja, 'Registros'))
+    ws.append(encabezados)
+    for valores in filas:
+        ws.append(valores)
+    archivo = tempfile.TemporaryFile()
+    wb.save(archivo)
+    archivo.seek(0)
+    return send_file(archivo, as_attachment=True, download_name=nombre,
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+# ---- Importación masiva ----
+
+# Nombre de columna del archivo (campo o encabezado del Excel, sin distinguir mayúsculas) -> campo
+_COLUMNAS_IMPORTACION = {c.lower(): c for c in CAMPOS_REGISTRO}
+_COLUMNAS_IMPORTACION.update((e.lower(), c) for e, c in zip(ENCABEZADOS_REGISTRO, CAMPOS_REGISTRO))
+
+def _texto_celda(valor):
+    """Valor de una celda o campo importado como el texto que enviaría el formulario."""
+    if valor is None:
+        return ''
+    if isinstance(valor, datetime):
+        return valor.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+def _lista_importada(valor):
+    """Vacunas/enfermedades: lista en JSON o texto separado por comas en CSV/XLSX."""
+    if isinstance(valor, list):
+        return [_texto_celda(v) for v in valor if _texto_celda(v)]
+    return [v.strip() for v in _texto_celda(valor).split(',') if v.strip()]
+
+def leer_filas_importacion():
+    """Filas a importar como ``[(numero, {campo: valor})]`` desde JSON, CSV o XLSX.
+
+    ``numero`` es la fila del archivo contando el encabezado (CSV/XLSX) o la posición
+    en el arreglo JSON, empezando en 1, para que los errores se puedan ubicar.
+    """
+    if request.is_json:
+        contenido, nombre = request.get_json(silent=True), '.json'
+        if contenido is None:
+            raise ValueError('El cuerpo no es un JSON válido')
+    else:
+        archivo = request.files.get('archivo')
+        if not archivo or not archivo.filename:
+            raise ValueError('No se envió el archivo de registros')
+        contenido, nombre = None, archivo.filename.lower()
+
+    if nombre.endswith('.json'):
+        if contenido is None:
+            contenido = json.load(archivo.stream)
+        if isinstance(contenido, dict):
+            contenido = contenido.get('registros')
+        if not isinstance(contenido, list) or not all(isinstance(r, dict) for r in contenido):
+            raise ValueError('El JSON debe ser un arreglo de registros')
+        filas = list(enumerate(contenido, 1))
+    elif nombre.endswith('.csv'):
+        lector = csv.DictReader(io.TextIOWrapper(archivo.stream, encoding='utf-8-sig', newline=''))
+        filas = list(enumerate(lector, 2))
+    elif nombre.endswith('.xlsx'):
+        wb = load_workbook(archivo.stream, read_only=True, data_only=True)
+        try:
+            hoja = wb.active.iter_rows(values_only=True)
+            encabezados = [_texto_celda(e) for e in next(hoja, ())]
+            filas = [(n, dict(zip(encabezados, row))) for n, row in enumerate(hoja, 2)
+                     if any(v is not None for v in row)]
+        finally:
+            wb.close()
+    else:
+        raise ValueError('Formato no soportado: use CSV, XLSX o JSON')
+
+    if len(filas) > IMPORTAR_MAX_FILAS:
+        raise ValueError(f'Demasiados registros: el máximo es {IMPORTAR_MAX_FILAS}')
+    normalizadas = []
+    for numero, fila in filas:
+        campos = {}
+        for columna, valor in fila.items():
+            campo = _COLUMNAS_IMPORTACION.get(_texto_celda(columna).lower())
+            if campo is not None:
+                campos[campo] = valor
+        normalizadas.append((numero, campos))
+    return normalizadas
+
+@app.route('/importar', methods=['POST'])
+def importar():
+    """Importa un lote de registros de ordeño (CSV, XLSX o JSON) con una sola escritura.
+
+    Las fotos son opcionales: la columna ``foto`` nombra un archivo dentro del zip
+    enviado en ``fotos``. Cada fila se valida con las reglas de ``/guardar``. Si alguna
+    falla no se guarda nada, salvo con ``?parcial=1``, que guarda las filas válidas.
+    La respuesta lista los errores por fila.
+    """
+    try:
+        filas = leer_filas_importacion()
+        zip_fotos = request.files.get('fotos')
+        zip_fotos = zipfile.ZipFile(zip_fotos.stream) if zip_fotos and zip_fotos.filename else None
+    except (ValueError, UnicodeDecodeError, zipfile.BadZipFile) as e:
+        return jsonify(success=False, error=str(e)), 400
+
+    errores = []
+    validas = []  # (numero, datos, trabajo de la foto o None)
+    trabajos = {}  # nombre en el zip -> trabajo del pool
+    for numero, campos in filas:
+        try:
+            datos = validar_registro(
+                {campo: _texto_celda(valor) for campo, valor in campos.items()},
+                _lista_importada(campos.get('vacunas')),
+                _lista_importada(campos.get('enfermedades')),
+                _texto_celda(campos.get('fecha_hora')),
+            )
+            trabajo = None
+            nombre_foto = _texto_celda(campos.get('foto'))
+            if nombre_foto:
+                if zip_fotos is None:
+                    raise ValueError(f'La foto {nombre_foto} requiere el zip de fotos')
+                if not allowed_file(nombre_foto):
+                    raise ValueError(f'Formato de imagen no permitido: {nombre_foto}')
+                try:
+                    info = zip_fotos.getinfo(nombre_foto)
+                except KeyError:
+                    raise ValueError(f'La foto {nombre_foto} no está en el zip') from None
+                if info.file_size > IMPORTAR_MAX_BYTES_FOTO:
+                    raise ValueError(f'La foto {nombre_foto} es demasiado grande')
+                # Todas las fotos se comprimen a la vez en el pool de procesos, una vez por archivo
+                trabajo = trabajos.get(nombre_foto)
+                if trabajo is None:
+                    trabajo = trabajos[nombre_foto] = pool_imagenes().submit(
+                        procesar_foto, zip_fotos.read(info), FOTO_MAX_BYTES)
+            validas.append((numero, datos, trabajo))
+        except ValueError as e:
+            errores.append({'fila': numero, 'error': str(e)})
+
+    listas = []  # (datos, (jpeg, derivados) o None)
+    with tramo('imagen'):
+        for numero, datos, trabajo in validas:
+            try:
+                listas.append((datos, trabajo.result() if trabajo is not None else None))
+            except Exception as e:
+                errores.append({'fila': numero, 'error': f'No se pudo procesar la foto: {e}'})
+    errores.sort(key=lambda e: e['fila'])
+
+    if errores and request.args.get('parcial') != '1':
+        return jsonify(success=False, importados=0, errores=errores), 400
+    for datos, foto in listas:
+        datos['foto'] = fotos.guardar(*foto) if foto is not None else None
+    # Un solo grupo en el diario: una escritura y un fsync para todo el lote
+    filas_nuevas = almacen.agregar_registros([datos_a_valores(datos) for datos, _ in listas])
+    return jsonify(success=True, importados=len(filas_nuevas), filas=filas_nuevas, errores=errores)
+
+# ---- Sincronización de dispositivos ----
+
+# Campos de una cría enviada por un dispositivo que no pueden faltar
+CAMPOS_CRIA_OBLIGATORIOS = ['madre_id', 'cria_id', 'cria_nombre', 'fecha_nacimiento', 'sexo']
+
+def _id_sincronizado(tipo, elemento):
+    """ID estable del alta a partir de la ``clave`` que eligió el dispositivo (la misma en cada reintento)."""
+    clave = _texto_celda(elemento.get('clave'))
+    if not clave:
+        raise ValueError('Falta la clave del elemento')
+    return uuid.uuid5(uuid.NAMESPACE_URL, f'veterinaria:sync:{tipo}:{clave}').hex
+
+def _foto_sincronizada(valor):
+    """Hash de una foto que el servidor ya tiene, o trabajo del pool que comprime la foto en base64."""
+    valor = _texto_celda(valor)
+    if not valor:
+        return None, None
+    if fotos.existe(valor):
+        return valor, None
+    try:
+        datos = base64.b64decode(valor, validate=True)
+    except ValueError:
+        raise ValueError('La foto debe ir en base64 o ser el hash de una foto ya enviada') from None
+    if len(datos) > IMPORTAR_MAX_BYTES_FOTO:
+        raise ValueError('La foto es demasiado grande')
+    return None, pool_imagenes().submit(procesar_foto, datos, FOTO_MAX_BYTES)
+
+def _cria_sincronizada(elemento, madres_del_lote):
+    """Valores de una cría enviada por un dispositivo; ValueError si falta algo (mismas reglas que /crias/guardar).
+
+    ``madres_del_lote`` (ID normalizado -> nombre) son las vacas de los registros válidos del mismo
+    lote, que todavía no están en el almacén: una vaca nueva y su cría pueden llegar juntas.
+    """
+    campos = {campo: _texto_celda(elemento.get(campo)) for campo in CAMPOS_CRIA_EDITABLES}
+    faltan = [campo for campo in CAMPOS_CRIA_OBLIGATORIOS if not campos[campo]]
+    if faltan:
+        raise ValueError('Faltan campos requeridos: ' + ', '.join(faltan))
+    if not campos['madre_nombre']:
+        vaca = almacen.vaca(campos['madre_id'])
+        if vaca is not None:
+            campos['madre_nombre'] = vaca['nombre']
+        elif clave_texto(campos['madre_id']) in madres_del_lote:
+            campos['madre_nombre'] = madres_del_lote[clave_texto(campos['madre_id'])]
+        else:
+            raise ValueError(f"No hay registros de la vaca {campos['madre_id']}")
+    if campos['fecha_registro']:
+        campos['fecha_registro'] = datetime.strptime(campos['fecha_registro'],
+                                                     '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:%S')
+    else:
+        campos['fecha_registro'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return [campos[campo] for campo in CAMPOS_CRIA_EDITABLES]
+
+def _leer_sincronizacion():
+    """``(cursor, registros, crias)`` de la petición: query string en GET, cuerpo JSON en POST."""
+    if request.method == 'GET':
+        return request.args.get('cursor', ''), [], []
+    cuerpo = request.get_json(silent=True)
+    if not isinstance(cuerpo, dict):
+        raise ValueError('El cuerpo debe ser un objeto JSON')
+    registros, crias = cuerpo.get('registros', []), cuerpo.get('crias', [])
+    for nombre, lista in (('registros', registros), ('crias', crias)):
+        if not isinstance(lista, list) or not all(isinstance(e, dict) for e in lista):
+            raise ValueError(f"'{nombre}' debe ser un arreglo de objetos")
+    if len(registros) + len(crias) > SINCRONIZAR_MAX_ELEMENTOS:
+        raise ValueError(f'Demasiados elementos: el máximo es {SINCRONIZAR_MAX_ELEMENTOS} por petición')
+    return _texto_celda(cuerpo.get('cursor')), registros, crias
+
+@app.route('/api/sincronizar', methods=['GET', 'POST'])
+def sincronizar():
+    """Sincronización de dispositivos de campo que trabajan sin conexión.
+
+    En POST el dispositivo envía lo que anotó sin conexión (``registros`` con los campos
+    del formulario, ``fecha_hora`` y ``foto`` en base64 o como hash ya enviado; ``crias``
+    con los campos de la hoja 'Crias'), cada elemento con una ``clave`` única elegida por
+    el dispositivo. La clave fija el ID del registro: reenviar un lote tras un corte
+    no duplica nada y esos elementos vuelven como ``duplicado``. Las altas válidas se
+    guardan con una sola escritura; cada elemento responde ``creado``, ``duplicado`` o
+    ``error`` con su mensaje.
+
+    En GET o POST la respuesta trae además los ``cambios`` posteriores a ``cursor``
+    (incluidos los de este lote) y el ``cursor`` para la próxima vez; con ``mas`` hay
+    que volver a pedir, con ese cursor, para completar la descarga.
+    """
+    limite = min(max(request.args.get('limite', SINCRONIZAR_MAX_CAMBIOS, type=int) or 1, 1),
+                 SINCRONIZAR_MAX_CAMBIOS)
+    try:
+        cursor, registros_recibidos, crias_recibidas = _leer_sincronizacion()
+        IndiceCambios.clave_cursor(cursor)
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+
+    resultados = {'registros': [], 'crias': []}
+    altas = {'registros': [], 'crias': []}  # (resultado, id, valores o datos, trabajo de la foto)
+    madres_del_lote = {}  # vacas de los registros válidos de este lote, para las crías que vienen detrás
+    for tipo, recibidos in (('registros', registros_recibidos), ('crias', crias_recibidas)):
+        for elemento in recibidos:
+            resultado = {'clave': elemento.get('clave')}
+            resultados[tipo].append(resultado)
+            try:
+                id_registro = _id_sincronizado(tipo, elemento)
+                # Reintento de algo ya guardado: no se vuelve a validar ni a comprimir la foto
+                existente = (almacen.registro_por_id if tipo == 'registros' else almacen.cria_por_id)(id_registro)
+                if existente is not None:
+                    resultado.update(estado='duplicado', id_registro=id_registro, fila=existente['fila'])
+                    continue
+                if tipo == 'crias':
+                    altas[tipo].append((resultado, id_registro, _cria_sincronizada(elemento, madres_del_lote), None))
+                    continue
+                datos = validar_registro(
+                    {campo: _texto_celda(valor) for campo, valor in elemento.items()},
+                    _lista_importada(elemento.get('vacunas')),
+                    _lista_importada(elemento.get('enfermedades')),
+                    _texto_celda(elemento.get('fecha_hora')),
+                )
+                datos['foto'], trabajo = _foto_sincronizada(elemento.get('foto'))
+                altas[tipo].append((resultado, id_registro, datos, trabajo))
+                madres_del_lote[clave_texto(datos['id_vaca'])] = datos['nombre_vaca']
+            except ValueError as e:
+                resultado.update(estado='error', error=str(e))
+
+    registros_validos = []
+    with tramo('imagen'):
+        for resultado, id_registro, datos, trabajo in altas['registros']:
+            try:
+                if trabajo is not None:
+                    datos['foto'] = fotos.guardar(*trabajo.result())
+                registros_validos.append((resultado, id_registro, datos))
+            except Exception as e:
+                resultado.update(estado='error', error=f'No se pudo procesar la foto: {e}')
+
+    # Una sola escritura para todo el lote; los IDs ya existentes no se repiten
+    filas_registros, filas_crias = almacen.agregar_con_id(
+        [(id_registro, datos_a_valores(datos)) for _, id_registro, datos in registros_validos],
+        [(id_registro, valores) for _, id_registro, valores, _ in altas['crias']],
+    )
+    guardados = zip([(r, i) for r, i, _ in registros_validos] + [(r, i) for r, i, _, _ in altas['crias']],
+                    filas_registros + filas_crias)
+    for (resultado, id_registro), (fila, nuevo) in guardados:
+        resultado.update(estado='creado' if nuevo else 'duplicado', id_registro=id_registro, fila=fila)
+
+    registros, crias, cursor, mas = almacen.cambios_desde(cursor, limite)
+    return jsonify(success=True, registros=resultados['registros'], crias=resultados['crias'],
+                   cambios={'registros': [registro_json(r) for r in registros], 'crias': crias},
+                   cursor=cursor, mas=mas)
+
+@app.cli.command('migrar-fotos')
+def migrar_fotos():
+    """Migración única: pasa las fotos base64 de la columna 6 al almacén de fotos y deja solo el hash."""
+    migradas = 0
+    archivadas = {}  # fila -> valores de los registros de meses archivados
+    for registro in almacen.registros():
+        valor = registro['foto']
+        if not valor or es_hash_foto(valor):
+            continue
+        # Celdas truncadas por el límite de 32767 caracteres de Excel: se conserva lo decodificable
+        valor = valor[:len(valor) - len(valor) % 4]
+        try:
+            datos = base64.b64decode(valor, validate=True)
+        except ValueError:
+            print(f"Fila {registro['fila']}: base64 inválido, se deja como está")
+            continue
+        valores = registro_a_valores(dict(registro, foto=fotos.guardar(datos)))
+        if almacen.archivado(registro['fila']):
+            # Los meses archivados no se editan: se reescriben sus libros de archivo al final
+            archivadas[registro['fila']] = valores
+        else:
+            almacen.actualizar_registro(registro['fila'], valores)
+        migradas += 1
+    # Volcar ya al Excel para que el archivo se reduzca
+    almacen.compactar()
+    if archivadas:
+        almacen.reescribir_archivados(archivadas)
+    print(f"Fotos migradas: {migradas}")
+
+@app.cli.command('migrar-almacen')
+@click.argument('destino', type=click.Choice(['excel', 'sqlite']))
+@click.option('--sobrescribir', is_flag=True, help='Reemplazar el contenido que ya tenga el destino')
+def migrar_almacen(destino, sobrescribir):
+    """Copia registros y crías del almacén en uso (ALMACEN) a DESTINO, con sus filas, IDs y versiones."""
+    if destino == ALMACEN:
+        raise click.UsageError(f"El almacén en uso ya es '{destino}'")
+    nuevo = crear_almacen(destino)
+    if os.path.exists(nuevo.ruta) and not sobrescribir:
+        raise click.UsageError(f'{nuevo.ruta} ya existe; usa --sobrescribir para reemplazarlo')
+    registros, crias = almacen.registros(), almacen.crias()
+    inicio = time.perf_counter()
+    nuevo.restaurar(registros, crias)
+    print(f"Copiados {len(registros)} registros y {len(crias)} crías a {nuevo.ruta} "
+          f"en {time.perf_counter() - inicio:.1f} s")
+    print(f"Para usarlo, arranca con VETERINARIA_ALMACEN={destino}")
+
+# Carga inicial: crea o migra el almacenamiento una sola vez (no en cada petición); el
+# Excel usa la instantánea si corresponde al libro actual
+if not _PROCESO_DEL_POOL:
+    almacen.cargar()
+
 if __name__ == '__main__':
     print("=" * 50)
     print("🐄 Servidor de Veterinaria iniciado")
     print("=" * 50)
-    print(f"📁 Archivo Excel: {EXCEL_FILE}")
-    print("📷 Imágenes almacenadas en base64 dentro del Excel")
+    print(f"📁 Datos: {almacen.ruta} ({ALMACEN})")
+    print(f"📷 Fotos almacenadas en la carpeta '{FOTOS_DIR}' (el Excel guarda su hash)")
     print("🌐 Abre tu navegador en: http://127.0.0.1:5000")
     print("=" * 50)
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,129 @@
+"""Benchmark de compresión de fotos: codificaciones y tiempo por foto, antes y después.
+
+Uso (desde la raíz del proyecto):
+
+    python benchmarks/imagenes.py [--fotos 8] [--lado 4032]
+
+"Antes" es el algoritmo original de ``procesar_imagen_a_base64`` (hasta 5 tamaños x
+8 calidades, midiendo el base64); "después" es ``fotos.comprimir_jpeg``. También se
+compara procesar las fotos de una en una con hacerlo en el pool de procesos.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageFilter, ImageOps  # noqa: E402
+
+import fotos  # noqa: E402
+
+
+def foto_sintetica(lado, semilla):
+    """JPEG tipo cámara de móvil (4:3, ruido suave sobre degradados) de ``lado`` px de ancho."""
+    rnd = random.Random(semilla)
+    ancho, alto = lado, lado * 3 // 4
+    base = Image.linear_gradient('L').resize((ancho, alto)).convert('RGB')
+    color = Image.new('RGB', (ancho, alto), (rnd.randint(60, 200), rnd.randint(60, 200), rnd.randint(40, 120)))
+    ruido = Image.effect_noise((ancho // 4, alto // 4), 60).resize((ancho, alto)).convert('RGB')
+    img = Image.blend(Image.blend(base, color, 0.5), ruido, 0.35).filter(ImageFilter.GaussianBlur(1))
+    buf = BytesIO()
+    img.save(buf, format='JPEG', quality=92)
+    return buf.getvalue()
+
+
+def original(datos, max_base64_len=32000):
+    """Copia del algoritmo anterior; devuelve (bytes, codificaciones)."""
+    img = ImageOps.exif_transpose(Image.open(BytesIO(datos)))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    codificaciones = 0
+    for max_px in fotos.TAMANOS:
+        copia = img.copy()
+        copia.thumbnail((max_px, max_px), Image.LANCZOS)
+        for q in fotos.CALIDADES:
+            buf = BytesIO()
+            copia.save(buf, format='JPEG', quality=q, optimize=True)
+            codificaciones += 1
+            raw = buf.getvalue()
+            if len(base64.b64encode(raw).decode('utf-8')) <= max_base64_len:
+                return raw, codificaciones
+    buf = BytesIO()
+    img_small = img.copy()
+    img_small.thumbnail((480, 480), Image.LANCZOS)
+    img_small.save(buf, format='JPEG', quality=50, optimize=True)
+    return buf.getvalue(), codificaciones + 1
+
+
+def nuevo(datos):
+    """``fotos.comprimir_jpeg`` contando las codificaciones; devuelve (bytes, codificaciones)."""
+    contador = [0]
+    codificar = fotos._codificar
+
+    def contar(img, calidad):
+        contador[0] += 1
+        return codificar(img, calidad)
+
+    fotos._codificar = contar
+    try:
+        return fotos.comprimir_jpeg(datos), contador[0]
+    finally:
+        fotos._codificar = codificar
+
+
+def medir(funcion, muestras):
+    codificaciones, tamanos = [], []
+    inicio = time.perf_counter()
+    for datos in muestras:
+        raw, n = funcion(datos)
+        codificaciones.append(n)
+        tamanos.append(len(raw))
+    total = time.perf_counter() - inicio
+    return {
+        'codificaciones_por_foto': sum(codificaciones) / len(muestras),
+        'codificaciones_max': max(codificaciones),
+        'ms_por_foto': round(total / len(muestras) * 1000, 1),
+        'bytes_medios': sum(tamanos) // len(tamanos),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fotos', type=int, default=8)
+    parser.add_argument('--lado', type=int, default=4032)
+    args = parser.parse_args()
+
+    muestras = [foto_sintetica(args.lado, i) for i in range(args.fotos)]
+    resultado = {
+        'fotos': args.fotos,
+        'lado_px': args.lado,
+        'bytes_subida_medios': sum(map(len, muestras)) // len(muestras),
+        'antes': medir(original, muestras),
+        'despues': medir(nuevo, muestras),
+    }
+
+    # Subidas simultáneas: una tras otra en el mismo proceso frente al pool de procesos
+    inicio = time.perf_counter()
+    for datos in muestras:
+        fotos.comprimir_jpeg(datos)
+    secuencial = time.perf_counter() - inicio
+    with ProcessPoolExecutor() as pool:
+        list(pool.map(fotos.comprimir_jpeg, muestras[:1]))  # arranque de los procesos
+        inicio = time.perf_counter()
+        list(pool.map(fotos.comprimir_jpeg, muestras))
+        paralelo = time.perf_counter() - inicio
+    resultado['lote_secuencial_s'] = round(secuencial, 3)
+    resultado['lote_pool_s'] = round(paralelo, 3)
+    resultado['procesos'] = os.cpu_count()
+
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Memoria por registro de ordeño cargado, sobre un rebaño sintético.
+
+Uso (desde la raíz del proyecto):
+
+    python benchmarks/memoria.py [--filas 100000] [--semilla 1] [--almacen excel sqlite]
+
+Genera un rebaño con ``rebano.py`` en un directorio temporal y mide con
+``tracemalloc``, cada medición en un proceso nuevo (sin objetos de las anteriores):
+
+- ``por_fila``: bytes por fila de los registros solos, como diccionarios (la forma
+  que tenían antes de ``almacen.Registro``) y como ``Registro``, construidos con las
+  filas tal como las lee openpyxl (un texto nuevo por celda, como SQLite y el diario).
+- ``almacen``: bytes por registro del almacén completo ya cargado (registros, crías,
+  índices, catálogo y estadísticas); el Excel se carga desde su instantánea.
+
+La salida es JSON para comparar entre commits.
+"""
+import argparse
+import gc
+import json
+import marshal
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rebano  # noqa: E402
+from rutas import copiar_a_sqlite  # noqa: E402
+
+
+def diccionario(idx, row):
+    """Registro como diccionario, como lo construía ``fila_a_registro`` antes de ``Registro``."""
+    from almacen import CAMPOS_REGISTRO, id_registro_legado
+    registro = {'fila': idx}
+    for pos, campo in enumerate(CAMPOS_REGISTRO):
+        registro[campo] = row[pos] if pos < len(row) else None
+    registro['vacunas'] = registro['vacunas'] or ''
+    registro['enfermedades'] = registro['enfermedades'] or ''
+    registro['condicion_corporal'] = registro['condicion_corporal'] or ''
+    registro['id_registro'] = registro['id_registro'] or id_registro_legado(idx)
+    registro['version'] = registro['version'] or 1
+    registro['seq'] = registro['seq'] or 0
+    return registro
+
+
+def medir_filas(ruta_filas, representacion):
+    """Bytes por fila que retienen los registros construidos con ``representacion``."""
+    from almacen import fila_a_registro
+    construir = fila_a_registro if representacion == 'registro' else diccionario
+    with open(ruta_filas, 'rb') as f:
+        datos = f.read()
+    gc.collect()
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    # Las filas se leen ya con tracemalloc activo: cuentan los textos que los registros retienen
+    filas = marshal.loads(datos)
+    registros = {idx: construir(idx, row) for idx, row in filas}
+    del filas
+    gc.collect()
+    total = tracemalloc.get_traced_memory()[0] - antes
+    tracemalloc.stop()
+    return round(total / len(registros))
+
+
+def medir_almacen(directorio, tipo):
+    """Bytes por registro del almacén ``tipo`` de ``directorio`` ya cargado (con todos sus índices)."""
+    from almacen import AlmacenExcel
+    from almacen_sqlite import AlmacenSQLite
+    gc.collect()
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    inicio = time.perf_counter()
+    if tipo == 'sqlite':
+        almacen = AlmacenSQLite(os.path.join(directorio, 'registros_vacas.sqlite3'))
+    else:
+        almacen = AlmacenExcel(os.path.join(directorio, 'registros_vacas.xlsx'))
+    almacen.cargar()
+    segundos = time.perf_counter() - inicio
+    gc.collect()
+    total = tracemalloc.get_traced_memory()[0] - antes
+    tracemalloc.stop()
+    return {'bytes_por_registro': round(total / len(almacen.registros())), 'carga_s_con_tracemalloc': round(segundos, 1)}
+
+
+def en_proceso_nuevo(*argumentos):
+    proceso = subprocess.run([sys.executable, os.path.abspath(__file__), *argumentos],
+                             capture_output=True, text=True, check=True)
+    return json.loads(proceso.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filas', type=int, default=100000)
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--almacen', nargs='+', choices=['excel', 'sqlite'], default=['excel', 'sqlite'])
+    # Uso interno: una medición en este proceso
+    parser.add_argument('--medir-filas', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--medir-almacen', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.medir_filas:
+        print(json.dumps(medir_filas(*args.medir_filas)))
+        return
+    if args.medir_almacen:
+        print(json.dumps(medir_almacen(*args.medir_almacen)))
+        return
+
+    from openpyxl import load_workbook
+    resultado = {'filas': args.filas}
+    with tempfile.TemporaryDirectory(prefix='rebano_') as directorio:
+        resumen = rebano.generar(directorio, args.filas, args.semilla)
+        resultado['vacas'] = resumen['vacas']
+
+        # Las filas del Excel tal como las lee openpyxl, guardadas para cada medición (marshal
+        # conserva lo que openpyxl comparta entre celdas, que no es nada: un texto por celda)
+        wb = load_workbook(resumen['ruta'], read_only=True)
+        filas = [(idx, row) for idx, row in enumerate(wb.active.iter_rows(min_row=2, values_only=True), start=2)
+                 if row and row[0]]
+        wb.close()
+        ruta_filas = os.path.join(directorio, 'filas.marshal')
+        with open(ruta_filas, 'wb') as f:
+            marshal.dump(filas, f)
+        del filas
+        resultado['por_fila'] = {representacion: en_proceso_nuevo('--medir-filas', ruta_filas, representacion)
+                                 for representacion in ('diccionario', 'registro')}
+
+        # El Excel deja escrita su instantánea en la primera carga; SQLite parte de una copia
+        if 'sqlite' in args.almacen:
+            copiar_a_sqlite(directorio)
+        else:
+            en_proceso_nuevo('--medir-almacen', directorio, 'excel')
+        resultado['almacen'] = {tipo: en_proceso_nuevo('--medir-almacen', directorio, tipo) for tipo in args.almacen}
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Generador de rebaños sintéticos: un ``registros_vacas.xlsx`` con N ordeños, crías y fotos.
+
+Uso (desde la raíz del proyecto):
+
+    python benchmarks/rebano.py --filas 10000 --destino /tmp/rebano [--semilla 1] [--fotos-base64]
+
+Crea ``<destino>/registros_vacas.xlsx`` con el formato actual (ID estable y versión
+incluidos) y ``<destino>/fotos`` con un puñado de fotos JPEG tipo cámara comprimidas
+como las sube la aplicación; cada registro apunta a una de ellas por su hash. Con
+``--fotos-base64`` la columna de la foto lleva el base64 como los libros anteriores
+a ``fotos/`` (sirve para medir la migración; ocupa ~32 KB por fila).
+
+El rebaño es reproducible: la misma semilla da el mismo libro. Hay una vaca por cada
+``--ordenos-por-vaca`` filas, ordeñada una vez al día, con su número de parto y
+crías coherentes, y algunas vacas con caídas de producción.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openpyxl import Workbook  # noqa: E402
+
+import fotos  # noqa: E402
+from almacen import ENCABEZADOS_CRIA, ENCABEZADOS_REGISTRO, HOJA_META, VERSION_ESQUEMA  # noqa: E402
+from imagenes import foto_sintetica  # noqa: E402
+
+NOMBRES = ['Lola', 'Mili', 'Estrella', 'Rosa', 'Canela', 'Luna', 'Perla', 'Manchas', 'Negra', 'Pinta',
+           'Dulce', 'Flor', 'Reina', 'Chispa', 'Nube', 'Paloma', 'Bonita', 'Morena', 'Blanca', 'Tita']
+ORDENADORES = ['Pedro', 'Juan', 'Ana', 'Luis', 'Marta', 'Carlos']
+ESTADOS = ['Productiva'] * 7 + ['En Reposo'] * 2 + ['No Productiva']
+VACUNAS = ['Aftosa', 'Brucella', 'Rabia', 'Carbón', 'IBR']
+ENFERMEDADES = ['Mastitis', 'Cojera', 'Fiebre']
+CONDICIONES = ['Delgada', 'Normal', 'Buena', 'Gorda']
+
+
+def generar(destino, filas, semilla=1, ordenos_por_vaca=30, fotos_distintas=12, fotos_base64=False):
+    """Escribe el rebaño en ``destino`` y devuelve un resumen (filas, vacas, crías, bytes)."""
+    rnd = random.Random(semilla)
+    os.makedirs(destino, exist_ok=True)
+    almacen_fotos = fotos.AlmacenFotos(os.path.join(destino, 'fotos'))
+
+    # Fotos tipo cámara de móvil comprimidas igual que en /guardar
+    hashes, base64s = [], []
+    for i in range(fotos_distintas):
+        jpeg, derivados = fotos.procesar_foto(foto_sintetica(1600, semilla * 1000 + i))
+        hashes.append(almacen_fotos.guardar(jpeg, derivados))
+        base64s.append(base64.b64encode(jpeg).decode('ascii'))
+
+    num_vacas = max(1, filas // ordenos_por_vaca)
+    vacas = []
+    for n in range(num_vacas):
+        partos = rnd.randint(0, 6)
+        vacas.append({
+            'id': f'V{n + 1:05d}',
+            'nombre': f'{rnd.choice(NOMBRES)} {n + 1}',
+            'edad': partos + rnd.randint(2, 4),
+            'partos': partos,
+            'base': rnd.uniform(8, 28),
+            # Una de cada veinte pierde producción en sus últimos ordeños
+            'caida': rnd.random() < 0.05,
+            'foto': rnd.randrange(fotos_distintas),
+        })
+
+    inicio = datetime(2024, 1, 1, 5, 0, 0)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Registros')
+    ws.append(ENCABEZADOS_REGISTRO)
+    for fila in range(filas):
+        vaca = vacas[fila % num_vacas]
+        dia = fila // num_vacas
+        litros = vaca['base'] * rnd.uniform(0.85, 1.15)
+        if vaca['caida'] and dia >= ordenos_por_vaca - 5:
+            litros *= 0.5
+        estado = rnd.choice(ESTADOS)
+        ws.append([
+            (inicio + timedelta(days=dia, minutes=rnd.randint(0, 180))).strftime('%Y-%m-%d %H:%M:%S'),
+            rnd.choice(ORDENADORES),
+            vaca['id'],
+            vaca['nombre'],
+            round(litros, 1) if estado == 'Productiva' else 0,
+            base64s[vaca['foto']] if fotos_base64 else hashes[vaca['foto']],
+            vaca['edad'],
+            estado,
+            'Sí' if vaca['partos'] else 'No',
+            'Sí' if estado == 'En Reposo' else 'No',
+            vaca['partos'],
+            vaca['partos'],
+            ', '.join(rnd.sample(VACUNAS, rnd.randint(0, 3))),
+            rnd.choice(ENFERMEDADES) if rnd.random() < 0.08 else 'Ninguna',
+            rnd.choice(CONDICIONES),
+            uuid.UUID(int=rnd.getrandbits(128)).hex,
+            1,
+            0,
+        ])
+
+    # Crías coherentes con el número de partos de cada madre
+    ws_crias = wb.create_sheet('Crias')
+    ws_crias.append(ENCABEZADOS_CRIA)
+    crias = 0
+    for vaca in vacas:
+        for parto in range(vaca['partos']):
+            crias += 1
+            nacimiento = inicio - timedelta(days=400 * (vaca['partos'] - parto))
+            ws_crias.append([
+                (nacimiento + timedelta(days=2)).strftime('%Y-%m-%d %H:%M:%S'),
+                vaca['id'],
+                vaca['nombre'],
+                f'C{crias:06d}',
+                f'Cría {crias}',
+                nacimiento.strftime('%Y-%m-%d'),
+                rnd.choice(['Hembra', 'Macho']),
+                '',
+                uuid.UUID(int=rnd.getrandbits(128)).hex,
+                0,
+            ])
+
+    # Ya en el esquema actual: el primer arranque no lo migra
+    meta = wb.create_sheet(HOJA_META)
+    meta.sheet_state = 'hidden'
+    meta.append(['seq_diario', 0])
+    meta.append(['version_esquema', VERSION_ESQUEMA])
+
+    ruta = os.path.join(destino, 'registros_vacas.xlsx')
+    wb.save(ruta)
+    return {
+        'ruta': ruta,
+        'filas': filas,
+        'vacas': num_vacas,
+        'crias': crias,
+        'fotos_distintas': fotos_distintas,
+        'fotos_base64': fotos_base64,
+        'bytes_excel': os.path.getsize(ruta),
+        'bytes_foto_media': sum(len(b) * 3 // 4 for b in base64s) // len(base64s),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filas', type=int, default=1000)
+    parser.add_argument('--destino', required=True)
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--ordenos-por-vaca', type=int, default=30)
+    parser.add_argument('--fotos-base64', action='store_true')
+    args = parser.parse_args()
+
+    inicio = time.perf_counter()
+    resumen = generar(args.destino, args.filas, args.semilla, args.ordenos_por_vaca,
+                      fotos_base64=args.fotos_base64)
+    resumen['segundos'] = round(time.perf_counter() - inicio, 2)
+    print(json.dumps(resumen, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""Benchmark de las rutas de la aplicación sobre rebaños sintéticos de varios tamaños.
+
+Uso (desde la raíz del proyecto):
+
+    python benchmarks/rutas.py [--filas 1000 10000 100000] [--repeticiones 30] [--rutas registros guardar ...]
+                               [--almacen excel sqlite]
+
+Para cada tamaño se genera un rebaño con ``rebano.py`` en un directorio temporal y se
+mide en un proceso nuevo (la memoria de un tamaño no contamina al siguiente), con el
+cliente de pruebas de Flask, cada ruta ``--repeticiones`` veces. Por ruta se informa:
+
+- ``p50_ms`` / ``p99_ms``: latencia de la petición completa (vista + plantilla/JSON).
+- ``rss_pico_kb``: pico de memoria residente del proceso al terminar la ruta (acumulado:
+  solo sube; compara el salto respecto a la ruta anterior).
+- ``bytes_escritos``: bytes por petición que el proceso escribió a archivos
+  (``wchar`` de ``/proc/self/io``; ``null`` fuera de Linux).
+
+Además se mide la carga inicial y la compactación del diario, que es la única
+operación que reescribe el libro. Con ``--almacen sqlite`` el rebaño se copia antes
+a la base SQLite y se mide con ese almacén (cada almacén, en su propio proceso).
+La salida es JSON para comparar entre commits.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import rebano  # noqa: E402
+from imagenes import foto_sintetica  # noqa: E402
+
+
+def rss_pico_kb():
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico // 1024 if sys.platform == 'darwin' else pico
+
+
+def bytes_escritos():
+    """Bytes pasados a write() por el proceso hasta ahora, o ``None`` si no se puede saber."""
+    try:
+        with open('/proc/self/io') as f:
+            for linea in f:
+                if linea.startswith('wchar:'):
+                    return int(linea.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def formulario_registro(id_vaca, nombre_vaca, version=None):
+    datos = {
+        'nombre_ordenador': 'Benchmark', 'id_vaca': id_vaca, 'nombre_vaca': nombre_vaca,
+        'edad': '5', 'estado_productivo': 'Productiva', 'vaca_parida': 'Sí', 'vaca_seca': 'No',
+        'numero_crias': '2', 'numero_parto': '2', 'litros': '18.5', 'condicion_corporal': 'Buena',
+        'vacunas': ['Aftosa', 'Rabia'], 'enfermedades': [],
+    }
+    if version is not None:
+        datos['version'] = str(version)
+    return datos
+
+
+def rutas_a_medir(cliente, app_mod, foto):
+    """Lista de (nombre, función que hace la petición). Las de escritura cambian el rebaño."""
+    almacen = app_mod.almacen
+    vaca = almacen.vacas()[0]
+    registro = almacen.registro(2)
+    fila_media = max(2, len(almacen.registros()) // 2)
+    mes = str(registro['fecha_hora'])[:7]
+
+    def guardar():
+        datos = formulario_registro(vaca['id'], vaca['nombre'])
+        datos['foto'] = (io.BytesIO(foto), 'vaca.jpg')
+        return cliente.post('/guardar', data=datos, content_type='multipart/form-data')
+
+    def actualizar():
+        actual = almacen.registro(2)
+        datos = formulario_registro(actual['id_vaca'], actual['nombre_vaca'], actual['version'])
+        return cliente.post('/actualizar/2', data=datos)
+
+    def importar():
+        filas = [dict(formulario_registro(vaca['id'], vaca['nombre']), vacunas='Aftosa', enfermedades='')
+                 for _ in range(50)]
+        return cliente.post('/importar?parcial=1', json=filas)
+
+    contador_crias = iter(range(10 ** 9))
+
+    def cria():
+        return cliente.post('/crias/guardar', data={
+            'madre': vaca['id'], 'cria_id': f'BENCH{next(contador_crias)}', 'cria_nombre': 'Bench',
+            'fecha_nacimiento': '2024-05-01', 'sexo': 'Hembra',
+        })
+
+    return [
+        ('inicio', lambda: cliente.get('/')),
+        ('registros', lambda: cliente.get('/registros')),
+        ('registros_filtro_vaca', lambda: cliente.get(f"/registros?vaca={vaca['id']}")),
+        ('registros_orden_litros', lambda: cliente.get('/registros?orden=litros&dir=desc&pagina=3')),
+        ('api_registros', lambda: cliente.get('/api/registros?por_pagina=100')),
+        ('api_registros_campos', lambda: cliente.get('/api/registros?por_pagina=100&fields=id_vaca,litros')),
+        ('api_registro', lambda: cliente.get(f'/api/registro/{fila_media}')),
+        ('api_registro_id', lambda: cliente.get(f"/api/registro/id/{registro['id_registro']}")),
+        ('editar', lambda: cliente.get(f'/editar/{fila_media}')),
+        ('foto_mini', lambda: cliente.get(f"/foto/{registro['foto']}?tam=mini", headers={'Accept': 'image/webp'})),
+        ('estadisticas', lambda: cliente.get('/estadisticas')),
+        ('estadisticas_mes', lambda: cliente.get(f'/estadisticas?mes={mes}')),
+        ('api_estadisticas_mes', lambda: cliente.get(f'/api/estadisticas?mes={mes}')),
+        ('produccion', lambda: cliente.get('/produccion')),
+        ('produccion_vaca', lambda: cliente.get(f"/produccion/{vaca['id']}")),
+        ('api_vacas', lambda: cliente.get('/api/vacas?q=V0')),
+        ('crias', lambda: cliente.get('/crias')),
+        ('exportar_csv', lambda: cliente.get('/exportar/registros.csv?foto=0')),
+        ('guardar', guardar),
+        ('actualizar', actualizar),
+        ('crias_guardar', cria),
+        ('importar_50', importar),
+    ]
+
+
+def copiar_a_sqlite(directorio):
+    """Copia el rebaño de ``directorio`` a su base SQLite (como ``flask migrar-almacen sqlite``)."""
+    from almacen import AlmacenExcel
+    from almacen_sqlite import AlmacenSQLite
+    excel = AlmacenExcel(os.path.join(directorio, 'registros_vacas.xlsx'))
+    excel.cargar()
+    AlmacenSQLite(os.path.join(directorio, 'registros_vacas.sqlite3')).restaurar(excel.registros(), excel.crias())
+
+
+def medir_rebano(directorio, repeticiones, seleccion, tipo_almacen='excel'):
+    """Mide las rutas con el rebaño de ``directorio`` (se ejecuta en un proceso propio)."""
+    os.chdir(directorio)
+    os.environ['VETERINARIA_ALMACEN'] = tipo_almacen
+    salida = io.StringIO()
+    resultado = {}
+    with contextlib.redirect_stdout(salida):
+        inicio = time.perf_counter()
+        import app as app_mod  # carga el almacén de ``directorio`` al importarse
+        resultado['carga_inicial_ms'] = round((time.perf_counter() - inicio) * 1000, 1)
+        resultado['rss_tras_carga_kb'] = rss_pico_kb()
+
+        almacen = app_mod.almacen
+        # Sin compactaciones en segundo plano: se miden aparte al final
+        almacen.umbral_compactacion = float('inf')
+        almacen.intervalo_compactacion = 10 ** 9
+        cliente = app_mod.app.test_client()
+        foto = foto_sintetica(1600, 7)
+
+        rutas = {}
+        for nombre, peticion in rutas_a_medir(cliente, app_mod, foto):
+            if seleccion and nombre not in seleccion:
+                continue
+            respuesta = peticion()  # calentamiento (plantillas, cachés, pool de imágenes)
+            respuesta.get_data()
+            escritos = bytes_escritos()
+            tiempos = []
+            for _ in range(repeticiones):
+                t = time.perf_counter()
+                respuesta = peticion()
+                respuesta.get_data()  # consume las respuestas en streaming
+                tiempos.append((time.perf_counter() - t) * 1000)
+            despues = bytes_escritos()
+            rutas[nombre] = {
+                'estado': respuesta.status_code,
+                'p50_ms': round(statistics.median(tiempos), 2),
+                'p99_ms': round(percentil(tiempos, 99), 2),
+                'rss_pico_kb': rss_pico_kb(),
+                'bytes_escritos': (despues - escritos) // repeticiones if escritos is not None else None,
+            }
+        resultado['rutas'] = rutas
+
+        escritos = bytes_escritos()
+        inicio = time.perf_counter()
+        operaciones = almacen.compactar()
+        resultado['compactacion'] = {
+            'operaciones': operaciones,
+            'ms': round((time.perf_counter() - inicio) * 1000, 1),
+            'bytes_escritos': bytes_escritos() - escritos if escritos is not None else None,
+            'rss_pico_kb': rss_pico_kb(),
+        }
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filas', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeticiones', type=int, default=30)
+    parser.add_argument('--rutas', nargs='*', default=[], help='medir solo estas rutas (por nombre)')
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--almacen', nargs='+', choices=['excel', 'sqlite'], default=['excel'])
+    parser.add_argument('--rebano', help=argparse.SUPPRESS)  # uso interno: mide un rebaño ya generado
+    args = parser.parse_args()
+
+    if args.rebano:
+        print(json.dumps(medir_rebano(args.rebano, args.repeticiones, set(args.rutas), args.almacen[0])))
+        return
+
+    resultados = []
+    for filas in args.filas:
+        with tempfile.TemporaryDirectory(prefix='rebano_') as directorio:
+            resumen = rebano.generar(directorio, filas, args.semilla)
+            if 'sqlite' in args.almacen:
+                copiar_a_sqlite(directorio)
+            for tipo in args.almacen:
+                # Cada almacén parte del mismo rebaño: las escrituras del anterior se descartan
+                copia = os.path.join(directorio, tipo)
+                shutil.copytree(directorio, copia, ignore=shutil.ignore_patterns(*args.almacen))
+                proceso = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--rebano', copia, '--almacen', tipo,
+                     '--repeticiones', str(args.repeticiones), '--rutas', *args.rutas],
+                    capture_output=True, text=True, check=True)
+                medicion = json.loads(proceso.stdout.strip().splitlines()[-1])
+                resultados.append({
+                    'filas': filas,
+                    'almacen': tipo,
+                    'vacas': resumen['vacas'],
+                    'crias': resumen['crias'],
+                    'bytes_excel': resumen['bytes_excel'],
+                    **medicion,
+                })
+    print(json.dumps({'repeticiones': args.repeticiones, 'rebanos': resultados}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
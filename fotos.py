@@ -0,0 +1,200 @@
+"""Compresión de fotos y almacén de fotos direccionado por contenido.
+
+Cada foto se guarda una sola vez como JPEG en ``<carpeta>/<2 primeros>/<hash>.jpg``,
+donde el hash es el SHA-256 de los bytes; la fila del Excel solo guarda el hash.
+Junto a ella se guardan derivados más pequeños (``<hash>_mini.jpg``,
+``<hash>_detalle.webp``...) para que los listados y vistas previas no descarguen la
+foto completa.
+
+Este módulo solo depende de Pillow (y de ``metricas``, que no tiene dependencias)
+para que los procesos del pool de compresión no tengan que importar la aplicación.
+Si se arrancó con ``python app.py``, esos procesos (forkserver o spawn) sí vuelven a
+ejecutar app.py como ``__mp_main__``, pero ahí se salta la carga de datos y las métricas.
+"""
+import hashlib
+import math
+import os
+import re
+from io import BytesIO
+
+from PIL import Image, ImageOps, features
+
+from metricas import tramo
+
+_PATRON_HASH = re.compile(r'[0-9a-f]{64}')
+
+# Lados máximos (px) y calidades JPEG a intentar, de mejor a peor
+TAMANOS = [800, 720, 640, 560, 480]
+CALIDADES = [85, 80, 75, 70, 65, 60, 55, 50]
+
+# Derivados: nombre -> lado máximo (px). 'mini' para la tabla de registros y
+# 'detalle' para las vistas previas de edición; la foto completa es la principal.
+VARIANTES = {'mini': 96, 'detalle': 400}
+CALIDAD_DERIVADOS = 80
+WEBP_DISPONIBLE = features.check('webp')
+FORMATOS_DERIVADOS = ('jpg', 'webp') if WEBP_DISPONIBLE else ('jpg',)
+
+
+def _codificar(img, calidad):
+    buf = BytesIO()
+    img.save(buf, format='JPEG', quality=calidad, optimize=True)
+    return buf.getvalue()
+
+
+def _mejor_calidad(img, max_bytes):
+    """JPEG con la mayor calidad de ``CALIDADES`` que cabe en ``max_bytes``.
+
+    Si ni la peor calidad cabe devuelve su tamaño en bytes (un ``int``) para que el
+    llamador pueda estimar qué lado probar después.
+
+    El tamaño crece con la calidad, así que basta una búsqueda binaria: se prueba la
+    peor calidad (si no cabe, ninguna cabe), la mejor (caso habitual en fotos pequeñas)
+    y luego se parte el intervalo. Son 2-5 codificaciones en lugar de hasta 8.
+    """
+    peor = _codificar(img, CALIDADES[-1])
+    if len(peor) > max_bytes:
+        return len(peor)
+    mejor = _codificar(img, CALIDADES[0])
+    if len(mejor) <= max_bytes:
+        return mejor
+    # Invariante: CALIDADES[hi] cabe (resultado en encontrado), CALIDADES[lo] no cabe
+    lo, hi, encontrado = 0, len(CALIDADES) - 1, peor
+    while hi - lo > 1:
+        medio = (lo + hi) // 2
+        raw = _codificar(img, CALIDADES[medio])
+        if len(raw) <= max_bytes:
+            hi, encontrado = medio, raw
+        else:
+            lo = medio
+    return encontrado
+
+
+def _abrir(datos):
+    """Abre la imagen orientada y en RGB, decodificando los JPEG grandes ya reducidos."""
+    img = Image.open(BytesIO(datos))
+    # Los JPEG grandes (cámara del móvil) se decodifican ya reducidos en escala 1/2, 1/4 u 1/8,
+    # sin bajar de lo necesario para que el lado mayor llegue a TAMANOS[0]
+    if img.format == 'JPEG':
+        factor = TAMANOS[0] / max(img.size)
+        if factor < 1:
+            img.draft('RGB', (math.ceil(img.width * factor), math.ceil(img.height * factor)))
+
+    # Corregir orientación y convertir a RGB
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+
+def _comprimir(img, max_bytes):
+    excedido = None  # (lado, bytes) del último tamaño que no cupo ni con la peor calidad
+    for max_px in TAMANOS:
+        # Los bytes crecen al menos con el área: si a este lado ni la estimación cabe, no se prueba
+        if excedido is not None and excedido[1] * (max_px / excedido[0]) ** 2 > max_bytes:
+            continue
+        # Redimensionar manteniendo proporción
+        copia = img.copy()
+        copia.thumbnail((max_px, max_px), Image.LANCZOS)
+        raw = _mejor_calidad(copia, max_bytes)
+        if isinstance(raw, int):
+            excedido = (max_px, raw)
+            continue
+        return raw
+
+    # Si no se pudo cumplir el límite, devolver la versión más comprimida posible
+    copia = img.copy()
+    copia.thumbnail((TAMANOS[-1], TAMANOS[-1]), Image.LANCZOS)
+    return _codificar(copia, CALIDADES[-1])
+
+
+def comprimir_jpeg(datos, max_bytes=24000):
+    """Redimensiona y comprime una imagen (bytes de cualquier formato soportado) a un JPEG de a lo sumo ``max_bytes``.
+
+    Se busca el mayor tamaño de ``TAMANOS`` y, dentro de él, la mayor calidad que
+    cumplan el límite. Si ninguna combinación lo cumple se devuelve la más comprimida.
+    """
+    return _comprimir(_abrir(datos), max_bytes)
+
+
+def generar_derivado(img, tam, formato):
+    """Bytes del derivado ``tam`` (clave de ``VARIANTES``) en ``formato`` ('jpg' o 'webp')."""
+    copia = img.copy()
+    copia.thumbnail((VARIANTES[tam], VARIANTES[tam]), Image.LANCZOS)
+    buf = BytesIO()
+    if formato == 'webp':
+        copia.save(buf, format='WEBP', quality=CALIDAD_DERIVADOS, method=4)
+    else:
+        copia.save(buf, format='JPEG', quality=CALIDAD_DERIVADOS, optimize=True)
+    return buf.getvalue()
+
+
+def procesar_foto(datos, max_bytes=24000):
+    """Foto principal comprimida más todos sus derivados, decodificando la imagen una sola vez.
+
+    Devuelve ``(principal, derivados)`` con ``derivados`` como ``{(tam, formato): bytes}``.
+    Pensada para ejecutarse en el pool de procesos.
+    """
+    img = _abrir(datos)
+    derivados = {
+        (tam, formato): generar_derivado(img, tam, formato)
+        for tam in VARIANTES
+        for formato in FORMATOS_DERIVADOS
+    }
+    return _comprimir(img, max_bytes), derivados
+
+
+def es_hash_foto(valor):
+    """True si el valor de la columna de foto es un hash (y no el base64 antiguo)."""
+    return isinstance(valor, str) and _PATRON_HASH.fullmatch(valor) is not None
+
+
+class AlmacenFotos:
+    """Guarda y localiza fotos por su hash SHA-256."""
+
+    def __init__(self, carpeta):
+        self.carpeta = os.path.abspath(carpeta)
+
+    def ruta(self, hash_foto, tam=None, formato='jpg'):
+        """Ruta de la foto principal o, con ``tam``, de uno de sus derivados."""
+        nombre = hash_foto if tam is None else f'{hash_foto}_{tam}'
+        return os.path.join(self.carpeta, hash_foto[:2], f'{nombre}.{formato}')
+
+    @staticmethod
+    def _escribir(destino, datos):
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        tmp = f'{destino}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(datos)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, destino)
+
+    def guardar(self, datos, derivados=None):
+        """Guarda los bytes JPEG (si no existían ya) y sus derivados; devuelve el hash.
+
+        ``derivados`` es el diccionario ``{(tam, formato): bytes}`` de ``procesar_foto``.
+        """
+        hash_foto = hashlib.sha256(datos).hexdigest()
+        with tramo('fotos_guardado'):
+            for (tam, formato), contenido in (derivados or {}).items():
+                destino = self.ruta(hash_foto, tam, formato)
+                if not os.path.exists(destino):
+                    self._escribir(destino, contenido)
+            # La principal va al final: si existe, sus derivados también (salvo fotos migradas)
+            destino = self.ruta(hash_foto)
+            if not os.path.exists(destino):
+                self._escribir(destino, datos)
+        return hash_foto
+
+    def ruta_derivado(self, hash_foto, tam, formato):
+        """Ruta del derivado, generándolo desde la principal si falta (fotos guardadas antes de existir)."""
+        destino = self.ruta(hash_foto, tam, formato)
+        if not os.path.exists(destino):
+            with tramo('imagen_derivado'):
+                with open(self.ruta(hash_foto), 'rb') as f:
+                    img = _abrir(f.read())
+                self._escribir(destino, generar_derivado(img, tam, formato))
+        return destino
+
+    def existe(self, hash_foto):
+        return es_hash_foto(hash_foto) and os.path.exists(self.ruta(hash_foto))
@@ -0,0 +1,169 @@
+"""Métricas de la aplicación en el formato de texto de Prometheus (sin dependencias).
+
+Histogramas de duración por petición y por tramo (carga y guardado del Excel,
+diario, imágenes, plantillas...) y contadores, que se exponen en ``/metrics``.
+Un tramo medido durante una petición suma además su duración al desglose de esa
+petición, que es lo que se muestra en el registro de peticiones lentas.
+
+Los valores son de este proceso: con varios workers cada uno expone los suyos.
+Medir cuesta dos ``perf_counter`` y una suma bajo un lock por tramo; con
+``activas = False`` los tramos no hacen nada.
+"""
+import bisect
+import threading
+import time
+
+# Límites superiores (segundos) de las cubetas de los histogramas
+CUBETAS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+activas = True
+
+_registro = []  # métricas en el orden en que se exponen
+_local = threading.local()
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _etiquetas(nombres, valores, extra=''):
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return '{' + ','.join(pares) + '}' if pares else ''
+
+
+def _numero(valor):
+    if valor == float('inf'):
+        return '+Inf'
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class Histograma:
+    """Histograma con una serie por combinación de valores de ``etiquetas``."""
+
+    def __init__(self, nombre, ayuda, etiquetas=(), cubetas=CUBETAS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.cubetas = tuple(cubetas)
+        self._series = {}  # valores de etiquetas -> [conteos por cubeta (+Inf al final), suma]
+        self._lock = threading.Lock()
+        _registro.append(self)
+
+    def observar(self, valor, *etiquetas):
+        posicion = bisect.bisect_left(self.cubetas, valor)
+        with self._lock:
+            serie = self._series.get(etiquetas)
+            if serie is None:
+                serie = self._series[etiquetas] = [[0] * (len(self.cubetas) + 1), 0.0]
+            serie[0][posicion] += 1
+            serie[1] += valor
+
+    def exponer(self):
+        with self._lock:
+            series = [(clave, list(conteos), suma) for clave, (conteos, suma) in sorted(self._series.items())]
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} histogram']
+        for clave, conteos, suma in series:
+            acumulado = 0
+            for limite, conteo in zip(self.cubetas + (float('inf'),), conteos):
+                acumulado += conteo
+                le = _etiquetas(self.etiquetas, clave, f'le="{_numero(limite)}"')
+                lineas.append(f'{self.nombre}_bucket{le} {acumulado}')
+            lineas.append(f'{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {_numero(suma)}')
+            lineas.append(f'{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {acumulado}')
+        return lineas
+
+
+class Contador:
+    """Contador monótono con una serie por combinación de valores de ``etiquetas``."""
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registro.append(self)
+
+    def incrementar(self, *etiquetas, cantidad=1):
+        with self._lock:
+            self._series[etiquetas] = self._series.get(etiquetas, 0) + cantidad
+
+    def exponer(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} counter']
+        lineas += [f'{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(valor)}' for clave, valor in series]
+        return lineas
+
+
+class Indicador:
+    """Valor que se lee al exponer las métricas (``funcion`` devuelve un número)."""
+
+    def __init__(self, nombre, ayuda, funcion, tipo='gauge'):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.funcion = funcion
+        self.tipo = tipo
+        _registro.append(self)
+
+    def exponer(self):
+        try:
+            valor = self.funcion()
+        except Exception:
+            return []
+        return [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} {self.tipo}',
+                f'{self.nombre} {_numero(valor)}']
+
+
+TRAMOS = Histograma('veterinaria_tramo_segundos',
+                    'Duración de las operaciones internas (Excel, diario, imágenes, plantillas)', ['tramo'])
+
+
+def exponer():
+    """Todas las métricas registradas en el formato de texto de Prometheus."""
+    lineas = []
+    for metrica in _registro:
+        lineas += metrica.exponer()
+    return '\n'.join(lineas) + '\n'
+
+
+# ---- Tramos y desglose por petición ----
+
+def iniciar_peticion():
+    """Empieza el desglose de tramos de la petición que atiende este hilo."""
+    _local.desglose = {}
+
+
+def terminar_peticion():
+    """Termina el desglose del hilo y lo devuelve (``{tramo: segundos}``)."""
+    desglose = getattr(_local, 'desglose', None)
+    _local.desglose = None
+    return desglose or {}
+
+
+def registrar_tramo(nombre, duracion):
+    """Anota ``duracion`` segundos del tramo ``nombre`` (y en el desglose de la petición en curso)."""
+    TRAMOS.observar(duracion, nombre)
+    desglose = getattr(_local, 'desglose', None)
+    if desglose is not None:
+        desglose[nombre] = desglose.get(nombre, 0.0) + duracion
+
+
+class tramo:
+    """``with tramo('excel_guardado'): ...`` mide el bloque como el tramo indicado."""
+
+    __slots__ = ('nombre', 'inicio')
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+
+    def __enter__(self):
+        self.inicio = time.perf_counter() if activas else None
+        return self
+
+    def __exit__(self, *exc):
+        if self.inicio is not None:
+            registrar_tramo(self.nombre, time.perf_counter() - self.inicio)
+        return False